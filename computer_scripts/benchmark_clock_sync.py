@@ -0,0 +1,144 @@
+import argparse
+import sys
+import time
+import numpy as np
+from clock_sync import ClockSync
+from hand_protocol import (MessageDecoder, TimestampUnwrapper, RawForce, RawForceBlock, force_frame_size,
+    TOGGLE_FORCE_STREAM, TOGGLE_FORCE_BLOCK_STREAM)
+from hand_emulator import HandFirmware, MemoryHandEmulator
+
+"""
+
+Accuracy of the hand to computer clock mapping (clock_sync.ClockSync)
+
+Live test - an emulated hand with a skewed millis() clock that starts just
+before the 32 bit wrap streams readings with random send delays. The
+timestamps must keep increasing across the wrap, and the fitted mapping is
+compared with the true time each reading was taken.
+
+Simulated test - hours of readings with random delays and occasional stalls
+(readings queued behind a busy listener) are generated without waiting, to
+check the drift estimate over long runs.
+
+"""
+
+parser = argparse.ArgumentParser(description="Check clock synchronisation with the hand emulator")
+parser.add_argument("--duration", type=float, default=15.0, help="Seconds of live streaming (at least 15)")
+parser.add_argument("--skew-ppm", type=float, default=300.0, help="Emulated device clock error")
+parser.add_argument("--jitter", type=float, default=0.002, help="Mean random send delay (s)")
+parser.add_argument("--blocks", action="store_true", help="Use the force block stream")
+parser.add_argument("--baudrate", type=int, default=115200)
+parser.add_argument("--simulated-hours", type=float, default=4.0, help="Length of the simulated test")
+args = parser.parse_args()
+# Shorter runs fit too few 1 s windows to tell a few hundred ppm of drift from none
+if args.duration < 15.0:
+    parser.error("--duration must be at least 15 s - the drift is fitted over 1 s windows")
+
+failed = False
+
+def check(name, ok):
+    global failed
+    failed = failed or not ok
+    print(f"{name:<44}{'ok' if ok else 'FAIL'}")
+
+def percentiles(values):
+    return f"p50 {np.percentile(values, 50)*1e3:.2f} p99 {np.percentile(values, 99)*1e3:.2f} max {np.max(values)*1e3:.2f} ms"
+
+
+# Live test
+first_clock = []
+def clock():
+    t = time.perf_counter()
+    if not first_clock:
+        first_clock.append(t)
+    return t
+
+start_millis = (1 << 32) - int(args.duration * 500)     # Wraps half way through
+rate = 1.0 + args.skew_ppm * 1e-6
+firmware = HandFirmware(debug_only=False, clock=clock, clock_skew_ppm=args.skew_ppm, start_millis=start_millis)
+emulator = MemoryHandEmulator(firmware, baudrate=args.baudrate, stream_interval=0.01, block_interval=0.005,
+                              jitter=args.jitter, seed=1)
+ser = emulator.serial
+ser.timeout = 0.05
+decoder = MessageDecoder(unwrap_timestamps=True)
+# Each frame is fitted by when it started arriving, as in the GUI - blocks can be partial
+byte_time = 10.0 / args.baudrate
+sync = ClockSync()
+device_ms, arrivals, delays = [], [], []
+with emulator:
+    ser.write(bytes([TOGGLE_FORCE_BLOCK_STREAM if args.blocks else TOGGLE_FORCE_STREAM]))
+    end = time.perf_counter() + args.duration
+    while time.perf_counter() < end:
+        data = ser.read(ser.in_waiting or 1)
+        arrival = time.perf_counter()
+        for message in decoder.feed(data):
+            if type(message) is RawForce:
+                frame_time = force_frame_size(message) * byte_time
+                delays.append(sync.update(message.timestamp, arrival - frame_time) + frame_time)
+                device_ms.append(message.timestamp)
+                arrivals.append(arrival)
+            elif type(message) is RawForceBlock:
+                frame_time = force_frame_size(message) * byte_time
+                delays.extend(sync.update_array(message.timestamps, arrival - frame_time) + frame_time)
+                device_ms.extend(message.timestamps.tolist())
+                arrivals.extend([arrival] * len(message.timestamps))
+
+device_ms = np.array(device_ms, dtype=np.int64)
+# True time each reading was taken - millis() truncates, so up to 1 ms (device) later
+taken = first_clock[0] + (device_ms - start_millis) / (1000.0 * rate)
+errors = sync.to_host(device_ms) - taken
+settled = device_ms >= device_ms[0] + 2000     # After the first two windows
+# Window minima are only known to the 1 ms resolution of millis(), so the fitted
+# slope through n windows is uncertain by sigma * sqrt(12 / (n (n^2 - 1))) / window -
+# short runs get a wider tolerance (4 sigma, at least 100 ppm)
+windows = max(sync.stats()['windows_fitted'], 2)
+slope_sigma = 1e-3 / 12 ** 0.5 * (12 / (windows * (windows ** 2 - 1))) ** 0.5 / sync.window
+drift_tolerance = max(100.0, 4 * slope_sigma * 1e6)
+print(f"Live : {len(device_ms)} readings, {decoder.unwrapper.wraps} wrap, {args.skew_ppm:+.0f} ppm skew, "
+      f"{args.jitter*1e3:.1f} ms mean send delay")
+print(f"  Estimated drift {sync.drift_ppm:+.1f} ppm")
+print(f"  Mapping error (fitted - true)    {percentiles(np.abs(errors[settled]))}")
+print(f"  Reading delay (arrival - taken)  {percentiles(np.array(delays)[settled])}")
+check("Timestamps increase across the wrap", decoder.unwrapper.wraps == 1 and np.all(np.diff(device_ms) >= 0))
+# The check can only fail a wrong estimate if the skew is well outside the tolerance of zero
+if abs(args.skew_ppm) >= 2 * drift_tolerance:
+    check(f"Drift within {drift_tolerance:.0f} ppm (live)", abs(sync.drift_ppm - args.skew_ppm) < drift_tolerance)
+    check("Drift distinguished from zero (live)", abs(sync.drift_ppm) > drift_tolerance
+          and (sync.drift_ppm > 0) == (args.skew_ppm > 0))
+else:
+    print(f"SKIPPED drift checks (live) - {args.skew_ppm:+.0f} ppm skew cannot be told from none "
+          f"with a {drift_tolerance:.0f} ppm tolerance - use --skew-ppm {2 * drift_tolerance:.0f} or more")
+check("Mapping error p99 within 5 ms (live)", np.percentile(np.abs(errors[settled]), 99) < 0.005)
+
+
+# Simulated test
+rng = np.random.default_rng(0)
+count = int(args.simulated_hours * 3600 * 100)
+device_ms = (np.arange(count, dtype=np.int64) * 10 + start_millis) & 0xFFFFFFFF
+taken = np.arange(count) * 0.01 / rate
+transit = 7 * 10.0 / 9600       # Fastest possible arrival - one frame at 9600 baud
+delay = transit + rng.exponential(args.jitter, count)
+# Stalls - every ~20 s the listener is busy for 300 ms and readings queue up
+for stall in np.flatnonzero(rng.random(count) < 1 / 2000):
+    queued = slice(stall, min(stall + 30, count))
+    delay[queued] += np.linspace(0.3, 0.0, queued.stop - queued.start)
+arrival = taken + delay
+unwrapper = TimestampUnwrapper()
+sync = ClockSync(base_delay=transit)
+start = time.perf_counter()
+unwrapped = unwrapper.unwrap_array(device_ms)
+for t, a in zip(unwrapped.tolist(), arrival.tolist()):
+    sync.update(t, a)
+elapsed = time.perf_counter() - start
+# Error over the last minute
+errors = sync.to_host(unwrapped[-6000:]) - taken[-6000:]
+print(f"Simulated : {args.simulated_hours:.0f} h of readings at 100/s, {unwrapper.wraps} wrap, "
+      f"{elapsed / count * 1e6:.2f} us per update")
+print(f"  Estimated drift {sync.drift_ppm:+.2f} ppm (true {args.skew_ppm:+.0f})")
+print(f"  Mapping error over the last minute {percentiles(np.abs(errors))}")
+check("Drift within 2 ppm (simulated)", abs(sync.drift_ppm - args.skew_ppm) < 2)
+check("Mapping error within 2 ms (simulated)", np.max(np.abs(errors)) < 0.002)
+
+if failed:
+    print("FAIL")
+    sys.exit(1)
@@ -0,0 +1,89 @@
+import argparse
+import sys
+import time
+import numpy as np
+from force_filters import (MovingAverage, MedianFilter, Decimator, FilterChain, ContactDetector,
+    lowpass, lfilter)
+
+"""
+
+Per-reading cost of the streaming force filters, and a check that
+filtering in chunks gives the same output as filtering one reading at a time
+
+Chunk size 1 is a stream of single RawForce messages, 16 is a stream of
+RawForceBlock messages and larger chunks are replays of recordings.
+The budget is the time between readings of the block stream at 115200 baud
+(about 3100 readings/s, see benchmark_link.py) - every filter must take a
+small fraction of it.
+
+"""
+
+BUDGET_READINGS_PER_S = 3100
+
+parser = argparse.ArgumentParser(description="Benchmark streaming force filters")
+parser.add_argument("--readings", type=int, default=20000, help="Readings in the test signal")
+parser.add_argument("--chunks", type=int, nargs='+', default=[1, 16, 1024], help="Chunk sizes to time")
+args = parser.parse_args()
+
+# Test signal - noisy force with two contacts
+rng = np.random.default_rng(0)
+timestamps = np.arange(args.readings, dtype=np.int64) * 10
+values = 200 + rng.normal(0, 15, args.readings)
+values[args.readings // 4:args.readings // 2] += 400
+values[3 * args.readings // 4:] += 250
+values = np.clip(np.rint(values), 0, 1023).astype(np.int64)
+
+filters = {
+    'moving_average_8': lambda: MovingAverage(8),
+    'lowpass_0.1': lambda: lowpass(0.1, 1.0),
+    'median_5': lambda: MedianFilter(5),
+    'decimate_4': lambda: Decimator(4),
+    'chain': lambda: FilterChain(MedianFilter(5), lowpass(0.1, 1.0), Decimator(4)),
+    'contact': lambda: ContactDetector(450, 350),
+    }
+
+def run(make, chunk):
+    f = make()
+    outputs = []
+    start = time.perf_counter()
+    for i in range(0, len(values), chunk):
+        outputs.append(f.process(timestamps[i:i + chunk], values[i:i + chunk]))
+    elapsed = time.perf_counter() - start
+    return outputs, elapsed
+
+def combine(outputs):
+    if outputs and isinstance(outputs[0], list):
+        return [event for events in outputs for event in events]
+    return np.concatenate([o[0] for o in outputs]), np.concatenate([o[1] for o in outputs])
+
+def same(a, b):
+    if isinstance(a, list):
+        return a == b
+    return np.array_equal(a[0], b[0]) and np.allclose(a[1], b[1], rtol=1e-12, atol=1e-9)
+
+print(f"Biquad implementation : {'scipy.signal.lfilter' if lfilter is not None else 'NumPy blocks'}")
+print(f"Budget : {1e6 / BUDGET_READINGS_PER_S:.0f} us per reading ({BUDGET_READINGS_PER_S} readings/s)")
+print(f"{'filter':<20}" + "".join(f"{'chunk ' + str(c):>14}" for c in args.chunks) + "   chunked == single")
+failed = False
+for name, make in filters.items():
+    reference = combine(run(make, 1)[0])
+    row = f"{name:<20}"
+    matches = True
+    for chunk in args.chunks:
+        outputs, elapsed = run(make, chunk)
+        matches = matches and same(combine(outputs), reference)
+        row += f"{elapsed / len(values) * 1e6:>11.2f} us"
+    # Uneven chunk sizes as well
+    f = make()
+    bounds = np.cumsum(rng.integers(1, 50, len(values)))
+    bounds = np.concatenate(((0,), bounds[bounds < len(values)], (len(values),)))
+    uneven = [f.process(timestamps[a:b], values[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+    matches = matches and same(combine(uneven), reference)
+    failed = failed or not matches
+    print(row + f"   {'yes' if matches else 'NO'}")
+
+events = run(filters['contact'], 16)[0]
+print("Contact events :", [(e.kind, e.timestamp) for e in combine(events)])
+if failed:
+    print("FAIL - chunked output differs from single reading output")
+    sys.exit(1)
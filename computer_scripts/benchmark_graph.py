@@ -0,0 +1,65 @@
+import argparse
+import math
+import sys
+import time
+import tkinter as tk
+
+from communication_gui import GraphDisplayFrame
+
+"""
+
+Measures how many frames per second GraphDisplayFrame can draw while
+data is streaming in
+The visible window holds --points samples, which the graph reduces to about
+one min/max pair per pixel
+Requires a display as the graph is drawn in a real Tk window
+
+Target: at least 30 frames per second with 10000 visible points
+
+"""
+
+TARGET_FPS = 30
+TARGET_POINTS = 10000
+
+parser = argparse.ArgumentParser(description="Benchmark force graph rendering")
+parser.add_argument("--points", type=int, default=TARGET_POINTS, help="Number of visible points")
+parser.add_argument("--frames", type=int, default=300, help="Number of frames to draw")
+parser.add_argument("--batch", type=int, default=20, help="Points appended per frame")
+parser.add_argument("--target-fps", type=float, default=TARGET_FPS, help="Frames per second required to pass")
+args = parser.parse_args()
+
+root = tk.Tk()
+t = 0.0
+dt = 0.01
+graph = GraphDisplayFrame("Benchmark", root, window=args.points*dt)
+graph.grid(row=0, column=0)
+root.update()
+
+# Fill the graph so every frame covers the full number of points
+def next_batch(count):
+    global t
+    xs = [t + i*dt for i in range(count)]
+    ys = [math.sin(x) * 512 + 512 for x in xs]
+    t += count*dt
+    return xs, ys
+
+graph.extend_data(*next_batch(args.points))
+graph.update_display()
+root.update()
+
+# Draw frames as fast as possible
+start = time.perf_counter()
+for frame in range(args.frames):
+    graph.extend_data(*next_batch(args.batch))
+    graph.update_display()
+    root.update()
+elapsed = time.perf_counter() - start
+root.destroy()
+
+fps = args.frames / elapsed
+print(f"{args.points} points, {args.frames} frames in {elapsed:.3f} s")
+print(f"{fps:.1f} frames per second ({1000.0/fps:.2f} ms per frame)")
+if fps < args.target_fps:
+    print(f"FAIL - below target of {args.target_fps} frames per second")
+    sys.exit(1)
+print(f"PASS - target is {args.target_fps} frames per second")
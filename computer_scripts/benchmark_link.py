@@ -0,0 +1,258 @@
+import argparse
+import json
+import sys
+import time
+# pySerial
+import serial
+# Threading
+from threading import Thread
+from queue import Queue, Empty
+# Hand serial protocol
+from hand_protocol import (MessageDecoder, StringMessage, AllServoPositions, AllServoLimits, RawForce,
+    RawForceBlock, QUERY_ALL_POSITIONS, QUERY_ALL_LIMITS, QUERY_FORCE_RAW, TOGGLE_FORCE_STREAM,
+    TOGGLE_FORCE_BLOCK_STREAM, encode_servo_command, encode_raw_force_message)
+from hand_emulator import HandFirmware, PtyHandEmulator
+
+"""
+
+Latency and throughput benchmarks for the serial link, run against the
+hand emulator on a pty (Linux/macOS)
+
+The host side mirrors communication_gui.py: a listener thread reads from
+the port, decodes messages and puts them on a queue for the consumer
+
+Reports:
+    Round-trip latency (p50/p95/p99) for each command type
+    Force stream frames/s, bytes/s, listener CPU time per frame and queue lag
+    Force samples/s with single reading frames and with packed blocks, and the gain
+    Decoder-only frames/s and CPU time per frame (no serial port)
+
+Usage:
+    python benchmark_link.py --save-baseline baseline.json
+    python benchmark_link.py --compare baseline.json
+
+"""
+
+# Allowed relative change before a result counts as a regression
+default_tolerance = 0.2
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+# Host side of the link - listener thread, decoder and message queue
+class LinkHarness:
+    def __init__(self, port):
+        self.ser = serial.Serial(port, timeout=0.1)
+        self.queue = Queue()
+        self.decoder = MessageDecoder()
+        self.bytes_received = 0
+        self.listener_cpu_time = 0.0
+        self._running = True
+        self._thread = Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def _listen(self):
+        start_cpu = time.thread_time()
+        while self._running:
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if data:
+                self.bytes_received += len(data)
+                now = time.perf_counter()
+                for message in self.decoder.feed(data):
+                    self.queue.put((message, now))
+            self.listener_cpu_time = time.thread_time() - start_cpu
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self.ser.close()
+
+    # Discard everything received so far
+    def drain(self, settle=0.2):
+        time.sleep(settle)
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                return
+
+    # Wait for a message of the given type, returns (message, time decoded)
+    def wait_for(self, message_type, timeout=2.0):
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"No {message_type.__name__} received")
+            message, decoded_at = self.queue.get(timeout=remaining)
+            if type(message) is message_type:
+                return message, decoded_at
+
+
+# Command name -> (bytes to send, reply type)
+# Servo commands are answered by the DEBUG_ONLY string
+latency_commands = {
+    'query_positions': (bytes([QUERY_ALL_POSITIONS]), AllServoPositions),
+    'query_limits': (bytes([QUERY_ALL_LIMITS]), AllServoLimits),
+    'query_force': (bytes([QUERY_FORCE_RAW]), RawForce),
+    'set_servo': (encode_servo_command(0, 90), StringMessage),
+    }
+
+def benchmark_latency(baudrate, iterations):
+    results = {}
+    with PtyHandEmulator(HandFirmware(debug_only=True), baudrate=baudrate) as emulator:
+        link = LinkHarness(emulator.port)
+        link.drain()
+        for name, (command, reply_type) in latency_commands.items():
+            samples = []
+            for _ in range(iterations):
+                sent_at = time.perf_counter()
+                link.ser.write(command)
+                link.wait_for(reply_type)
+                samples.append((time.perf_counter() - sent_at) * 1000.0)
+            results[name] = {
+                'p50_ms': percentile(samples, 50),
+                'p95_ms': percentile(samples, 95),
+                'p99_ms': percentile(samples, 99),
+                }
+        link.close()
+    return results
+
+# Max rate force stream - single readings, or packed blocks if blocks is True
+def benchmark_stream(baudrate, duration, blocks=False):
+    toggle = TOGGLE_FORCE_BLOCK_STREAM if blocks else TOGGLE_FORCE_STREAM
+    message_type = RawForceBlock if blocks else RawForce
+    with PtyHandEmulator(HandFirmware(debug_only=False), baudrate=baudrate,
+                         stream_interval=0, block_interval=0) as emulator:
+        link = LinkHarness(emulator.port)
+        link.drain()
+        link.ser.write(bytes([toggle]))
+        link.wait_for(message_type)
+        frames = 0
+        samples = 0
+        lags = []
+        start_bytes = link.bytes_received
+        start_cpu = link.listener_cpu_time
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            try:
+                message, decoded_at = link.queue.get(timeout=0.5)
+            except Empty:
+                continue
+            lags.append((time.perf_counter() - decoded_at) * 1e6)
+            if type(message) is message_type:
+                frames += 1
+                samples += len(message.raw_forces) if blocks else 1
+        elapsed = time.perf_counter() - start
+        received = link.bytes_received - start_bytes
+        cpu = link.listener_cpu_time - start_cpu
+        link.ser.write(bytes([toggle]))
+        link.close()
+    return {
+        'frames_per_s': frames / elapsed,
+        'samples_per_s': samples / elapsed,
+        'bytes_per_s': received / elapsed,
+        'cpu_us_per_frame': cpu * 1e6 / max(frames, 1),
+        'queue_lag_p50_us': percentile(lags, 50),
+        'queue_lag_p99_us': percentile(lags, 99),
+        }
+
+# Decoder throughput without a serial port
+def benchmark_decoder(frame_count, chunk_size=4096):
+    stream = b''.join(encode_raw_force_message(i, i & 0x3FF) for i in range(frame_count))
+    decoder = MessageDecoder()
+    decoded = 0
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        decoded += len(decoder.feed(stream[i:i+chunk_size]))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    return {
+        'frames_per_s': decoded / elapsed,
+        'bytes_per_s': len(stream) / elapsed,
+        'cpu_us_per_frame': cpu * 1e6 / decoded,
+        }
+
+def run_benchmarks(args):
+    results = {'decoder': benchmark_decoder(args.decoder_frames)}
+    for baudrate in args.baudrates:
+        key = f"{baudrate} baud"
+        stream = benchmark_stream(baudrate, args.duration)
+        stream_blocks = benchmark_stream(baudrate, args.duration, blocks=True)
+        results[key] = {
+            'latency': benchmark_latency(baudrate, args.iterations),
+            'stream': stream,
+            'stream_blocks': stream_blocks,
+            'block_gain': stream_blocks['samples_per_s'] / max(stream['samples_per_s'], 1e-9),
+            }
+    return results
+
+
+# Flatten nested results to {"section/metric": value}
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "/"))
+        else:
+            flat[name] = value
+    return flat
+
+# Metrics where a higher value is better - everything else is a time
+def higher_is_better(name):
+    return name.endswith('_per_s') or name.endswith('_gain')
+
+# Returns list of (metric, baseline, current) that got worse by more than tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    current = flatten(results)
+    for name, old in flatten(baseline).items():
+        new = current.get(name)
+        if new is None or old is None:
+            continue
+        if higher_is_better(name):
+            worse = new < old * (1.0 - tolerance)
+        else:
+            worse = new > old * (1.0 + tolerance)
+        if worse:
+            regressions.append((name, old, new))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hand serial link against the emulator")
+    parser.add_argument("--baudrates", type=int, nargs='+', default=[9600, 115200], help="Emulated baud rates to test")
+    parser.add_argument("--iterations", type=int, default=200, help="Round trips per command type")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to run the force stream for")
+    parser.add_argument("--decoder-frames", type=int, default=200000, help="Frames for decoder-only benchmark")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Write results to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="Compare results with baseline FILE")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance, help="Allowed relative change before failing")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    for name, value in flatten(results).items():
+        print(f"{name:45s} {value:12.2f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for name, old, new in regressions:
+                print(f"  {name}: {old:.2f} -> {new:.2f}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%}")
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import statistics
+import time
+from multi_hand import MultiHandController
+from hand_emulator import HandFirmware, PtyHandEmulator
+
+"""
+
+Scaling of MultiHandController with the number of hands, run against
+emulated hands on ptys (Linux/macOS)
+
+For each hand count reports:
+    Query round trip for all hands at once (median and max)
+    Broadcast skew - time between the first and last write of a broadcast
+    Force frames/s received in total and the lowest rate of any hand
+    Event loop thread CPU time per frame and loop lag while streaming
+
+Usage:
+    python benchmark_multi_hand.py
+    python benchmark_multi_hand.py --hands 1 8 32 --duration 5
+
+The emulators run as threads in this process, so they share the CPU with
+the controller - the loop CPU time is measured for the event loop thread only.
+
+"""
+
+# Measures how late call_later callbacks run while the loop is busy
+async def measure_loop_lag(stop, interval=0.005):
+    loop = asyncio.get_running_loop()
+    lags = []
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+    return lags
+
+
+async def benchmark(ports, queries, broadcasts, duration):
+    results = {}
+    async with MultiHandController(ports, reply_timeout=5.0) as hands:
+        # Round trip for a query sent to every hand
+        times = []
+        for _ in range(queries):
+            start = time.perf_counter()
+            await hands.query_positions()
+            times.append(time.perf_counter() - start)
+        results['query_all_p50_ms'] = statistics.median(times) * 1e3
+        results['query_all_max_ms'] = max(times) * 1e3
+
+        for i in range(broadcasts):
+            await hands.set_config(i % 4)
+        stats = hands.stats()
+        results['broadcast_skew_p50_us'] = stats['broadcast_skew_p50_us']
+        results['broadcast_skew_max_us'] = stats['broadcast_skew_max_us']
+
+        # Stream from every hand
+        frames = [0] * len(ports)
+        stop = asyncio.Event()
+        lag_task = asyncio.ensure_future(measure_loop_lag(stop))
+        stream = hands.force_stream()
+        # Skip readings sent before the stream was fully running
+        await stream.__anext__()
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        async for hand, reading in stream:
+            frames[hand] += 1
+            if time.perf_counter() - start >= duration:
+                break
+        elapsed = time.perf_counter() - start
+        cpu = time.thread_time() - start_cpu
+        await stream.aclose()
+        stop.set()
+        lags = sorted(await lag_task)
+    total = sum(frames)
+    results['frames_per_s'] = total / elapsed
+    results['min_hand_frames_per_s'] = min(frames) / elapsed
+    results['loop_cpu_us_per_frame'] = cpu / max(total, 1) * 1e6
+    results['loop_cpu_percent'] = cpu / elapsed * 100
+    results['loop_lag_p99_ms'] = lags[int(0.99 * (len(lags) - 1))] * 1e3 if lags else float('nan')
+    return results
+
+
+parser = argparse.ArgumentParser(description="Benchmark the multi-hand controller")
+parser.add_argument("--hands", type=int, nargs='+', default=[1, 8, 32], help="Hand counts to test")
+parser.add_argument("--baudrate", type=int, default=9600)
+parser.add_argument("--queries", type=int, default=20, help="Query rounds per hand count")
+parser.add_argument("--broadcasts", type=int, default=100, help="Broadcast commands per hand count")
+parser.add_argument("--duration", type=float, default=3.0, help="Force streaming time (s)")
+parser.add_argument("--max-rate", action="store_true", help="Stream force readings as fast as the link allows")
+args = parser.parse_args()
+
+rows = []
+for count in args.hands:
+    emulators = [PtyHandEmulator(HandFirmware(debug_only=False), baudrate=args.baudrate,
+                                 stream_interval=0 if args.max_rate else 0.1) for _ in range(count)]
+    for emulator in emulators:
+        emulator.start()
+    try:
+        results = asyncio.run(benchmark([e.port for e in emulators], args.queries, args.broadcasts, args.duration))
+    finally:
+        for emulator in emulators:
+            emulator.close()
+    rows.append((count, results))
+
+names = list(rows[0][1])
+print(f"{'hands':<24}" + "".join(f"{count:>12}" for count, _ in rows))
+for name in names:
+    print(f"{name:<24}" + "".join(f"{results[name]:>12.2f}" for _, results in rows))
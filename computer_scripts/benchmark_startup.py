@@ -0,0 +1,76 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+
+Measures how quickly communication_gui.py opens its window
+
+Each run starts a fresh Python process which imports communication_gui,
+creates the application and draws the first frame. Times are measured from
+process launch (including interpreter start up):
+    import          communication_gui imported
+    first paint     window drawn for the first time
+    graph ready     force graph figure created (matplotlib loaded)
+Requires a display as the application is drawn in a real Tk window
+
+Target: first paint in under 1 second
+
+"""
+
+TARGET_FIRST_PAINT = 1.0
+
+# Marks timing lines among any log output from the application
+_MARKER = "STARTUP "
+
+# Run in the child process - prints a marked line as each point is reached
+_CHILD = """
+import sys, time
+def report(name):
+    print("%s" + name, flush=True)
+import communication_gui
+report('import')
+app = communication_gui.HandControlApplication()
+app.update()
+report('first_paint')
+while not app._fforcegraph.has_figure:
+    app.update()
+    time.sleep(0.001)
+app.update()
+report('graph_ready')
+app.destroy()
+""" % _MARKER
+
+parser = argparse.ArgumentParser(description="Benchmark communication_gui start up time")
+parser.add_argument("--runs", type=int, default=5, help="Number of application launches")
+parser.add_argument("--target", type=float, default=TARGET_FIRST_PAINT, help="First paint time (s) required to pass")
+args = parser.parse_args()
+
+directory = os.path.dirname(os.path.abspath(__file__))
+results = {}
+for run in range(args.runs):
+    start = time.perf_counter()
+    child = subprocess.Popen([sys.executable, "-c", _CHILD], cwd=directory,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+    # Each line is timed as it arrives
+    for line in child.stdout:
+        if not line.startswith(_MARKER):
+            continue
+        name = line[len(_MARKER):].strip()
+        results.setdefault(name, []).append(time.perf_counter() - start)
+    if child.wait() != 0:
+        print(f"Application failed to start (exit code {child.returncode})")
+        sys.exit(1)
+
+for name in ('import', 'first_paint', 'graph_ready'):
+    times = results.get(name, [])
+    if times:
+        print(f"{name:<12} median {statistics.median(times)*1000:7.1f} ms   max {max(times)*1000:7.1f} ms")
+first_paint = statistics.median(results['first_paint'])
+if first_paint > args.target:
+    print(f"FAIL - first paint above target of {args.target} s")
+    sys.exit(1)
+print(f"PASS - target is {args.target} s")
@@ -0,0 +1,155 @@
+from collections import deque
+
+"""
+
+Mapping of hand timestamps to computer time
+
+The hand timestamps force readings with millis() - its own crystal, started
+at boot, so it is offset from the computer clock and runs slightly fast or
+slow (drift, typically tens of ppm). ClockSync estimates
+    host_time = offset + rate * device_time
+online from the arrival time of each reading.
+
+Every reading arrives after some transport delay (serial transmission, USB
+polling, OS buffering, a busy listener thread) which is never negative and
+is close to its minimum for some readings in any second. The estimator takes
+the reading with the smallest (arrival - device time) in each window of
+device time and fits a line under the last [windows] of these minima, so
+delayed readings do not pull the fit. The first fit is available after one
+window - until then the smallest offset seen is used with rate 1.
+
+The fitted line is the arrival time of the fastest readings, which still
+includes their transit time. That minimum cannot be observed from one
+direction of traffic - pass it (e.g. frame length / baud rate) as base_delay
+and it is taken off, so to_host() gives the time a reading was taken.
+update() returns the delay of each reading - arrival time minus to_host(),
+i.e. queueing and transport delay.
+
+Device times are unwrapped millis() values (MessageDecoder(unwrap_timestamps=True))
+and host times seconds from any monotonic clock, e.g. time.perf_counter().
+NumPy is only imported for arrays of readings, so the GUI still starts quickly.
+
+"""
+
+class ClockSync:
+    # window is in seconds of device time
+    # A reading arriving more than reset_after seconds before its fitted time
+    # means the device clock jumped (reset) - the estimate starts again from it
+    def __init__(self, window=1.0, windows=30, base_delay=0.0, reset_after=1.0):
+        self.window = window
+        self.windows = windows
+        self.base_delay = base_delay
+        self.reset_after = reset_after
+        self.resyncs = 0
+        self.reset()
+
+    def reset(self):
+        self._origin = None         # (device s, host s) of the first reading - fit is relative to it
+        self._minima = deque(maxlen=self.windows)   # (x, y) with the smallest y - x per finished window
+        self._window_index = None
+        self._window_min = None     # (x, y) for the current window
+        self._offset = 0.0          # Fit y = offset + rate * x
+        self._rate = 1.0
+        self.readings = 0
+
+    # True once at least one window has been fitted
+    @property
+    def synced(self):
+        return len(self._minima) > 0
+
+    # Device clock rate error in parts per million - positive when the device clock runs fast
+    @property
+    def drift_ppm(self):
+        return (1.0 / self._rate - 1.0) * 1e6
+
+    # Host time of device time zero
+    @property
+    def offset(self):
+        if self._origin is None:
+            return float('nan')
+        x0, y0 = self._origin
+        return y0 + self._offset - self._rate * x0 - self.base_delay
+
+    # Add a reading (device time in ms, arrival host time in s), returns its delay in s
+    def update(self, device_ms, host_time):
+        x, y = self._relative(device_ms / 1000.0, host_time)
+        self._add(x, y)
+        return y - (self._offset + self._rate * x) + self.base_delay
+
+    # Add readings that arrived together (e.g. a RawForceBlock), returns an array of delays
+    def update_array(self, device_ms, host_time):
+        import numpy as np
+        device_ms = np.asarray(device_ms, dtype=np.float64)
+        if not len(device_ms):
+            return device_ms
+        x, y = self._relative(device_ms[0] / 1000.0, host_time)
+        xs = x + (device_ms - device_ms[0]) / 1000.0
+        # Only the newest reading can set a window minimum unless the block spans windows
+        windows = np.floor(xs / self.window)
+        newest = np.flatnonzero(np.concatenate((windows[1:] != windows[:-1], (True,))))
+        for i in newest:
+            self._add(xs[i], y)
+        self.readings += len(xs) - len(newest)
+        return y - (self._offset + self._rate * xs) + self.base_delay
+
+    # Host time for device times in ms (number or array)
+    def to_host(self, device_ms):
+        if self._origin is None:
+            raise ValueError("Clock sync has no readings yet")
+        x0, y0 = self._origin
+        if not isinstance(device_ms, (int, float)):
+            import numpy as np
+            device_ms = np.asarray(device_ms, dtype=np.float64)
+        return y0 + self._offset + self._rate * (device_ms / 1000.0 - x0) - self.base_delay
+
+    def stats(self):
+        return {
+            'synced': self.synced,
+            'readings': self.readings,
+            'resyncs': self.resyncs,
+            'offset_s': self.offset,
+            'drift_ppm': self.drift_ppm,
+            'windows_fitted': len(self._minima),
+            }
+
+    # Device and host time relative to the first reading, keeping float precision
+    def _relative(self, device_s, host_time):
+        if self._origin is None:
+            self._origin = (device_s, host_time)
+        x0, y0 = self._origin
+        x, y = device_s - x0, host_time - y0
+        if self.readings and y - (self._offset + self._rate * x) < -self.reset_after:
+            self.resyncs += 1
+            self.reset()
+            return self._relative(device_s, host_time)
+        return x, y
+
+    def _add(self, x, y):
+        self.readings += 1
+        index = int(x // self.window)
+        if index != self._window_index:
+            if self._window_min is not None:
+                self._minima.append(self._window_min)
+                self._fit()
+            self._window_index = index
+            self._window_min = (x, y)
+        elif y - x < self._window_min[1] - self._window_min[0]:
+            self._window_min = (x, y)
+        if not self._minima:
+            # No finished window yet - smallest offset so far at rate 1
+            self._offset = self._window_min[1] - self._window_min[0]
+
+    # Least squares slope through the window minima, moved down to the lowest of them
+    def _fit(self):
+        if len(self._minima) == 1:
+            x, y = self._minima[0]
+            self._offset, self._rate = y - x, 1.0
+            return
+        count = len(self._minima)
+        x_mean = sum(x for x, _ in self._minima) / count
+        y_mean = sum(y for _, y in self._minima) / count
+        spread = sum((x - x_mean) ** 2 for x, _ in self._minima)
+        if spread <= 0:
+            return
+        self._rate = sum((x - x_mean) * (y - y_mean) for x, y in self._minima) / spread
+        self._offset = min(y - self._rate * x for x, y in self._minima)
@@ -2,63 +2,136 @@
 import tkinter as tk
 from tkinter import ttk
 import tkinter.scrolledtext
+import tkinter.filedialog
+import time
 # pySerial
 import serial, serial.tools.list_ports
 # Threading
-from threading import Thread
+from threading import Thread, Lock
 from queue import Queue
-# Converting struct data
-import struct
-# Graph plotting
-from matplotlib.backends.backend_tkagg import (
-    FigureCanvasTkAgg, NavigationToolbar2Tk)
-from matplotlib.figure import Figure
-# Temporary plot
-import numpy as np
+# Log display
+from log_batching import LogBatcher
+# Performance metrics
+from metrics import MetricsRegistry
+# Hand clock to computer clock mapping
+from clock_sync import ClockSync
+# Log text and graph data for each decoded message
+from message_display import MessageDisplay, message_types
+# Hand serial protocol
+from hand_protocol import (MessageDecoder, CommandBuffer, AllServoLimits, RawForce, RawForceBlock, force_frame_size,
+    QUERY_ALL_POSITIONS, QUERY_ALL_LIMITS, QUERY_FORCE_RAW, TOGGLE_FORCE_STREAM,
+    TOGGLE_FORCE_BLOCK_STREAM)
 
 """
 
 This code was written for Python 3.8
 The pySerial module is used to communicate through serial
 tkinter is used to create the gui
-Serial data from the connected device is treated as text
+Serial data from the connected device is decoded by hand_protocol.MessageDecoder
+matplotlib and NumPy are only imported when the force graph is first shown
+or force recording is used, so the window opens quickly
 
 """
 
-servo_count = 5
-
 # Custom class to allow a data graph to be displayed
 class GraphDisplayFrame(tk.Frame):
-    def __init__(self, title, master, **kwargs):
+    def __init__(self, title, master, window=20.0, metrics=None, **kwargs):
         # "title" will display in label on first row of frame
-        # Graph will display on second row of frame
+        # Graph will display on second row of frame, with zoom/pan toolbar on third row
+        # Draw times are recorded in metrics if given
         super().__init__(master, **kwargs)
-        ttk.Label(self, text=title).grid(row=0, column=0, sticky='nsew')
+        ttk.Label(self, text=title).grid(row=0, column=0, sticky='nsw')
+        # Follow newest data, or show range chosen with the toolbar
+        self._follow = tk.IntVar(self, 1)
+        ttk.Checkbutton(self, text="Follow newest data", variable=self._follow, command=self.mark_dirty).grid(row=0, column=0, sticky='nse')
 
-        # Maximum length of data storage lists
-        self._max_data_elements = 200
-        # Data storage lists
-        self._data_x = []
-        self._data_y = []
+        # Full data history - min/max pyramid keeps hours of data in fixed memory
+        # Created with the figure
+        self._history = None
+        # Width of visible x range while following newest data
+        self.window = window
+        # Points added by the listener thread since the last display update
+        self._pending_x = []
+        self._pending_y = []
+        self._data_lock = Lock()
         # Flag for checking whether or not display needs to be updated
         self._dirty_data = False
+        # History to be cleared on the next display update
+        self._clear_history = False
+        # Draw statistics
+        self._metrics = metrics if metrics is not None else MetricsRegistry(enabled=False)
+        self._draw_time = self._metrics.histogram("graph_draw")
+        self._full_draws = self._metrics.counter("graph_full_draws")
+        self._blits = self._metrics.counter("graph_blits")
+
+        # Figure is created once the frame is shown or data is displayed
+        # Placeholder keeps the frame size until then
+        self._fig = None
+        self._placeholder = ttk.Label(self, text="Loading graph...", width=50, anchor='center')
+        self._placeholder.grid(row=1, column=0, sticky='nsew', ipady=120)
+        self.bind('<Map>', self._on_map)
+
+    @property
+    def has_figure(self):
+        return self._fig is not None
 
-        # Create figure + axis, get canvas and add to frame
+    # Create figure + axis, get canvas and add to frame
+    # Plotting modules are imported here rather than at startup
+    def _create_figure(self):
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        from matplotlib.figure import Figure
+        from minmax_pyramid import MinMaxPyramid
+        self._history = MinMaxPyramid()
+        self._placeholder.destroy()
         self._fig = Figure(figsize=(4,3), dpi=100)
         self._ax = self._fig.add_subplot(111)
-        self._ax.plot(self._data_x, self._data_y)
+        # Line is reused for every update - animated so it is left out of the cached background
+        self._line, = self._ax.plot([], [], animated=True)
         self._canvas = FigureCanvasTkAgg(self._fig, master=self)
         self._canvas.get_tk_widget().grid(row=1, column=0, sticky='nsew')
+        self._toolbar = NavigationToolbar2Tk(self._canvas, self, pack_toolbar=False)
+        self._toolbar.grid(row=2, column=0, sticky='nsew')
+        # Background (axes, ticks, labels) is cached after every full draw and used for blitting
+        self._background = None
+        self._canvas.mpl_connect('draw_event', self._on_draw)
+        # Zooming or panning stops following and requests data for the new range
+        self._setting_limits = False
+        self._ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
 
-    # Add a data point to the data display lists
+    # Frame shown - create the figure once the window has been drawn
+    def _on_map(self, event):
+        if self._fig is None:
+            self.after_idle(self.mark_dirty)
+
+    # Add a data point to the data display buffer
     def append_data(self, x, y):
+        with self._data_lock:
+            self._pending_x.append(x)
+            self._pending_y.append(y)
+            self._dirty_data = True
+
+    # Add several data points (lists or NumPy arrays) to the data display buffer
+    def extend_data(self, xs, ys):
+        if hasattr(xs, 'tolist'):
+            xs = xs.tolist()
+            ys = ys.tolist()
+        with self._data_lock:
+            self._pending_x.extend(xs)
+            self._pending_y.extend(ys)
+            self._dirty_data = True
+
+    # Remove all data, e.g. when a new connection or replay starts
+    # May be called from any thread - the history is cleared on the next display update
+    def clear(self):
+        with self._data_lock:
+            self._pending_x = []
+            self._pending_y = []
+            self._clear_history = True
+            self._dirty_data = True
+
+    # Request display update on next call to update_display
+    def mark_dirty(self):
         self._dirty_data = True
-        self._data_x.append(x)
-        self._data_y.append(y)
-        # Crop list if too long
-        if len(self._data_x) > self._max_data_elements:
-            self._data_x = self._data_x[-self._max_data_elements:]
-            self._data_y = self._data_y[-self._max_data_elements:]
 
     # Update display
     # Note - this must be called in the main thread
@@ -66,29 +139,139 @@ class GraphDisplayFrame(tk.Frame):
         # Early return if no changes to display
         if not self._dirty_data:
             return
+        start = self._metrics.start_timer()
+        if self._fig is None:
+            self._create_figure()
+        with self._data_lock:
+            pending_x, self._pending_x = self._pending_x, []
+            pending_y, self._pending_y = self._pending_y, []
+            cleared, self._clear_history = self._clear_history, False
+            self._dirty_data = False
+        if cleared:
+            self._history.clear()
+            self._line.set_data([], [])
+            # Start the y axis again so it fits the new data
+            self._ax.set_ylim(0.0, 1.0)
+            self._background = None
+        self._history.extend(pending_x, pending_y)
         # Early return if too few data points
-        if len(self._data_x) < 2:
+        if len(self._history) < 2:
+            if cleared:
+                self._canvas.draw()
+                self._full_draws.inc()
             return
-        # Clear graph, plot new graph, update canvas
-        self._ax.clear()
-        self._ax.plot(self._data_x, self._data_y)
-        self._canvas.draw()
-        self._dirty_data = False
+        rescaled = False
+        if self._follow.get():
+            rescaled = self._follow_newest()
+        # About one min/max pair per horizontal pixel
+        x_low, x_high = self._ax.get_xlim()
+        x, y = self._history.query(x_low, x_high, 2 * max(int(self._ax.bbox.width), 100))
+        self._line.set_data(x, y)
+        if self._follow.get() and len(y):
+            rescaled = self._rescale_y(y) or rescaled
+        if rescaled or self._background is None:
+            # Full redraw - draw event will cache the new background and draw the line
+            self._canvas.draw()
+            self._full_draws.inc()
+        else:
+            # Only redraw the line over the cached background
+            self._canvas.restore_region(self._background)
+            self._ax.draw_artist(self._line)
+            self._canvas.blit(self._ax.bbox)
+            self._blits.inc()
+        self._draw_time.observe_since(start)
+
+    # Move x axis to show the newest data
+    # Space is left to the right so new data does not need a rescale straight away
+    # Returns True if the limits were changed
+    def _follow_newest(self):
+        newest = self._history.x_range()[1]
+        x_low, x_high = self._ax.get_xlim()
+        if newest <= x_high and abs((x_high - x_low) - 1.25*self.window) < 1e-9*self.window:
+            return False
+        self._setting_limits = True
+        self._ax.set_xlim(newest - self.window, newest + 0.25*self.window)
+        self._setting_limits = False
+        return True
+
+    # Expand y axis limits if the data has gone outside them
+    # Returns True if the limits were changed
+    def _rescale_y(self, y):
+        y_min, y_max = y.min(), y.max()
+        y_low, y_high = self._ax.get_ylim()
+        if y_max > y_high or y_min < y_low:
+            margin = max(0.1*(y_max - y_min), 1.0)
+            self._ax.set_ylim(y_min - margin, y_max + margin)
+            return True
+        return False
+
+    # X axis limits changed by the toolbar - stop following newest data
+    def _on_xlim_changed(self, ax):
+        if not self._setting_limits:
+            self._follow.set(0)
+        self._dirty_data = True
+
+    # Full canvas draw completed - cache background and draw line on top
+    def _on_draw(self, event):
+        self._background = self._canvas.copy_from_bbox(self._fig.bbox)
+        self._ax.draw_artist(self._line)
 
 class HandControlApplication(tk.Tk):
     def __init__(self):
         super().__init__()
         self.protocol("WM_DELETE_WINDOW", self.on_close)    # Set closing operation to custom method
 
+        # Link rate of the hand firmware - ports are always opened at this rate
+        # (self.ser may be a capture replay with the rate of the capture)
+        self.baudrate = 9600
         # Use a single serial instance instead of using context manager
         self.ser = serial.Serial()
-        self.ser.baudrate = 9600
+        self.ser.baudrate = self.baudrate
         self.ser.timeout = 1
         self.com_port_is_available = False  # Used for connect button
         # Listener thread management
         self.port_listener_thread = None    # Thread object
         self.port_listener_flag = False     # 
         self.log_queue = Queue()            # 
+        # Log display settings
+        self.log_max_lines = 5000           # Oldest lines are removed beyond this
+        self.echo_log_to_console = True     # Also print log messages
+        self.show_command_bytes = False     # Log every byte sent - plain flag as it is read by the grasp controller thread
+        self._log_batcher = LogBatcher()
+        # Outgoing commands - written by process_commands
+        self._command_buffer = CommandBuffer()
+        # Decoder keeps partial messages between reads
+        # Force timestamps are unwrapped so they keep increasing past the millis() wrap
+        self._decoder = MessageDecoder(unwrap_timestamps=True)
+        # Fits the hand clock to reading arrival times, less the transmission time of each frame
+        # at the rate of the connected link (set in connect - a capture has its own rate)
+        self._clock_sync = ClockSync()
+        self._byte_time = 10.0 / self.baudrate
+        self._timestamp_resets = 0
+        # Force readings are written to this while recording
+        self._force_recorder = None
+        # Force readings are published to other processes through this while sharing
+        self._force_publisher = None
+        # Bytes read and written are recorded to this while capturing
+        self._traffic_capture = None
+        # Closed loop grasp controller (None when off) and the last servo limits received
+        self._grasp_controller = None
+        self._servo_limits = None
+        # Grasp force target waiting for the servo limits reply before starting (None when not waiting)
+        self._grasp_target = None
+        self._grasp_lock = Lock()
+        # Commands are written from the main loop and the grasp controller thread
+        self._write_lock = Lock()
+        # Decoded messages are logged and graphed by self._display (message_display.py,
+        # created with the force graph) - these handlers do the rest
+        self._message_handlers = {
+            AllServoLimits: self.receive_all_servo_limits,
+            RawForce: self.receive_raw_force,
+            RawForceBlock: self.receive_raw_force_block,
+            }
+        # Link and display statistics - shown in the statistics frame
+        self.metrics = MetricsRegistry()
+        self._create_metrics()
 
         # Start the log process loop
         # Note : Text insertion must be performed inside main loop
@@ -104,6 +287,13 @@ class HandControlApplication(tk.Tk):
             "Alternating",
             "Invalid"
             ]
+        self.force_filter_names = [
+            "None",
+            "Moving average (8 readings)",
+            "Median (5 readings)",
+            "Low-pass (0.1 x sample rate)",
+            "Median + low-pass",
+            ]
 
         # Create UI
         self.create_widgets()
@@ -112,6 +302,13 @@ class HandControlApplication(tk.Tk):
         # Note : canvas.draw() call must be performed inside main loop
         #    update_graph_display will call itself on repeat
         self.update_graph_display()
+
+        # Start command sending process loop
+        self.process_commands()
+
+        # Start statistics display loop
+        self._last_snapshot = None
+        self.update_stats_display()
         
         self.title("Hand Controller")
 
@@ -119,6 +316,9 @@ class HandControlApplication(tk.Tk):
     def on_close(self):
         self.log("Stopping...")
         self.close_serial()
+        self.stop_force_recording()
+        self.stop_force_sharing()
+        self.stop_traffic_capture()
         self.destroy()
 
     # Create UI widgets
@@ -182,19 +382,72 @@ class HandControlApplication(tk.Tk):
         self._cbautoscroll = ttk.Checkbutton(self._foutput, text="Auto-scroll", variable=self._autoscroll)
         self._cbautoscroll.grid(row=0, column=1, sticky='nse')
         self._showcommandbytes = tk.IntVar(self, 0)
-        self._cbshowcommandbytes = ttk.Checkbutton(self._foutput, text="Display sent command bytes", variable=self._showcommandbytes)
+        self._cbshowcommandbytes = ttk.Checkbutton(self._foutput, text="Display sent command bytes", variable=self._showcommandbytes, command=self.toggle_show_command_bytes)
         self._cbshowcommandbytes.grid(row=2, column=0, sticky='nsew')
         self._displayforcereadings = tk.IntVar(self, 0)
-        self._cbdisplayforcereadings = ttk.Checkbutton(self._foutput, text="Display force readings", variable=self._displayforcereadings)
+        self._cbdisplayforcereadings = ttk.Checkbutton(self._foutput, text="Display force readings", variable=self._displayforcereadings, command=self.toggle_display_force_readings)
         self._cbdisplayforcereadings.grid(row=3, column=0, sticky='nsew')
+        self._echolog = tk.IntVar(self, int(self.echo_log_to_console))
+        self._cbecholog = ttk.Checkbutton(self._foutput, text="Echo log to console", variable=self._echolog, command=self.toggle_console_echo)
+        self._cbecholog.grid(row=4, column=0, sticky='nsew')
+        self._capturetraffic = tk.IntVar(self, 0)
+        self._cbcapturetraffic = ttk.Checkbutton(self._foutput, text="Capture serial traffic", variable=self._capturetraffic, command=self.toggle_traffic_capture)
+        self._cbcapturetraffic.grid(row=5, column=0, sticky='nsew')
 
         self._stoutput.insert(tk.END, "Connect to a device to start.\n")
 
         # Force readings
-        self._fforcegraph = GraphDisplayFrame("Force Display", self, relief='groove', bd=1)
+        self._fforcegraph = GraphDisplayFrame("Force Display", self, metrics=self.metrics, relief='groove', bd=1)
         self._fforcegraph.grid(row=0, column=4, rowspan=2, sticky='nsew')
+        self._display = MessageDisplay(self.log, self._fforcegraph)
         self._btoggleforce = ttk.Button(self._fforcegraph, text="Toggle Force Data Stream", command=self.toggle_force_data_stream)
-        self._btoggleforce.grid(row=2, column=0, sticky='nsew')
+        self._btoggleforce.grid(row=3, column=0, sticky='nsew')
+        self._btoggleforceblock = ttk.Button(self._fforcegraph, text="Toggle Force Block Stream", command=self.toggle_force_block_stream)
+        self._btoggleforceblock.grid(row=4, column=0, sticky='nsew')
+        self._recordforce = tk.IntVar(self, 0)
+        self._cbrecordforce = ttk.Checkbutton(self._fforcegraph, text="Record force readings", variable=self._recordforce, command=self.toggle_force_recording)
+        self._cbrecordforce.grid(row=5, column=0, sticky='nsew')
+        self._breplayforce = ttk.Button(self._fforcegraph, text="Replay Recording", command=self.replay_force_recording)
+        self._breplayforce.grid(row=6, column=0, sticky='nsew')
+        self._replaymaxspeed = tk.IntVar(self, 0)
+        self._cbreplaymaxspeed = ttk.Checkbutton(self._fforcegraph, text="Replay at maximum speed", variable=self._replaymaxspeed)
+        self._cbreplaymaxspeed.grid(row=7, column=0, sticky='nsew')
+        self._shareforce = tk.IntVar(self, 0)
+        self._cbshareforce = ttk.Checkbutton(self._fforcegraph, text="Share force readings with other processes", variable=self._shareforce, command=self.toggle_force_sharing)
+        self._cbshareforce.grid(row=8, column=0, sticky='nsew')
+        self._fforcefilter = tk.Frame(self._fforcegraph)
+        self._fforcefilter.grid(row=9, column=0, sticky='nsew')
+        ttk.Label(self._fforcefilter, text="Display filter").grid(row=0, column=0, sticky='nsw')
+        self._selected_filter = tk.StringVar(self, self.force_filter_names[0])
+        self._cbforcefilter = ttk.Combobox(self._fforcefilter, textvariable=self._selected_filter, values=self.force_filter_names, state='readonly')
+        self._cbforcefilter.grid(row=0, column=1, columnspan=2, sticky='nsew')
+        self._cbforcefilter.bind('<<ComboboxSelected>>', self.select_force_filter)
+        self._detectcontact = tk.IntVar(self, 0)
+        self._cbdetectcontact = ttk.Checkbutton(self._fforcefilter, text="Detect contact above", variable=self._detectcontact, command=self.toggle_contact_detection)
+        self._cbdetectcontact.grid(row=1, column=0, columnspan=2, sticky='nsw')
+        self._sbcontactthreshold = ttk.Spinbox(self._fforcefilter, from_=0, to=65535, width=7)
+        self._sbcontactthreshold.set(500)
+        self._sbcontactthreshold.grid(row=1, column=2, sticky='nsew')
+        self._graspcontrol = tk.IntVar(self, 0)
+        self._cbgraspcontrol = ttk.Checkbutton(self._fforcefilter, text="Grasp and hold force at", variable=self._graspcontrol, command=self.toggle_grasp_control)
+        self._cbgraspcontrol.grid(row=2, column=0, columnspan=2, sticky='nsw')
+        self._sbgraspforce = ttk.Spinbox(self._fforcefilter, from_=0, to=65535, width=7)
+        self._sbgraspforce.set(400)
+        self._sbgraspforce.grid(row=2, column=2, sticky='nsew')
+
+        # Link statistics
+        self._fstats = tk.Frame(self, relief='groove', bd=1)
+        self._fstats.grid(row=2, column=0, columnspan=5, sticky='nsew')
+        ttk.Label(self._fstats, text="Link Statistics").grid(row=0, column=0, sticky='nsw')
+        self._metricsenabled = tk.IntVar(self, int(self.metrics.enabled))
+        self._cbmetricsenabled = ttk.Checkbutton(self._fstats, text="Collect statistics", variable=self._metricsenabled, command=self.toggle_metrics)
+        self._cbmetricsenabled.grid(row=0, column=1, sticky='nsew')
+        self._bresetmetrics = ttk.Button(self._fstats, text="Reset", command=self.reset_metrics)
+        self._bresetmetrics.grid(row=0, column=2, sticky='nsew')
+        self._bdumpmetrics = ttk.Button(self._fstats, text="Save...", command=self.dump_metrics)
+        self._bdumpmetrics.grid(row=0, column=3, sticky='nsew')
+        self._statstext = tk.StringVar(self, "")
+        ttk.Label(self._fstats, textvariable=self._statstext, font='TkFixedFont', justify='left').grid(row=1, column=0, columnspan=4, sticky='nsw')
 
     # Get list of available ports
     def get_available_ports(self):
@@ -215,20 +468,36 @@ class HandControlApplication(tk.Tk):
     def connect(self):
         # Disconnect serial port if already connected
         self.close_serial()
-        if not self.com_port_is_available:
-            self.log("No port to connect to")
-            return
         # Obtain selected port
+        # Ports not found by the port search (e.g. an emulator pty) can be typed in
         port = self._selected_port.get()
-        self.ser.port = port
+        if not self.com_port_is_available and port == "No device detected":
+            self.log("No port to connect to")
+            return
         self.log(f"Connecting to {port}")
         # Connect to port and start listener thread
+        # Urls are accepted too, e.g. socket://localhost:8766 to share a hand through hand_broker.py
+        # A traffic capture file (.htc) is played back as if it were the hand
         try:
+            if port.endswith(".htc"):
+                from traffic_capture import CaptureReplaySerial
+                speed = None if self._replaymaxspeed.get() else 1.0
+                self.ser = CaptureReplaySerial(port, speed, timeout=self.ser.timeout)
+                link_baudrate = self.ser.baudrate
+            else:
+                self.ser = serial.serial_for_url(port, baudrate=self.baudrate, timeout=self.ser.timeout, do_not_open=True)
+                link_baudrate = self.baudrate
             self.ser.open()
+            self._byte_time = 10.0 / link_baudrate
+            self._decoder.reset()
+            self._clock_sync.reset()
+            self._timestamp_resets = 0
+            self._servo_limits = None
+            self._fforcegraph.clear()
             self.port_listener_flag = True
             self.port_listener_thread = Thread(target=self.listen_to_port)
             self.port_listener_thread.start()
-        except serial.serialutil.SerialException:
+        except (serial.serialutil.SerialException, ValueError, OSError):
             self.log(f"Failed to connect to port {port}")
 
     # Sends individual servo command (servo 0-5, value 0-255)
@@ -238,10 +507,9 @@ class HandControlApplication(tk.Tk):
         selected_servo = self.servo_names.index(servo_name)
         servo_value = int(self._sbservovalue.get())
         servo_value = min(max(0, servo_value), 180)     # Limit to 1 byte size
-        # Send single servo command
-        servo_command = 0b00000000 | selected_servo     # Line unnecessary, but kept in case command format changes
-        self.send_command(servo_command)                # Send servo to move
-        self.send_command(servo_value)                  # Send value
+        # Queue single servo command - replaces any unsent command for the same servo
+        if self.check_port_open():
+            self._command_buffer.set_servo(selected_servo, servo_value)
 
     # Sends configuration byte command (0-127)
     def set_config(self):
@@ -249,42 +517,264 @@ class HandControlApplication(tk.Tk):
         config_name = self._selected_config.get()
         selected_config = self.servo_configs.index(config_name)
         selected_config = min(max(0, selected_config), 127)     # Ensure config is value (0-127)
-        # Create and send command
-        config_command = 0b10000000 | selected_config           # First bit is 1, remaining are config
-        self.send_command(config_command)
+        # Queue command - replaces any unsent servo or configuration commands
+        if self.check_port_open():
+            self._command_buffer.set_config(selected_config)
 
     # Sends position query byte command
     def query_positions(self):
-        command = 0b00001000
-        self.send_command(command)
+        self.send_command(QUERY_ALL_POSITIONS)
 
     # Sends limit query byte command
     def query_limits(self):
-        command = 0b00001001
-        self.send_command(command)
+        self.send_command(QUERY_ALL_LIMITS)
 
     # Sends force reading query byte command
     def query_force(self):
-        command = 0b00001010
-        self.send_command(command)
+        self.send_command(QUERY_FORCE_RAW)
 
     # Sends command to enable/disable stream of force readings
     def toggle_force_data_stream(self):
-        command = 0b00001011
-        self.send_command(command)
+        self.send_command(TOGGLE_FORCE_STREAM)
+
+    # Sends command to enable/disable stream of force reading blocks
+    def toggle_force_block_stream(self):
+        self.send_command(TOGGLE_FORCE_BLOCK_STREAM)
+
+    # Start or stop recording force readings to file
+    def toggle_force_recording(self):
+        if self._recordforce.get():
+            from force_recorder import ForceRecorder
+            path = time.strftime("force_%Y%m%d_%H%M%S.hfr")
+            self._force_recorder = ForceRecorder(path)
+            self.log(f"Recording force readings to {path}")
+        else:
+            self.stop_force_recording()
+
+    # Stop recording and close the recording file
+    def stop_force_recording(self):
+        recorder = self._force_recorder
+        if recorder is None:
+            return
+        self._force_recorder = None
+        recorder.close()
+        self.log(f"Recorded {recorder.samples_written} force readings to {recorder.path}")
+
+    # Start or stop recording all bytes read from and written to the serial port
+    # Open the capture file as the port to play it back, or use replay_regression.py
+    def toggle_traffic_capture(self):
+        if self._capturetraffic.get():
+            from traffic_capture import TrafficCapture
+            path = time.strftime("traffic_%Y%m%d_%H%M%S.htc")
+            self._traffic_capture = TrafficCapture(path, self.baudrate)
+            self.log(f"Capturing serial traffic to {path}")
+        else:
+            self.stop_traffic_capture()
+
+    # Stop capturing and close the capture file
+    def stop_traffic_capture(self):
+        capture = self._traffic_capture
+        if capture is None:
+            return
+        self._traffic_capture = None
+        capture.close()
+        bytes_in, bytes_out = capture.bytes_captured
+        self.log(f"Captured {bytes_in} bytes in and {bytes_out} bytes out to {capture.path}")
+
+    # Start or stop publishing force readings in shared memory
+    # Other processes read them with shared_force_ring.SharedForceReader
+    def toggle_force_sharing(self):
+        if self._shareforce.get():
+            from shared_force_ring import SharedForceWriter, default_name
+            try:
+                self._force_publisher = SharedForceWriter(default_name)
+            except FileExistsError:
+                self.log(f"Shared memory '{default_name}' is already in use")
+                self._shareforce.set(0)
+                return
+            self.log(f"Sharing force readings as '{default_name}'")
+        else:
+            self.stop_force_sharing()
+
+    # Stop publishing and remove the shared memory
+    def stop_force_sharing(self):
+        publisher = self._force_publisher
+        if publisher is None:
+            return
+        self._force_publisher = None
+        publisher.close()
+        self.log(f"Stopped sharing force readings ({publisher.records_written} published)")
+
+    # Display filter selection changed - the new filter starts with no history
+    def select_force_filter(self, event=None):
+        from force_filters import MovingAverage, MedianFilter, FilterChain, lowpass
+        index = self.force_filter_names.index(self._selected_filter.get())
+        self._display.force_filter = [
+            lambda: None,
+            lambda: MovingAverage(8),
+            lambda: MedianFilter(5),
+            lambda: lowpass(0.1, 1.0),
+            lambda: FilterChain(MedianFilter(5), lowpass(0.1, 1.0)),
+            ][index]()
+
+    # Start or stop contact detection on the (filtered) force readings
+    # Contact ends when the force falls below 80% of the threshold
+    def toggle_contact_detection(self):
+        if self._detectcontact.get():
+            from force_filters import ContactDetector
+            try:
+                threshold = float(self._sbcontactthreshold.get())
+            except ValueError:
+                self.log("Contact threshold must be a number")
+                self._detectcontact.set(0)
+                return
+            self._display.contact_detector = ContactDetector(threshold, 0.8 * threshold)
+        else:
+            self._display.contact_detector = None
+
+    # Checkbox changed - copied to the display, as Tk variables must not be read from the listener thread
+    def toggle_display_force_readings(self):
+        self._display.display_force_readings = bool(self._displayforcereadings.get())
+
+    # Start or stop closing fingers 0-3 to hold the force at the target (grasp_controller.py)
+    # Needs the force stream running - setpoints are kept within the last queried servo limits
+    def toggle_grasp_control(self):
+        if self._graspcontrol.get():
+            try:
+                target = float(self._sbgraspforce.get())
+            except ValueError:
+                self.log("Grasp force must be a number")
+                self._graspcontrol.set(0)
+                return
+            if not self.check_port_open():
+                self._graspcontrol.set(0)
+                return
+            limits = self._servo_limits
+            if limits is None:
+                # Started by receive_all_servo_limits once the reply arrives
+                with self._grasp_lock:
+                    self._grasp_target = target
+                self.query_limits()
+                self.log("Grasp control waiting for servo limits")
+            else:
+                self.start_grasp_control(limits, target)
+        else:
+            self.stop_grasp_control()
+
+    # Start the control thread - may be called from the listener thread
+    # Without a target, starts with the one waiting for the limits - unless it was cancelled
+    def start_grasp_control(self, limits, target=None):
+        from grasp_controller import GraspController, PIDPolicy
+        with self._grasp_lock:
+            if target is None:
+                target = self._grasp_target
+                if target is None:
+                    return
+            self._grasp_target = None
+            self._grasp_controller = GraspController(self.write_command_bytes, PIDPolicy(target), limits=limits)
+            self._grasp_controller.start()
+        self.log(f"Grasp control started - holding force at {target:.0f}")
 
-    # Sends byte command to connected device
+    # Stop the control thread (or stop waiting to start it) and log its timing statistics
+    def stop_grasp_control(self):
+        with self._grasp_lock:
+            controller = self._grasp_controller
+            waiting = self._grasp_target is not None
+            self._grasp_controller = None
+            self._grasp_target = None
+        if controller is None:
+            if waiting:
+                self._graspcontrol.set(0)
+                self.log("Grasp control cancelled")
+            return
+        controller.stop()
+        self._graspcontrol.set(0)
+        stats = controller.stats()
+        self.log(f"Grasp control stopped : {stats['ticks']} ticks at {stats['rate_hz']:.0f} Hz, "
+                 f"{stats['missed_deadlines']} missed deadlines, {stats['stale_ticks']} without a new reading, "
+                 f"jitter p99 {stats['jitter_p99_us']:.0f} us, "
+                 f"reading to command p50 {stats['latency_p50_us']:.0f} us p99 {stats['latency_p99_us']:.0f} us")
+
+    # Play a recording back through the decoder and force graph
+    def replay_force_recording(self):
+        path = tkinter.filedialog.askopenfilename(filetypes=[("Force recordings", "*.hfr"), ("All files", "*")])
+        if not path:
+            return
+        speed = None if self._replaymaxspeed.get() else 1.0
+        Thread(target=self.replay_thread, args=(path, speed), daemon=True).start()
+
+    # Replay thread function
+    def replay_thread(self, path, speed):
+        from force_recorder import replay_frames
+        self.log(f"Replaying {path}")
+        self._fforcegraph.clear()
+        decoder = MessageDecoder(unwrap_timestamps=True)
+        resets = 0
+        try:
+            for chunk in replay_frames(path, speed):
+                for message in decoder.feed(chunk):
+                    # Recording spans a hand reset - graph starts again from it
+                    if decoder.unwrapper.resets != resets:
+                        resets = decoder.unwrapper.resets
+                        self._fforcegraph.clear()
+                    self.handle_message(message)
+        except (OSError, ValueError) as e:
+            self.log(f"Failed to replay {path} : {e}")
+            return
+        self.log(f"Finished replaying {path}")
+
+    # Queues byte command for connected device
     def send_command(self, command):
+        if self.check_port_open():
+            self._command_buffer.add([command])
+            self._commands_queued.inc()
+
+    # Returns True if commands can be sent
+    def check_port_open(self):
         if self.ser.is_open:
+            return True
+        self.log("Cannot send byte - port closed")
+        return False
+
+    # Sends queued commands on repeat
+    # Commands wait in the buffer while earlier bytes are still being transmitted,
+    # so repeated commands for the same servo are coalesced instead of backing up the link
+    def process_commands(self):
+        if len(self._command_buffer) and self.ser.is_open:
             try:
-                # Log command in format 0bxxxxxxxx
-                if self._showcommandbytes.get():
-                    self.log(f"Sending byte {command:08b}")
-                self.ser.write(bytearray([command]))
+                # Network ports have no transmit buffer count
+                if getattr(self.ser, 'out_waiting', 0) == 0:
+                    self._command_buffer.flush(self.write_command_bytes)
             except serial.serialutil.SerialException:
                 self.log("Failed to send byte")
-        else:
-            self.log("Cannot send byte - port closed")
+        # Call again after 20ms
+        self.after(20, self.process_commands)
+
+    # Checkbox changed - copied to a plain attribute, as Tk variables must not be read from other threads
+    def toggle_show_command_bytes(self):
+        self.show_command_bytes = bool(self._showcommandbytes.get())
+
+    # Writes command bytes to connected device in a single write
+    # Also called from the grasp controller thread
+    def write_command_bytes(self, data):
+        # Log commands in format 0bxxxxxxxx
+        if self.show_command_bytes:
+            for byte in data:
+                self.log(f"Sending byte {byte:08b}")
+        start = self.metrics.start_timer()
+        with self._write_lock:
+            self.ser.write(data)
+            capture = self._traffic_capture
+            if capture is not None:
+                capture.record_out(data)
+        self._write_time.observe_since(start)
+        self._bytes_out.inc(len(data))
+
+    # Logs how many commands were sent and coalesced
+    def log_command_stats(self):
+        stats = self._command_buffer.stats()
+        self.log(f"Sent {stats['commands_sent']} commands ({stats['bytes_sent']} bytes) in {stats['writes']} writes, "
+                 f"coalesced {stats['commands_coalesced']} commands ({stats['bytes_coalesced']} bytes)")
 
     # Serial port listener thread function
     def listen_to_port(self):
@@ -292,9 +782,22 @@ class HandControlApplication(tk.Tk):
         # End when flag is set to false or exception raised
         while self.port_listener_flag:
             try:
-                msg = self.ser.read()
-                if msg != b'':
-                    self.handle_message(msg[0])
+                # Read everything already waiting, or block (up to timeout) for one byte
+                start = self.metrics.start_timer()
+                data = self.ser.read(self.ser.in_waiting or 1)
+                arrival = time.perf_counter()
+                self._read_time.observe_since(start)
+                if data:
+                    self._bytes_in.inc(len(data))
+                    capture = self._traffic_capture
+                    if capture is not None:
+                        capture.record_in(data, arrival)
+                    start = self.metrics.start_timer()
+                    for message in self._decoder.feed(data):
+                        self.sync_clock(message, arrival)
+                        self.handle_message(message)
+                    self._decode_time.observe_since(start)
+                    self._dropped_bytes.set(self._decoder.dropped_bytes)
             except (serial.serialutil.SerialException, TypeError, AttributeError) as e:
                 self.log("Error raised in listener thread - is the hand connected?")
                 raise e
@@ -304,34 +807,134 @@ class HandControlApplication(tk.Tk):
                 break
         self.log("Serial port listener stopped")
 
+    # Fit the hand clock to force reading arrival times and record each reading's delay
+    # (reading taken to bytes read, in ns) - replayed readings are not passed here
+    def sync_clock(self, message, arrival):
+        message_type = type(message)
+        if message_type is not RawForce and message_type is not RawForceBlock:
+            return
+        # Hand was reset - its clock restarted, so the graph starts again too
+        resets = self._decoder.unwrapper.resets
+        if resets != self._timestamp_resets:
+            self._timestamp_resets = resets
+            self._clock_sync.reset()
+            self._fforcegraph.clear()
+        # Frames of different lengths (a RawForce or a block of any size) take different times
+        # to arrive, so each is fitted by when it started arriving and the time is added back
+        frame_time = force_frame_size(message) * self._byte_time
+        sent = arrival - frame_time
+        if message_type is RawForce:
+            delay = self._clock_sync.update(message.timestamp, sent) + frame_time
+            self._force_delay.observe(max(delay, 0.0) * 1e9)
+        else:
+            for delay in (self._clock_sync.update_array(message.timestamps, sent) + frame_time).tolist():
+                self._force_delay.observe(max(delay, 0.0) * 1e9)
+        self._clock_drift.set(round(self._clock_sync.drift_ppm, 1))
+
     # Closes serial port and stops listener thread
     def close_serial(self):
+        self.stop_grasp_control()
         self.port_listener_flag = False
         if self.port_listener_thread is not None:
             self.port_listener_thread.join()
             self.port_listener_thread = None
         if self.ser.is_open:
             self.ser.close()
+            self.log_command_stats()
 
     # Call log(text) to log any important information to gui
-    # Text is printed to console and displayed in gui
-    def log(self, text):
-        self.log_queue.put(text)
-        print(text)
+    # Text is displayed in gui and printed to console if echo is enabled
+    # High rate messages should pass a key (e.g. "force") so they can be rate limited
+    def log(self, text, key=None):
+        self.log_queue.put((text, key))
+        if self.echo_log_to_console:
+            print(text)
 
     # Handles gui console
     def process_log(self):
-        # Display all messages in queue
-        while not self.log_queue.empty():
-            text = self.log_queue.get()
-            self._stoutput.insert(tk.END, '\n')
-            self._stoutput.insert(tk.END, text)
+        start = self.metrics.start_timer()
+        queued = self.log_queue.qsize()
+        self._log_queue_depth.set(queued)
+        # Collect all messages in queue into one batch
+        for _ in range(queued):
+            text, key = self.log_queue.get_nowait()
+            self._log_batcher.add(text, key)
+        lines = self._log_batcher.drain()
+        if lines:
+            self._stoutput.insert(tk.END, '\n' + '\n'.join(lines))
+            # Remove oldest lines beyond the scrollback limit
+            line_count = int(self._stoutput.index('end-1c').split('.')[0])
+            if line_count > self.log_max_lines:
+                self._stoutput.delete('1.0', f"{line_count - self.log_max_lines + 1}.0")
             # Move scrollbar to bottom
             if self._autoscroll.get():
                 self._stoutput.see(tk.END)
+            self._log_lines.inc(len(lines))
+        self._log_time.observe_since(start)
         # Call again after 50ms
         self.after(50, self.process_log)
 
+    # Console echo checkbox changed
+    def toggle_console_echo(self):
+        self.echo_log_to_console = bool(self._echolog.get())
+
+    # Create the metrics recorded by the application
+    def _create_metrics(self):
+        metrics = self.metrics
+        self._bytes_in = metrics.counter("bytes_in")
+        self._bytes_out = metrics.counter("bytes_out")
+        self._read_time = metrics.histogram("serial_read")
+        self._decode_time = metrics.histogram("decode_and_handle")
+        self._write_time = metrics.histogram("serial_write")
+        self._dropped_bytes = metrics.gauge("decoder_dropped_bytes")
+        self._commands_queued = metrics.counter("commands_queued")
+        self._message_counters = {message_type: metrics.counter(f"messages_{message_type.__name__}")
+                                  for message_type in message_types}
+        self._unhandled_messages = metrics.counter("messages_unhandled")
+        self._block_readings = metrics.counter("block_readings")
+        self._log_queue_depth = metrics.gauge("log_queue_depth")
+        self._log_lines = metrics.counter("log_lines")
+        self._log_time = metrics.histogram("process_log")
+        self._force_delay = metrics.histogram("force_delay")
+        self._clock_drift = metrics.gauge("clock_drift_ppm")
+
+    # Statistics checkbox changed
+    def toggle_metrics(self):
+        self.metrics.enabled = bool(self._metricsenabled.get())
+
+    # Clear all statistics
+    def reset_metrics(self):
+        self.metrics.reset()
+        self._last_snapshot = None
+
+    # Save statistics as JSON or CSV (chosen by file extension)
+    def dump_metrics(self):
+        path = tkinter.filedialog.asksaveasfilename(
+            defaultextension=".json", initialfile=time.strftime("stats_%Y%m%d_%H%M%S"),
+            filetypes=[("JSON", "*.json"), ("CSV", "*.csv")])
+        if not path:
+            return
+        try:
+            if path.lower().endswith('.csv'):
+                self.metrics.dump_csv(path)
+            else:
+                self.metrics.dump_json(path)
+        except OSError as e:
+            self.log(f"Failed to save statistics to {path} : {e}")
+            return
+        self.log(f"Saved statistics to {path}")
+
+    # Updates statistics display on repeat
+    # Rates are calculated from the change since the previous update
+    def update_stats_display(self):
+        snapshot = self.metrics.snapshot()
+        previous = self._last_snapshot
+        self._last_snapshot = snapshot
+        if previous is not None and self.metrics.enabled:
+            self._statstext.set(format_stats(snapshot, previous))
+        # Call again after 500ms
+        self.after(500, self.update_stats_display)
+
     # Updates graph on repeat
     def update_graph_display(self):
         # Update graph display
@@ -339,102 +942,89 @@ class HandControlApplication(tk.Tk):
         # Call again after 100ms
         self.after(100, self.update_graph_display)
 
-    # Message byte received from serial port
-    # Handle the byte based on the message specification
+    # Decoded message received from serial port
+    # Message format is described in hand_protocol
+    # Logged and graphed by self._display, then passed to the handler for its type if any
     def handle_message(self, message):
-        """
-
-        If first bit is 1 then message is string
-            Remaining bits specify string length - 1
-            Next [length] bytes are characters
-        If first 5 bits are 0 then message is for servo position
-            Remaining bits specify which servo
-            Next byte specifies position
-        If message is 0b00001000 then message is for all servo positions
-            Next 5 bytes are position for servos 0 to 4
-        If message is 0b00001001 then message is for all servo limits
-            Next 10 bytes specify limits
-            Order is min 0, max 0, min 1, max 1, etc
-        If message is 0b00001010 then message is raw force reading
-            Next byte specifies reading
-        """
-        print(f"Got message {message}")
-        if message >> 7 == 1:
-            # String
-            self.receive_char_array(message)
-        elif message >> 3 == 0b00000:
-            # Servo position
-            self.receive_servo_position(message)
-        elif message == 0b00001000:
-            # All servo positions
-            self.receive_all_servo_positions()
-        elif message == 0b00001001:
-            # All servo limits
-            self.receive_all_servo_limits()
-        elif message == 0b00001010:
-            # Raw force reading
-            self.receive_raw_force()
-        print(f"Handled message {message}")
-
-    # Read a character array from the serial port
-    def receive_char_array(self, message):
-        # Array length = last 7 bits of message + 1
-        length = (message - 0b10000000) + 1
-        # Read directly from serial port, cast to string, remove surrounding characters
-        text = str(self.ser.read(length))[2:-1]
-        self.log(f"> \"{text}\"")
-
-    # Read a single servo position
-    def receive_servo_position(self, message):
-        # Servo number = message as prefix is all 0
-        servo_num = message - 0b00000000
-        # Position is following byte
-        pos = self.read_one_byte()
-        self.log(f"> Servo {servo_num} position : {pos}")
-
-    # Read all servo positions
-    def receive_all_servo_positions(self):
-        # Following 5 bytes correspond to positions for servos 0 to 4
-        out = "Servo positions : "
-        for i in range(servo_count):
-            pos = self.read_one_byte()
-            out += f"{pos} "
-        self.log(f"> {out}")
-
-    # Read all servo limits
-    def receive_all_servo_limits(self):
-        # Following 10 bytes correspond to servo limits
-        # Order is min 0, max 0, min 1, max 1, etc.
-        out = "Servo limits : "
-        for i in range(servo_count):
-            l_min = self.read_one_byte()
-            l_max = self.read_one_byte()
-            out += f"({l_min},{l_max}) "
-        self.log(f"> {out}")
-
-    # Read a raw force reading
-    def receive_raw_force(self):
-        # Force reading is 6 bytes
-        # 4 bytes - unsigned long timestamp
-        # 2 bytes - unsigned short reading
-        # Data is in little endian order
-        data = self.ser.read(6)
-        timestamp, raw_force = struct.unpack(f'<LH', data)
-        if self._displayforcereadings.get():
-            self.log(f"> Raw force : {raw_force} at {timestamp}")
-        # Add reading to force graph
-        self._fforcegraph.append_data(timestamp/1000.0, raw_force)
-
-    # Helper function to read 1 byte from the serial port
-    # Will not return until a byte has been received
-    def read_one_byte(self):
-        byte = b''
-        while byte == b'':
-            byte = self.ser.read()
-        # ser.read() returns a byte array - take only first value
-        return byte[0]
+        message_type = type(message)
+        if not self._display.handle(message):
+            self._unhandled_messages.inc()
+            return
+        self._message_counters[message_type].inc()
+        handler = self._message_handlers.get(message_type)
+        if handler is not None:
+            handler(message)
+
+    # Keep the servo limits for grasp control
+    def receive_all_servo_limits(self, message):
+        self._servo_limits = message.limits
+        controller = self._grasp_controller
+        if controller is not None:
+            controller.set_limits(message.limits)
+        # Grasp control was waiting for the limits
+        if self._grasp_target is not None:
+            self.start_grasp_control(message.limits)
+
+    # Handle a raw force reading
+    # The graph shows filtered readings, the recording and shared memory get the raw readings
+    def receive_raw_force(self, message):
+        # Timestamp is in milliseconds
+        timestamp, raw_force = message
+        recorder = self._force_recorder
+        if recorder is not None:
+            recorder.append(timestamp, raw_force)
+        publisher = self._force_publisher
+        if publisher is not None:
+            publisher.append(timestamp, raw_force)
+        controller = self._grasp_controller
+        if controller is not None:
+            controller.update_force(timestamp, raw_force)
+
+    # Handle a block of raw force readings
+    # Readings are added to the recording in one call
+    def receive_raw_force_block(self, message):
+        timestamps, raw_forces = message
+        self._block_readings.inc(len(raw_forces))
+        recorder = self._force_recorder
+        if recorder is not None:
+            recorder.extend(timestamps, raw_forces)
+        publisher = self._force_publisher
+        if publisher is not None:
+            publisher.extend(timestamps, raw_forces)
+        controller = self._grasp_controller
+        if controller is not None:
+            controller.update_force(int(timestamps[-1]), int(raw_forces[-1]))
+
+
+# Text for the statistics display from two metrics snapshots
+def format_stats(snapshot, previous):
+    elapsed = max(snapshot['elapsed_s'] - previous['elapsed_s'], 1e-9)
+    counters = snapshot['counters']
+    histograms = snapshot['histograms']
+    def rate(name):
+        return (counters.get(name, 0) - previous['counters'].get(name, 0)) / elapsed
+    def times(name):
+        h = histograms.get(name)
+        if h is None or not h['count']:
+            return "-"
+        return f"p50 {h['p50']/1e6:.2f} p99 {h['p99']/1e6:.2f} max {h['max']/1e6:.2f} ms"
+    messages = ", ".join(f"{name[len('messages_'):]} {rate(name):.0f}/s"
+                         for name in counters if name.startswith('messages_'))
+    gauges = snapshot['gauges']
+    return "\n".join((
+        f"In {rate('bytes_in'):.0f} B/s   Out {rate('bytes_out'):.0f} B/s   "
+        f"Commands {rate('commands_queued'):.1f}/s   Dropped bytes {gauges.get('decoder_dropped_bytes', 0)}",
+        f"Messages : {messages}   Block readings {rate('block_readings'):.0f}/s",
+        f"Serial read   {times('serial_read')}",
+        f"Decode        {times('decode_and_handle')}",
+        f"Serial write  {times('serial_write')}",
+        f"Force delay   {times('force_delay')}   clock drift {gauges.get('clock_drift_ppm', 0)} ppm",
+        f"Graph draw    {times('graph_draw')}   ({rate('graph_full_draws'):.1f} full, {rate('graph_blits'):.1f} blit /s)",
+        f"Log update    {times('process_log')}   queue {gauges.get('log_queue_depth', 0)}   {rate('log_lines'):.0f} lines/s",
+        ))
 
 
 # Instantiate application and run
-app = HandControlApplication()
-app.mainloop()
+if __name__ == "__main__":
+    app = HandControlApplication()
+    app.mainloop()
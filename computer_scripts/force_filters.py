@@ -0,0 +1,279 @@
+import math
+from collections import namedtuple
+import numpy as np
+# SciPy is optional - the biquad filter falls back to NumPy block filtering without it
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+"""
+
+Streaming filters and contact detection for force readings
+
+Every filter takes chunks of (timestamps, values) arrays and returns the
+filtered (timestamps, values). State is kept between calls, so filtering a
+stream in chunks of any size gives the same output as filtering it one
+reading at a time - a single RawForce and a RawForceBlock can be passed
+through the same filter.
+
+Filters:
+    MovingAverage(length)           Mean of the last [length] readings
+    Biquad(b, a) / lowpass(...)     Second order IIR filter
+    MedianFilter(length)            Median of the last [length] readings
+    Decimator(factor)               Mean of each group of [factor] readings,
+                                    one output per group
+    FilterChain(*filters)           Filters applied in order
+Until a filter has seen [length] readings it uses the readings it has.
+
+ContactDetector reports when the force rises above one threshold and falls
+back below a lower one (hysteresis), with the timestamp of each change.
+
+"""
+
+# Outputs are float64 - raw readings are integers so sums are exact
+def as_arrays(timestamps, values):
+    return np.asarray(timestamps), np.asarray(values, dtype=np.float64)
+
+
+class MovingAverage:
+    def __init__(self, length):
+        if length < 1:
+            raise ValueError("Moving average length must be at least 1")
+        self.length = length
+        self.reset()
+
+    def reset(self):
+        self._history = np.empty(0)
+
+    def process(self, timestamps, values):
+        timestamps, values = as_arrays(timestamps, values)
+        if not len(values):
+            return timestamps, values
+        held = len(self._history)
+        extended = np.concatenate((self._history, values))
+        sums = np.concatenate(((0.0,), np.cumsum(extended)))
+        end = np.arange(held + 1, len(extended) + 1)
+        start = np.maximum(end - self.length, 0)
+        out = (sums[end] - sums[start]) / (end - start)
+        self._history = extended[-(self.length - 1):] if self.length > 1 else extended[:0]
+        return timestamps, out
+
+
+# Second order IIR section with coefficients b (3) and a (3, a[0] normalised to 1)
+# Direct form II transposed, the same as scipy.signal.lfilter
+# Without SciPy, readings are filtered block_length at a time with matrix products
+class Biquad:
+    block_length = 64
+
+    def __init__(self, b, a):
+        b = np.asarray(b, dtype=np.float64)
+        a = np.asarray(a, dtype=np.float64)
+        if b.shape != (3,) or a.shape != (3,):
+            raise ValueError("Biquad needs 3 b and 3 a coefficients")
+        self.b = b / a[0]
+        self.a = a / a[0]
+        if lfilter is None:
+            self._block_matrices()
+        self.reset()
+
+    def reset(self):
+        self._state = np.zeros(2)
+        self._started = False
+
+    def process(self, timestamps, values):
+        timestamps, values = as_arrays(timestamps, values)
+        if not len(values):
+            return timestamps, values
+        if not self._started:
+            # Start settled at the first reading instead of rising from zero
+            self._state = self._steady_state(values[0])
+            self._started = True
+        if lfilter is not None:
+            out, self._state = lfilter(self.b, self.a, values, zi=self._state)
+            return timestamps, out
+        return timestamps, self._filter_blocks(values)
+
+    # One step of the filter, returns (output, new state)
+    def _step(self, x, z1, z2):
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+        y = b0 * x + z1
+        return y, b1 * x - a1 * y + z2, b2 * x - a2 * y
+
+    # Responses over one block, the filter being linear:
+    #   _impulse[k]     output k readings after a unit reading, from zero state
+    #   _impulse_state[k]   state after that output
+    #   _state_output[k]    output k readings after each unit state, with zero input
+    #   _state_power[k]     state after that output (the state transition matrix to the power k+1)
+    def _block_matrices(self):
+        length = self.block_length
+        self._impulse = np.empty(length)
+        self._impulse_state = np.empty((length, 2))
+        self._state_output = np.empty((length, 2))
+        self._state_power = np.empty((length, 2, 2))
+        z = (0.0, 0.0)
+        x = 1.0
+        for k in range(length):
+            self._impulse[k], *z = self._step(x, *z)
+            self._impulse_state[k] = z
+            x = 0.0
+        for column, start in enumerate(((1.0, 0.0), (0.0, 1.0))):
+            z = start
+            for k in range(length):
+                self._state_output[k, column], *z = self._step(0.0, *z)
+                self._state_power[k, :, column] = z
+        # Zero state output of a block is a lower triangular Toeplitz matrix of the impulse response
+        lags = np.arange(length)[:, None] - np.arange(length)
+        self._block_response = np.where(lags >= 0, self._impulse[np.maximum(lags, 0)], 0.0)
+
+    # Filter without SciPy - whole blocks are filtered together, leaving only
+    # the state carried from block to block in a Python loop
+    def _filter_blocks(self, values):
+        length = self.block_length
+        blocks = len(values) // length
+        state = self._state
+        out = np.empty_like(values)
+        if blocks:
+            x = values[:blocks * length].reshape(blocks, length)
+            y = x @ self._block_response.T
+            # State at the end of each block due to its own readings
+            end_states = x @ self._impulse_state[::-1]
+            transition = self._state_power[-1]
+            starts = np.empty((blocks, 2))
+            for i in range(blocks):
+                starts[i] = state
+                state = transition @ state + end_states[i]
+            out[:blocks * length] = (y + starts @ self._state_output.T).ravel()
+        remaining = len(values) - blocks * length
+        if remaining:
+            x = values[blocks * length:]
+            out[blocks * length:] = (self._block_response[:remaining, :remaining] @ x
+                                     + self._state_output[:remaining] @ state)
+            state = self._state_power[remaining - 1] @ state + x @ self._impulse_state[remaining - 1::-1]
+        self._state = state
+        return out
+
+    # Filter state for a constant input
+    def _steady_state(self, value):
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+        gain = (b0 + b1 + b2) / (1.0 + a1 + a2)
+        y = gain * value
+        z2 = b2 * value - a2 * y
+        z1 = b1 * value - a1 * y + z2
+        return np.array((z1, z2))
+
+
+# Butterworth style low-pass biquad (RBJ audio EQ cookbook)
+# cutoff and sample_rate in the same units - e.g. lowpass(0.1, 1.0) cuts off at a tenth of the sample rate
+def lowpass(cutoff, sample_rate, q=1 / math.sqrt(2)):
+    if not 0 < cutoff < sample_rate / 2:
+        raise ValueError("Low-pass cutoff must be between 0 and half the sample rate")
+    w0 = 2 * math.pi * cutoff / sample_rate
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+    b = ((1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2)
+    a = (1 + alpha, -2 * cos_w0, 1 - alpha)
+    return Biquad(b, a)
+
+
+class MedianFilter:
+    def __init__(self, length):
+        if length < 1:
+            raise ValueError("Median filter length must be at least 1")
+        self.length = length
+        self.reset()
+
+    def reset(self):
+        self._history = np.empty(0)
+
+    def process(self, timestamps, values):
+        timestamps, values = as_arrays(timestamps, values)
+        if not len(values):
+            return timestamps, values
+        held = len(self._history)
+        extended = np.concatenate((self._history, values))
+        out = np.empty(len(values))
+        # Outputs before [length] readings have been seen use the readings so far
+        filling = min(max(self.length - 1 - held, 0), len(values))
+        for i in range(filling):
+            out[i] = np.median(extended[:held + i + 1])
+        if filling < len(values):
+            windows = np.lib.stride_tricks.sliding_window_view(extended, self.length)
+            out[filling:] = np.median(windows[held + filling + 1 - self.length:], axis=1)
+        self._history = extended[-(self.length - 1):] if self.length > 1 else extended[:0]
+        return timestamps, out
+
+
+# Averages each group of [factor] readings - the timestamp is that of the last reading in the group
+class Decimator:
+    def __init__(self, factor):
+        if factor < 1:
+            raise ValueError("Decimation factor must be at least 1")
+        self.factor = factor
+        self.reset()
+
+    def reset(self):
+        self._held_timestamps = np.empty(0, dtype=np.int64)
+        self._held_values = np.empty(0)
+
+    def process(self, timestamps, values):
+        timestamps, values = as_arrays(timestamps, values)
+        timestamps = np.concatenate((self._held_timestamps, timestamps.astype(np.int64, copy=False)))
+        values = np.concatenate((self._held_values, values))
+        full = len(values) - len(values) % self.factor
+        self._held_timestamps = timestamps[full:]
+        self._held_values = values[full:]
+        out = values[:full].reshape(-1, self.factor).mean(axis=1)
+        return timestamps[self.factor - 1:full:self.factor], out
+
+
+class FilterChain:
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+
+    def process(self, timestamps, values):
+        for f in self.filters:
+            timestamps, values = f.process(timestamps, values)
+        return timestamps, values
+
+
+# kind is 'contact' when the force rises above the on threshold and 'release' when it falls below the off threshold
+ContactEvent = namedtuple('ContactEvent', ['kind', 'timestamp', 'value'])
+
+
+# Contact detection with hysteresis - off_threshold must not be above on_threshold
+class ContactDetector:
+    def __init__(self, on_threshold, off_threshold=None):
+        if off_threshold is None:
+            off_threshold = on_threshold
+        if off_threshold > on_threshold:
+            raise ValueError("Contact off threshold must not be above the on threshold")
+        self.on_threshold = on_threshold
+        self.off_threshold = off_threshold
+        self.reset()
+
+    def reset(self):
+        self.in_contact = False
+
+    # Returns a list of ContactEvents in the chunk
+    def process(self, timestamps, values):
+        timestamps, values = as_arrays(timestamps, values)
+        if not len(values):
+            return []
+        # 1 above on threshold, 0 below off threshold, -1 in between (state held)
+        marks = np.where(values >= self.on_threshold, 1, np.where(values <= self.off_threshold, 0, -1))
+        # State after each reading is the last mark that was not held
+        indices = np.where(marks >= 0, np.arange(len(marks)), -1)
+        np.maximum.accumulate(indices, out=indices)
+        states = np.where(indices >= 0, marks[np.maximum(indices, 0)], int(self.in_contact))
+        previous = np.concatenate(((int(self.in_contact),), states[:-1]))
+        changes = np.flatnonzero(states != previous)
+        self.in_contact = bool(states[-1])
+        return [ContactEvent('contact' if states[i] else 'release', int(timestamps[i]), float(values[i]))
+                for i in changes]
@@ -0,0 +1,156 @@
+import os
+import struct
+import time
+# Threading
+from threading import Thread, Lock, Event
+import numpy as np
+# Hand serial protocol
+from hand_protocol import MSG_FORCE_RAW
+
+"""
+
+Binary recording of raw force readings
+
+File layout:
+    32 byte header - magic, format version, record size, recording start time (unix seconds)
+    Fixed size records - little endian uint32 timestamp (ms) + uint16 raw force,
+        the same layout as the MSG_FORCE_RAW payload
+
+At the firmware stream rate (10 readings/s) an hour of recording is about 216 kB,
+and about 3 MB at the 9600 baud maximum
+
+"""
+
+file_magic = b'HFRC'
+file_version = 1
+_header_struct = struct.Struct('<4sHHd')
+header_size = 32
+
+record_dtype = np.dtype([('timestamp', '<u4'), ('raw_force', '<u2')])
+_record_struct = struct.Struct('<LH')
+
+# Frame layout used to re-encode records as MSG_FORCE_RAW messages
+_frame_dtype = np.dtype([('opcode', 'u1'), ('timestamp', '<u4'), ('raw_force', '<u2')])
+
+
+# Appends readings to a recording file
+# Writes are collected in memory and flushed to disk by a background thread
+# so the caller (listener thread) never waits on the disk
+class ForceRecorder:
+    def __init__(self, path, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.samples_written = 0
+        self._file = open(path, 'wb')
+        header = _header_struct.pack(file_magic, file_version, record_dtype.itemsize, time.time())
+        self._file.write(header.ljust(header_size, b'\0'))
+        self._pending = bytearray()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Add a single reading
+    # Unwrapped timestamps are stored as the device's 32 bit millis() value
+    def append(self, timestamp, raw_force):
+        record = _record_struct.pack(timestamp & 0xFFFFFFFF, raw_force)
+        with self._lock:
+            self._pending += record
+
+    # Add several readings at once
+    def extend(self, timestamps, raw_forces):
+        records = np.empty(len(timestamps), dtype=record_dtype)
+        records['timestamp'] = np.asarray(timestamps) & 0xFFFFFFFF
+        records['raw_force'] = raw_forces
+        with self._lock:
+            self._pending += records.tobytes()
+
+    # Write out pending readings and stop the writer thread
+    def close(self):
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._flush()
+        self._file.close()
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            data = self._pending
+            self._pending = bytearray()
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            self.samples_written += len(data) // record_dtype.itemsize
+
+
+# Read a recording header, returns dict of header values
+def read_header(path):
+    with open(path, 'rb') as f:
+        data = f.read(header_size)
+    if len(data) < header_size:
+        raise ValueError(f"{path} is too short to be a force recording")
+    magic, version, record_size, start_time = _header_struct.unpack_from(data)
+    if magic != file_magic:
+        raise ValueError(f"{path} is not a force recording")
+    if version != file_version or record_size != record_dtype.itemsize:
+        raise ValueError(f"{path} has unsupported format version {version}")
+    return {'version': version, 'record_size': record_size, 'start_time': start_time}
+
+# Memory-map a recording as a read-only structured array with fields 'timestamp' and 'raw_force'
+# No data is read until it is used, so large recordings open instantly
+# A partially written final record (e.g. after a crash) is ignored
+def open_recording(path):
+    header = read_header(path)
+    count = (os.path.getsize(path) - header_size) // record_dtype.itemsize
+    if count == 0:
+        return header, np.zeros(0, dtype=record_dtype)
+    records = np.memmap(path, dtype=record_dtype, mode='r', offset=header_size, shape=(count,))
+    return header, records
+
+# Device timestamps in ms since the first record, allowing for millis() wrapping
+# A step backwards of more than half the counter range is taken as a device reset
+def elapsed_ms(timestamps):
+    steps = np.diff(timestamps.astype(np.int64)) % (1 << 32)
+    steps[steps >= (1 << 31)] = 0
+    return np.concatenate(([0], np.cumsum(steps)))
+
+# Generator of recorded readings encoded as MSG_FORCE_RAW messages
+# speed is the playback rate (1.0 for real time) or None to go as fast as possible
+# Each yielded chunk can be passed straight to MessageDecoder.feed
+def replay_frames(path, speed=1.0, chunk_records=4096, chunk_duration=0.05):
+    _, records = open_recording(path)
+    if len(records) == 0:
+        return
+    if speed is None:
+        boundaries = range(0, len(records), chunk_records)
+        elapsed = None
+    else:
+        # Chunk boundaries every chunk_duration seconds of playback
+        elapsed = elapsed_ms(records['timestamp']) / (1000.0 * speed)
+        steps = np.arange(0.0, elapsed[-1] + chunk_duration, chunk_duration)
+        boundaries = np.unique(np.searchsorted(elapsed, steps))
+    start_time = time.perf_counter()
+    ends = list(boundaries[1:]) + [len(records)]
+    for start, end in zip(boundaries, ends):
+        if start >= end:
+            continue
+        if elapsed is not None:
+            delay = elapsed[start] - (time.perf_counter() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        frames = np.empty(end - start, dtype=_frame_dtype)
+        frames['opcode'] = MSG_FORCE_RAW
+        frames['timestamp'] = records['timestamp'][start:end]
+        frames['raw_force'] = records['raw_force'][start:end]
+        yield frames.tobytes()
@@ -0,0 +1,276 @@
+import argparse
+import time
+from collections import deque
+# Threading
+from threading import Lock
+# Hand serial protocol
+from hand_protocol import CommandBuffer, servo_count
+from scheduling import FixedRateScheduler
+
+"""
+
+Closed loop grasp control on the computer
+
+A GraspController runs a fixed-rate control thread. Each tick it takes the
+newest force reading, asks a policy for the new finger position and sends
+servo commands for the servos whose (whole number) setpoint changed.
+Setpoints are kept within the servo limits from a limits query.
+
+Force readings are passed in with update_force() from whatever reads the
+hand (GUI listener thread, HandClient handler, ...) - run the force stream
+faster than the control rate so every tick has a fresh reading.
+
+Policies:
+    PIDPolicy(target_force, ...)        Hold the force at a target
+    ForceLimitPolicy(force_limit, ...)  Close until the force reaches a limit, then hold
+
+Timing statistics (stats()):
+    Control loop jitter, overruns and missed deadlines from the scheduler
+    Sensor to actuation latency - reading received to command written (p50/p99/max)
+    Age of the reading used and ticks with no new reading
+
+Run this file to grasp a simulated springy object with the emulator:
+    python grasp_controller.py --target 400
+
+"""
+
+# Hold the force at target_force by moving the fingers
+# Output is a position offset from the start position - the integral term is
+# not wound up while the output is held at a limit
+class PIDPolicy:
+    def __init__(self, target_force, kp=0.02, ki=0.2, kd=0.0, max_speed=200.0):
+        self.target_force = target_force
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.max_speed = max_speed      # Degrees per second
+        self.reset(0)
+
+    def reset(self, position):
+        self._start = position
+        self._integral = 0.0
+        self._previous_error = None
+        self._output = float(position)
+
+    # Returns the new position for a force reading, dt seconds after the last update
+    def update(self, force, dt, low, high):
+        error = self.target_force - force
+        derivative = 0.0 if self._previous_error is None or dt <= 0 else (error - self._previous_error) / dt
+        self._previous_error = error
+        integral = self._integral + error * dt
+        target = self._start + self.kp * error + self.ki * integral + self.kd * derivative
+        # Limit finger speed
+        step = self.max_speed * dt
+        output = min(max(target, self._output - step, low), self._output + step, high)
+        # Anti-windup - only keep integrating while the output is free to follow
+        if output == target or (target > output) != (error > 0):
+            self._integral = integral
+        self._output = output
+        return output
+
+
+# Close at close_speed until the force reaches force_limit, then hold
+# Back off at close_speed while the force is more than margin above the limit
+class ForceLimitPolicy:
+    def __init__(self, force_limit, close_speed=60.0, margin=50.0):
+        self.force_limit = force_limit
+        self.close_speed = close_speed
+        self.margin = margin
+        self.reset(0)
+
+    def reset(self, position):
+        self._output = float(position)
+
+    def update(self, force, dt, low, high):
+        if force < self.force_limit:
+            self._output += self.close_speed * dt
+        elif force > self.force_limit + self.margin:
+            self._output -= self.close_speed * dt
+        self._output = min(max(self._output, low), high)
+        return self._output
+
+
+class GraspController:
+    # write is called with command bytes from the control thread (e.g. serial.Serial.write)
+    # servos are the fingers moved together, start_position where they start from
+    def __init__(self, write, policy, servos=(0, 1, 2, 3), rate=50.0, start_position=0,
+                 limits=None, stale_after=0.1, history=10000):
+        self._write = write
+        self.policy = policy
+        self.servos = tuple(servos)
+        self.start_position = start_position
+        self.stale_after = stale_after
+        self._limits = [(0, 255)] * servo_count
+        if limits is not None:
+            self.set_limits(limits)
+        self._commands = CommandBuffer()
+        self._sample = None         # (timestamp, raw_force, receive time)
+        self._sample_lock = Lock()
+        self._last_used = None
+        self._last_sent = {}
+        self._last_tick_time = None
+        self._scheduler = FixedRateScheduler(rate, self._tick, name="Grasp controller", history=history)
+        # Statistics
+        self.readings_received = 0
+        self.stale_ticks = 0        # Ticks without a new reading - setpoints are held
+        self._latencies = deque(maxlen=history)     # Reading received to command written (s)
+        self._ages = deque(maxlen=history)          # Age of the reading used at each tick (s)
+        # Held while the histories change, so stats() can copy them while running
+        self._stats_lock = Lock()
+        # Newest (time, force, position) for display
+        self.last_output = None
+
+    # Limits are the (min, max) per servo tuple returned by a limits query
+    def set_limits(self, limits):
+        self._limits = [tuple(l) for l in limits]
+
+    # Pass in a force reading - called from the thread reading the hand
+    def update_force(self, timestamp, raw_force):
+        sample = (timestamp, raw_force, time.perf_counter())
+        with self._sample_lock:
+            self._sample = sample
+            self.readings_received += 1
+
+    def start(self):
+        self.policy.reset(self.start_position)
+        self._last_sent = {}
+        self._last_used = None
+        self._last_tick_time = None
+        self._scheduler.start()
+
+    def stop(self):
+        self._scheduler.stop()
+
+    def join(self, timeout=None):
+        self._scheduler.join(timeout)
+
+    @property
+    def is_running(self):
+        return self._scheduler.is_running
+
+    def _tick(self, tick, scheduled_time):
+        with self._sample_lock:
+            sample = self._sample
+        now = time.perf_counter()
+        if sample is None or sample is self._last_used or now - sample[2] > self.stale_after:
+            self.stale_ticks += 1
+            return True
+        self._last_used = sample
+        dt = 0.0 if self._last_tick_time is None else scheduled_time - self._last_tick_time
+        self._last_tick_time = scheduled_time
+        # All controlled fingers share the tightest limits
+        low = max(self._limits[s][0] for s in self.servos)
+        high = min(self._limits[s][1] for s in self.servos)
+        position = self.policy.update(sample[1], dt, low, high)
+        setpoint = int(round(min(max(position, low), high)))
+        for servo in self.servos:
+            if self._last_sent.get(servo) != setpoint:
+                self._commands.set_servo(servo, setpoint)
+                self._last_sent[servo] = setpoint
+        written = self._commands.flush(self._write)
+        with self._stats_lock:
+            if written:
+                self._latencies.append(time.perf_counter() - sample[2])
+            self._ages.append(now - sample[2])
+        self.last_output = (sample[0], sample[1], setpoint)
+        return True
+
+    # Timing statistics in microseconds, with the scheduler statistics
+    def stats(self):
+        stats = self._scheduler.stats()
+        def percentile(values, p):
+            if not values:
+                return float('nan')
+            values = sorted(values)
+            return values[min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)] * 1e6
+        with self._stats_lock:
+            latencies = list(self._latencies)
+            ages = list(self._ages)
+        stats.update({
+            'readings_received': self.readings_received,
+            'stale_ticks': self.stale_ticks,
+            'latency_p50_us': percentile(latencies, 50),
+            'latency_p99_us': percentile(latencies, 99),
+            'latency_max_us': max(latencies) * 1e6 if latencies else float('nan'),
+            'reading_age_p50_us': percentile(ages, 50),
+            'reading_age_p99_us': percentile(ages, 99),
+            })
+        stats.update(self._commands.stats())
+        return stats
+
+
+if __name__ == "__main__":
+    import serial
+    from threading import Thread
+    from hand_protocol import MessageDecoder, RawForce, AllServoLimits, QUERY_ALL_LIMITS, TOGGLE_FORCE_STREAM
+    from hand_emulator import HandFirmware, PtyHandEmulator, SpringContactModel
+
+    parser = argparse.ArgumentParser(description="Grasp a simulated springy object with the emulator")
+    parser.add_argument("--policy", choices=('pid', 'limit'), default='pid')
+    parser.add_argument("--target", type=float, default=400, help="Target force (PID) or force limit")
+    parser.add_argument("--rate", type=float, default=50, help="Control rate (Hz)")
+    parser.add_argument("--sensor-rate", type=float, default=100, help="Force stream rate (Hz)")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to run")
+    parser.add_argument("--port", help="Use a real hand on this port instead of the emulator")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    args = parser.parse_args()
+
+    emulator = None
+    port = args.port
+    if port is None:
+        model = SpringContactModel()
+        emulator = PtyHandEmulator(HandFirmware(debug_only=False, force_model=model),
+                                   baudrate=args.baudrate, stream_interval=1.0 / args.sensor_rate)
+        emulator.start()
+        port = emulator.port
+        print(f"Emulated object contact at {model.contact_position}, stiffness {model.stiffness} per degree")
+
+    ser = serial.Serial(port, args.baudrate, timeout=0.1)
+    if args.policy == 'pid':
+        policy = PIDPolicy(args.target)
+    else:
+        policy = ForceLimitPolicy(args.target)
+    controller = GraspController(ser.write, policy, rate=args.rate)
+    trace = []
+    limits_received = []
+    running = True
+
+    # Listener thread - passes force readings to the controller
+    def listen():
+        decoder = MessageDecoder()
+        while running:
+            for message in decoder.feed(ser.read(ser.in_waiting or 1)):
+                if type(message) is RawForce:
+                    controller.update_force(*message)
+                    trace.append((time.perf_counter(), message.raw_force))
+                elif type(message) is AllServoLimits:
+                    controller.set_limits(message.limits)
+                    limits_received.append(message.limits)
+    listener = Thread(target=listen, daemon=True)
+    listener.start()
+
+    ser.write(bytes([QUERY_ALL_LIMITS, TOGGLE_FORCE_STREAM]))
+    time.sleep(0.2)
+    print(f"Servo limits : {limits_received[-1] if limits_received else 'no reply - using 0 to 255'}")
+    start = time.perf_counter()
+    controller.start()
+    time.sleep(args.duration)
+    controller.stop()
+    ser.write(bytes([TOGGLE_FORCE_STREAM]))
+    time.sleep(0.1)
+    running = False
+    listener.join()
+    ser.close()
+    if emulator is not None:
+        emulator.close()
+
+    # Step response of the force
+    forces = [(t - start, f) for t, f in trace if t >= start]
+    if forces:
+        peak = max(f for _, f in forces)
+        final = [f for t, f in forces if t >= args.duration - 1.0]
+        settled = next((t for t, f in forces if abs(f - args.target) <= 0.05 * args.target), None)
+        print(f"Force : peak {peak}, mean over last second {sum(final)/max(len(final), 1):.1f} (target {args.target:.0f}), "
+              f"first within 5% at {'-' if settled is None else f'{settled:.2f} s'}")
+    for name, value in controller.stats().items():
+        print(f"{name:<24}{value:>12.1f}" if isinstance(value, float) else f"{name:<24}{value:>12}")
@@ -0,0 +1,526 @@
+import argparse
+import asyncio
+import struct
+from collections import deque
+# pySerial
+import serial
+# Hand serial protocol
+from hand_protocol import (MessageDecoder, StringMessage, ServoPosition, AllServoPositions,
+    AllServoLimits, RawForce, RawForceBlock, QUERY_FORCE_RAW, TOGGLE_FORCE_STREAM, TOGGLE_FORCE_BLOCK_STREAM,
+    command_length)
+from hand_client import SerialTransport, HandClient
+
+"""
+
+Broker that shares one hand between several programs
+
+The broker owns the serial port, decodes the stream from the hand once and
+passes every message on to its subscribers over local sockets. Commands
+from subscribers are merged back onto the serial link.
+
+Framed subscribers (Unix socket or TCP) exchange frames of:
+    2 byte little endian payload length, 1 byte frame kind, payload
+Frame kinds:
+    FRAME_DEVICE     broker -> client   One message frame exactly as sent by the hand
+    FRAME_COMMAND    client -> broker   Command bytes for the hand
+    FRAME_DROPPED    broker -> client   4 byte count of force messages dropped for this client
+    FRAME_SUBSCRIBE  client -> broker   1 byte mask of the SUBSCRIBE_* message groups to receive
+BrokerClient is a HandClient that connects to a broker instead of a port.
+
+Raw subscribers (--raw-tcp) see the plain device byte stream and send plain
+command bytes, so any program using pySerial can connect with a
+socket://localhost:PORT url.
+
+Commands are queued per subscriber and sent round robin, one command from
+each subscriber in turn, paced to the link rate so no subscriber can fill
+the link ahead of the others. A subscriber with too many queued commands
+stops being read until its queue drains.
+
+Messages to a subscriber that is not keeping up are held back once its
+socket buffer is full. Only force messages are ever dropped, according to
+the drop policy:
+    'oldest'        Drop the oldest held back force message
+    'newest'        Drop the new force message
+    'disconnect'    Close the connection to the subscriber
+Replies and strings are always delivered. The serial reader never waits
+for a subscriber.
+
+Force streams are shared - the broker turns a stream on when the first
+subscriber enables it and off when the last one disables it or disconnects.
+Query replies go to every subscriber, so a subscriber may see replies to
+queries sent by others. A force query while the shared RawForce stream is on
+is not sent to the hand, whose reply would be mixed into the stream - the
+broker answers it with the next streamed reading instead. The reading that
+answers a force query is sent to the subscriber that asked even if it does
+not subscribe to force messages.
+
+"""
+
+_frame_header = struct.Struct('<HB')
+_dropped_struct = struct.Struct('<L')
+
+FRAME_DEVICE = 1
+FRAME_COMMAND = 2
+FRAME_DROPPED = 3
+FRAME_SUBSCRIBE = 4
+
+# Message groups for FRAME_SUBSCRIBE
+SUBSCRIBE_STRINGS = 0b0001
+SUBSCRIBE_POSITIONS = 0b0010
+SUBSCRIBE_LIMITS = 0b0100
+SUBSCRIBE_FORCE = 0b1000
+SUBSCRIBE_ALL = 0b1111
+
+_message_groups = {
+    StringMessage: SUBSCRIBE_STRINGS,
+    ServoPosition: SUBSCRIBE_POSITIONS,
+    AllServoPositions: SUBSCRIBE_POSITIONS,
+    AllServoLimits: SUBSCRIBE_LIMITS,
+    RawForce: SUBSCRIBE_FORCE,
+    RawForceBlock: SUBSCRIBE_FORCE,
+    }
+
+drop_policies = ('oldest', 'newest', 'disconnect')
+
+_stream_toggles = (TOGGLE_FORCE_STREAM, TOGGLE_FORCE_BLOCK_STREAM)
+
+
+def encode_frame(kind, payload=b''):
+    return _frame_header.pack(len(payload), kind) + payload
+
+
+# Splits a byte stream into (kind, payload) frames
+class FrameReader:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        frames = []
+        pos = 0
+        while len(buf) - pos >= _frame_header.size:
+            length, kind = _frame_header.unpack_from(buf, pos)
+            end = pos + _frame_header.size + length
+            if end > len(buf):
+                break
+            frames.append((kind, bytes(buf[pos + _frame_header.size:end])))
+            pos = end
+        del buf[:pos]
+        return frames
+
+
+# Broker side of one subscriber connection
+class _Subscriber(asyncio.Protocol):
+    def __init__(self, broker, raw=False):
+        self._broker = broker
+        self.raw = raw
+        self.transport = None
+        self.mask = SUBSCRIBE_ALL
+        self.name = None
+        self._frames = FrameReader()
+        self._partial_command = bytearray()
+        # Commands waiting to be sent to the hand
+        self.commands = deque()
+        self.reading_paused = False
+        # Force messages held back while the socket buffer is full
+        self._backlog = deque()
+        self._writing_paused = False
+        self.dropped = 0            # Dropped since last reported to the subscriber
+        self.dropped_total = 0
+        self.messages_sent = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self._broker.write_buffer_limit)
+        peer = transport.get_extra_info('peername')
+        self.name = f"{'raw ' if self.raw else ''}{peer or 'local'}"
+        self._broker._add_subscriber(self)
+
+    def connection_lost(self, exc):
+        self._broker._remove_subscriber(self)
+
+    def data_received(self, data):
+        if self.raw:
+            self._add_commands(data)
+            return
+        for kind, payload in self._frames.feed(data):
+            if kind == FRAME_COMMAND:
+                self._add_commands(payload)
+            elif kind == FRAME_SUBSCRIBE and payload:
+                self.mask = payload[0]
+
+    # Split command bytes into individual commands
+    def _add_commands(self, data):
+        buf = self._partial_command
+        buf += data
+        pos = 0
+        while pos < len(buf):
+            length = command_length(buf[pos])
+            if pos + length > len(buf):
+                break
+            self._broker._queue_command(self, bytes(buf[pos:pos + length]))
+            pos += length
+        del buf[:pos]
+
+    # Send a message frame (already framed for this kind of subscriber)
+    def send(self, data, droppable):
+        if self.transport.is_closing():
+            return
+        if not self._writing_paused or not droppable:
+            self.transport.write(data)
+            self.messages_sent += 1
+            return
+        backlog = self._backlog
+        if len(backlog) < self._broker.queue_limit:
+            backlog.append(data)
+            return
+        policy = self._broker.drop_policy
+        if policy == 'disconnect':
+            # Close without waiting for the buffered data the subscriber is not reading
+            self.transport.abort()
+            return
+        if policy == 'oldest':
+            backlog.popleft()
+            backlog.append(data)
+        self.dropped += 1
+        self.dropped_total += 1
+
+    # Socket buffer full / drained (asyncio flow control)
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        backlog = self._backlog
+        while backlog and not self._writing_paused:
+            self.transport.write(backlog.popleft())
+            self.messages_sent += 1
+        if self.dropped and not self.raw:
+            self.transport.write(encode_frame(FRAME_DROPPED, _dropped_struct.pack(self.dropped)))
+            self.dropped = 0
+
+
+# Owns the serial port and serves subscribers
+class HandBroker(asyncio.Protocol):
+    def __init__(self, port, baudrate=9600, queue_limit=1000, drop_policy='oldest',
+                 command_queue_limit=256, write_buffer_limit=64*1024):
+        if drop_policy not in drop_policies:
+            raise ValueError(f"Unknown drop policy '{drop_policy}' - use one of {drop_policies}")
+        self.port = port
+        self.baudrate = baudrate
+        self.queue_limit = queue_limit
+        self.drop_policy = drop_policy
+        self.command_queue_limit = command_queue_limit
+        self.write_buffer_limit = write_buffer_limit
+        self._decoder = MessageDecoder()
+        self._serial = None
+        self._servers = []
+        self._subscribers = []
+        # Subscribers that have each force stream turned on, keyed by toggle command
+        self._stream_users = {toggle: set() for toggle in _stream_toggles}
+        # Force queries waiting for a RawForce - (subscriber, held) where held queries
+        # are answered from the RawForce stream and were not sent to the hand
+        self._force_queries = []
+        self._commands_ready = None
+        self._pump_task = None
+        self._closed = None
+        # Statistics
+        self.messages_received = 0
+        self.commands_sent = 0
+        self.bytes_sent = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Open the serial port
+    # port may be a pySerial url or an already open serial object
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        if isinstance(self.port, str):
+            ser = serial.serial_for_url(self.port, baudrate=self.baudrate)
+        else:
+            ser = self.port
+        self._closed = loop.create_future()
+        self._commands_ready = asyncio.Event()
+        SerialTransport(loop, self, ser)
+        await asyncio.sleep(0)
+        self._pump_task = asyncio.ensure_future(self._pump_commands())
+
+    # Listen for framed subscribers on a Unix socket
+    async def serve_unix(self, path):
+        server = await asyncio.get_running_loop().create_unix_server(lambda: _Subscriber(self), path)
+        self._servers.append(server)
+        return server
+
+    # Listen for framed (or raw) subscribers on TCP - use port 0 to pick a free port
+    # Returns the server - the port is server.sockets[0].getsockname()[1]
+    async def serve_tcp(self, host='127.0.0.1', port=0, raw=False):
+        server = await asyncio.get_running_loop().create_server(lambda: _Subscriber(self, raw), host, port)
+        self._servers.append(server)
+        return server
+
+    # Stop listening, disconnect subscribers and close the serial port
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        for subscriber in list(self._subscribers):
+            subscriber.transport.close()
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+            self._pump_task = None
+        if self._serial is not None:
+            self._serial.close()
+            await self._closed
+
+    # Serial port protocol callbacks
+    def connection_made(self, transport):
+        self._serial = transport
+
+    def data_received(self, data):
+        for message, frame in self._decoder.feed_frames(data):
+            self.messages_received += 1
+            group = _message_groups[type(message)]
+            droppable = group == SUBSCRIBE_FORCE
+            framed = None
+            for subscriber in self._subscribers:
+                if subscriber.raw:
+                    subscriber.send(frame, droppable)
+                elif subscriber.mask & group:
+                    if framed is None:
+                        framed = encode_frame(FRAME_DEVICE, frame)
+                    subscriber.send(framed, droppable)
+            if self._force_queries and type(message) is RawForce:
+                self._answer_force_queries(frame)
+
+    # A reading is the reply to one waiting force query from each subscriber
+    # Subscribers that do not receive force messages are sent it as a reply
+    def _answer_force_queries(self, frame):
+        answered = []
+        remaining = []
+        for query in self._force_queries:
+            subscriber = query[0]
+            if subscriber in answered:
+                remaining.append(query)
+                continue
+            answered.append(subscriber)
+            if not subscriber.raw and not subscriber.mask & SUBSCRIBE_FORCE:
+                subscriber.send(encode_frame(FRAME_DEVICE, frame), False)
+        self._force_queries = remaining
+
+    # RawForce stream turned off - held force queries go to the hand
+    def _release_force_queries(self):
+        for subscriber, held in self._force_queries:
+            if held:
+                subscriber.commands.append(bytes([QUERY_FORCE_RAW]))
+        self._force_queries = [(subscriber, False) for subscriber, _ in self._force_queries]
+        self._commands_ready.set()
+
+    def connection_lost(self, exc):
+        self._serial = None
+        for subscriber in list(self._subscribers):
+            subscriber.transport.close()
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(exc)
+
+    def _add_subscriber(self, subscriber):
+        self._subscribers.append(subscriber)
+
+    # Turn off any streams only this subscriber was using
+    def _remove_subscriber(self, subscriber):
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+        self._force_queries = [query for query in self._force_queries if query[0] is not subscriber]
+        for toggle, users in self._stream_users.items():
+            if subscriber in users:
+                users.discard(subscriber)
+                if not users and self._serial is not None:
+                    self._serial.write(bytes([toggle]))
+                    if toggle == TOGGLE_FORCE_STREAM:
+                        self._release_force_queries()
+
+    # Command from a subscriber
+    # Stream toggles are only passed on when the shared stream needs to change
+    def _queue_command(self, subscriber, command):
+        if command[0] == QUERY_FORCE_RAW:
+            held = bool(self._stream_users[TOGGLE_FORCE_STREAM])
+            self._force_queries.append((subscriber, held))
+            if held:
+                return
+        users = self._stream_users.get(command[0])
+        if users is not None and len(command) == 1:
+            was_running = bool(users)
+            if subscriber in users:
+                users.discard(subscriber)
+            else:
+                users.add(subscriber)
+            if was_running == bool(users):
+                return
+            if command[0] == TOGGLE_FORCE_STREAM and not users:
+                subscriber.commands.append(command)
+                self._release_force_queries()
+                return
+        subscriber.commands.append(command)
+        if len(subscriber.commands) >= self.command_queue_limit and not subscriber.reading_paused:
+            subscriber.transport.pause_reading()
+            subscriber.reading_paused = True
+        self._commands_ready.set()
+
+    # Sends queued commands round robin, paced to the link rate
+    async def _pump_commands(self):
+        # Bytes the link carries in 5ms - at least one servo command
+        budget = max(2, int(self.baudrate / 10 * 0.005)) if self.baudrate else 4096
+        turn = 0
+        while True:
+            await self._commands_ready.wait()
+            waiting = [s for s in self._subscribers if s.commands]
+            if not waiting:
+                self._commands_ready.clear()
+                continue
+            # Start with a different subscriber each time
+            turn = (turn + 1) % len(waiting)
+            waiting = waiting[turn:] + waiting[:turn]
+            out = bytearray()
+            while waiting and len(out) < budget:
+                for subscriber in list(waiting):
+                    if not subscriber.commands:
+                        waiting.remove(subscriber)
+                        continue
+                    out += subscriber.commands.popleft()
+                    self.commands_sent += 1
+                    if subscriber.reading_paused and len(subscriber.commands) <= self.command_queue_limit // 2:
+                        subscriber.transport.resume_reading()
+                        subscriber.reading_paused = False
+                    if len(out) >= budget:
+                        break
+            if self._serial is None:
+                return
+            self._serial.write(bytes(out))
+            self.bytes_sent += len(out)
+            # Wait while the bytes are transmitted so commands queue here, where they are fair
+            await asyncio.sleep(len(out) * 10.0 / self.baudrate if self.baudrate else 0)
+
+    def stats(self):
+        return {
+            'subscribers': len(self._subscribers),
+            'messages_received': self.messages_received,
+            'commands_sent': self.commands_sent,
+            'bytes_sent': self.bytes_sent,
+            'messages_dropped': sum(s.dropped_total for s in self._subscribers),
+            }
+
+
+# Connection from a BrokerClient to the broker
+# Acts as the HandClient's transport - writes are sent as command frames
+class _BrokerConnection(asyncio.Protocol):
+    def __init__(self, client, subscribe):
+        self._client = client
+        self._subscribe = subscribe
+        self._frames = FrameReader()
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        transport.write(encode_frame(FRAME_SUBSCRIBE, bytes([self._subscribe])))
+        self._client.connection_made(self)
+
+    def data_received(self, data):
+        for kind, payload in self._frames.feed(data):
+            if kind == FRAME_DEVICE:
+                self._client.data_received(payload)
+            elif kind == FRAME_DROPPED:
+                self._client.dropped_messages += _dropped_struct.unpack(payload)[0]
+
+    def connection_lost(self, exc):
+        self._client.connection_lost(exc)
+
+    # Transport methods used by HandClient
+    def write(self, data):
+        self._transport.write(encode_frame(FRAME_COMMAND, data))
+
+    def is_closing(self):
+        return self._transport.is_closing()
+
+    def close(self):
+        self._transport.close()
+
+
+# HandClient connected through a broker
+# address is "host:port" for TCP or "unix:path" for a Unix socket
+# subscribe is a mask of SUBSCRIBE_* groups to receive
+class BrokerClient(HandClient):
+    def __init__(self, address, subscribe=SUBSCRIBE_ALL, reply_timeout=2.0, force_queue_size=1000):
+        super().__init__(address, None, reply_timeout, force_queue_size)
+        self.subscribe = subscribe
+        # Force messages the broker dropped because this client was too slow
+        self.dropped_messages = 0
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._closed = loop.create_future()
+        self._decoder.reset()
+        factory = lambda: _BrokerConnection(self, self.subscribe)
+        if self.port.startswith('unix:'):
+            await loop.create_unix_connection(factory, self.port[len('unix:'):])
+        else:
+            host, _, port = self.port.rpartition(':')
+            await loop.create_connection(factory, host or '127.0.0.1', int(port))
+
+
+async def _serve(args):
+    emulator = None
+    port = args.port
+    if args.emulate:
+        from hand_emulator import HandFirmware, PtyHandEmulator
+        emulator = PtyHandEmulator(HandFirmware(), baudrate=args.baudrate)
+        emulator.start()
+        port = emulator.port
+    broker = HandBroker(port, args.baudrate, args.queue_limit, args.drop_policy)
+    try:
+        await broker.open()
+        print(f"Broker serving {port}")
+        if args.unix:
+            await broker.serve_unix(args.unix)
+            print(f"  framed clients : unix:{args.unix}")
+        if args.tcp is not None:
+            server = await broker.serve_tcp(port=args.tcp)
+            print(f"  framed clients : 127.0.0.1:{server.sockets[0].getsockname()[1]}")
+        if args.raw_tcp is not None:
+            server = await broker.serve_tcp(port=args.raw_tcp, raw=True)
+            print(f"  raw clients    : socket://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            print(broker.stats())
+    finally:
+        await broker.close()
+        if emulator is not None:
+            emulator.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share one hand between several programs")
+    parser.add_argument("port", nargs='?', help="Serial port of the hand")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--emulate", action="store_true", help="Use an emulated hand on a pty instead of a port")
+    parser.add_argument("--unix", help="Unix socket path for framed clients")
+    parser.add_argument("--tcp", type=int, help="Localhost TCP port for framed clients (0 for any)")
+    parser.add_argument("--raw-tcp", type=int, help="Localhost TCP port for raw byte stream clients (0 for any)")
+    parser.add_argument("--queue-limit", type=int, default=1000, help="Force messages held back per slow client")
+    parser.add_argument("--drop-policy", choices=drop_policies, default='oldest')
+    parser.add_argument("--stats-interval", type=float, default=10.0, help="Seconds between statistics printouts")
+    args = parser.parse_args()
+    if not args.port and not args.emulate:
+        parser.error("Give a port or --emulate")
+    if args.unix is None and args.tcp is None and args.raw_tcp is None:
+        args.tcp = 8765
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,292 @@
+# Asynchronous I/O
+import asyncio
+from collections import deque
+# pySerial
+import serial
+# Threading (fallback reader for ports without a file descriptor)
+from threading import Thread
+# Hand serial protocol
+from hand_protocol import (MessageDecoder, CommandBuffer, AllServoPositions, AllServoLimits,
+    RawForce, RawForceBlock, QUERY_ALL_POSITIONS, QUERY_ALL_LIMITS, QUERY_FORCE_RAW,
+    TOGGLE_FORCE_STREAM, TOGGLE_FORCE_BLOCK_STREAM,
+    encode_servo_command, encode_config_command)
+
+"""
+
+Headless asyncio client for the hand - no tkinter required
+
+Example:
+    async with HandClient("/dev/ttyACM0") as client:
+        positions = await client.query_positions()
+        await client.set_servo(0, 90)
+        async for reading in client.force_stream():
+            print(reading.timestamp, reading.raw_force)
+
+The protocol has no request ids, so replies are matched to requests by
+type in the order the requests were sent. Several queries can be in flight
+at once - each one is resolved by the next reply of its type.
+A force query reply cannot be told apart from a streamed reading, so
+query_force() refuses to run while the force stream is enabled - read
+force_stream() instead.
+
+"""
+
+# asyncio transport for a pySerial port
+# Uses the event loop's reader on the port file descriptor where possible,
+# otherwise (e.g. Windows, loop:// urls) reads from a background thread
+class SerialTransport(asyncio.Transport):
+    def __init__(self, loop, protocol, ser):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._ser = ser
+        self._closing = False
+        self._reader_fd = None
+        self._reader_thread = None
+        try:
+            fd = ser.fileno()
+            ser.timeout = 0     # Non-blocking reads - only called when data is ready
+            loop.add_reader(fd, self._read_ready)
+            self._reader_fd = fd
+        except (AttributeError, NotImplementedError, serial.SerialException, OSError):
+            ser.timeout = 0.1   # Thread checks for closing at this interval
+            self._reader_thread = Thread(target=self._read_thread, daemon=True)
+            self._reader_thread.start()
+        loop.call_soon(protocol.connection_made, self)
+
+    # Event loop reader callback
+    def _read_ready(self):
+        try:
+            data = self._ser.read(self._ser.in_waiting or 1)
+        except serial.SerialException as e:
+            self._fatal_error(e)
+            return
+        if data:
+            self._protocol.data_received(data)
+
+    # Background reader thread function
+    def _read_thread(self):
+        while not self._closing:
+            try:
+                data = self._ser.read(self._ser.in_waiting or 1)
+            except (serial.SerialException, TypeError, AttributeError) as e:
+                if not self._closing:
+                    self._loop.call_soon_threadsafe(self._fatal_error, e)
+                return
+            if data:
+                self._loop.call_soon_threadsafe(self._protocol.data_received, data)
+
+    def _fatal_error(self, exc):
+        if not self._closing:
+            self._close(exc)
+
+    def write(self, data):
+        if self._closing:
+            raise ConnectionError("Serial transport is closed")
+        self._ser.write(data)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if not self._closing:
+            self._close(None)
+
+    def _close(self, exc):
+        self._closing = True
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+        if self._reader_thread is not None:
+            self._reader_thread.join()
+        self._ser.close()
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'serial':
+            return self._ser
+        return default
+
+
+# Client for a single hand
+class HandClient(asyncio.Protocol):
+    def __init__(self, port, baudrate=9600, reply_timeout=2.0, force_queue_size=1000):
+        self.port = port
+        self.baudrate = baudrate
+        self.reply_timeout = reply_timeout
+        self._force_queue_size = force_queue_size
+        self._transport = None
+        self._decoder = MessageDecoder()
+        # Futures waiting for a reply, oldest first, keyed by reply type
+        self._pending = {
+            AllServoPositions: deque(),
+            AllServoLimits: deque(),
+            RawForce: deque(),
+            }
+        # Queues of force stream iterators and firmware stream state, keyed by message type
+        self._force_subscribers = {RawForce: set(), RawForceBlock: set()}
+        self._force_stream_enabled = {RawForce: False, RawForceBlock: False}
+        # Callables passed every decoded message (e.g. device strings)
+        self._message_handlers = []
+        self._closed = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Open the serial port
+    # port may be a pySerial url or an already open serial object (e.g. hand_emulator.EmulatedSerial)
+    # The firmware starts with the force stream disabled
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        if isinstance(self.port, str):
+            ser = serial.serial_for_url(self.port, baudrate=self.baudrate)
+        else:
+            ser = self.port
+        self._closed = loop.create_future()
+        self._decoder.reset()
+        SerialTransport(loop, self, ser)
+        # Wait for connection_made
+        await asyncio.sleep(0)
+
+    # Close the serial port and fail any outstanding queries
+    async def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            await self._closed
+
+    @property
+    def is_open(self):
+        return self._transport is not None
+
+    # Register a callable to be passed every decoded message
+    def add_message_handler(self, handler):
+        self._message_handlers.append(handler)
+
+    def remove_message_handler(self, handler):
+        self._message_handlers.remove(handler)
+
+    # asyncio.Protocol callbacks
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        for message in self._decoder.feed(data):
+            self._handle_message(message)
+
+    def connection_lost(self, exc):
+        self._transport = None
+        error = ConnectionError("Connection to hand closed")
+        for waiting in self._pending.values():
+            while waiting:
+                future = waiting.popleft()
+                if not future.done():
+                    future.set_exception(error)
+        for message_type, subscribers in self._force_subscribers.items():
+            for queue in subscribers:
+                self._put_dropping_oldest(queue, None)
+            self._force_stream_enabled[message_type] = False
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(exc)
+
+    # Resolve the oldest query waiting for this reply type and pass on the message
+    def _handle_message(self, message):
+        waiting = self._pending.get(type(message))
+        while waiting:
+            future = waiting.popleft()
+            if not future.done():
+                future.set_result(message)
+                break
+        subscribers = self._force_subscribers.get(type(message))
+        if subscribers:
+            for queue in subscribers:
+                self._put_dropping_oldest(queue, message)
+        for handler in self._message_handlers:
+            handler(message)
+
+    # Full queues drop their oldest item so slow consumers never block the reader
+    @staticmethod
+    def _put_dropping_oldest(queue, item):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    # Send raw command bytes straight away, without waiting for a reply
+    # Not a coroutine, so several hands can be written to in one pass (multi_hand.py)
+    def write(self, data):
+        if self._transport is None:
+            raise ConnectionError("Hand is not connected")
+        self._transport.write(data)
+
+    # Send a query and wait for the reply of the given type
+    async def _request(self, command, reply_type):
+        future = asyncio.get_running_loop().create_future()
+        waiting = self._pending[reply_type]
+        waiting.append(future)
+        try:
+            self.write(bytes([command]))
+            return await asyncio.wait_for(future, self.reply_timeout)
+        finally:
+            # Timed out or cancelled - a late reply goes to the next query instead
+            if future in waiting:
+                waiting.remove(future)
+
+    # Returns tuple of current positions for servos 0 to 4
+    async def query_positions(self):
+        message = await self._request(QUERY_ALL_POSITIONS, AllServoPositions)
+        return message.positions
+
+    # Returns tuple of (min, max) limits for servos 0 to 4
+    async def query_limits(self):
+        message = await self._request(QUERY_ALL_LIMITS, AllServoLimits)
+        return message.limits
+
+    # Returns a RawForce reading
+    # Raises RuntimeError while the force stream is enabled, as the reply would be
+    # matched with whichever streamed reading arrived first
+    async def query_force(self):
+        if self._force_stream_enabled[RawForce]:
+            raise RuntimeError("query_force cannot be used while the force stream is enabled - read force_stream() instead")
+        return await self._request(QUERY_FORCE_RAW, RawForce)
+
+    # Move a single servo (0-4) to a position (0-255, limited by the hand)
+    async def set_servo(self, servo, position):
+        self.write(encode_servo_command(servo, position))
+
+    # Move several servos with a single write - None leaves a servo unchanged
+    async def set_pose(self, positions):
+        commands = CommandBuffer()
+        commands.set_pose(positions)
+        commands.flush(self.write)
+
+    # Set all servos to a preset configuration (0-127)
+    async def set_config(self, config):
+        self.write(encode_config_command(config))
+
+    # Enable or disable the force data stream
+    # blocks selects the stream of RawForceBlock messages instead of single readings
+    async def set_force_stream(self, enabled, blocks=False):
+        message_type = RawForceBlock if blocks else RawForce
+        if enabled != self._force_stream_enabled[message_type]:
+            self.write(bytes([TOGGLE_FORCE_BLOCK_STREAM if blocks else TOGGLE_FORCE_STREAM]))
+            self._force_stream_enabled[message_type] = enabled
+
+    # Async iterator over streamed force readings (RawForce, or RawForceBlock if blocks is True)
+    # The stream is enabled while at least one iterator is running
+    async def force_stream(self, blocks=False):
+        subscribers = self._force_subscribers[RawForceBlock if blocks else RawForce]
+        queue = asyncio.Queue(self._force_queue_size)
+        subscribers.add(queue)
+        try:
+            await self.set_force_stream(True, blocks)
+            while True:
+                reading = await queue.get()
+                if reading is None:     # Connection closed
+                    return
+                yield reading
+        finally:
+            subscribers.discard(queue)
+            if not subscribers and self._transport is not None:
+                await self.set_force_stream(False, blocks)
@@ -0,0 +1,452 @@
+import argparse
+import math
+import os
+import random
+import select
+import time
+# Threading
+from threading import Thread, Condition
+# Hand serial protocol
+from hand_protocol import (servo_count, CMD_CONFIG_START,
+    QUERY_ALL_POSITIONS, QUERY_ALL_LIMITS, QUERY_FORCE_RAW, TOGGLE_FORCE_STREAM,
+    TOGGLE_FORCE_BLOCK_STREAM, encode_string_message, encode_all_positions_message,
+    encode_all_limits_message, encode_raw_force_message, encode_raw_force_block_message)
+
+"""
+
+Software emulator of the hand firmware (hand_software/hand_software.ino)
+Used to run and benchmark the computer scripts without an Arduino
+
+The emulator can be served over:
+    A pty pair (Linux/macOS) - connect to PtyHandEmulator.port like a normal serial port
+    An in-process serial object - EmulatedSerial has the pySerial read/write interface
+        pySerial's loop:// url echoes writes back to the writer, so it cannot
+        carry two directions of traffic - EmulatedSerial is used instead
+
+Run from the command line to serve an emulated hand on a pty:
+    python hand_emulator.py --baudrate 9600 --max-rate
+Add --spring-contact to simulate the fingers closing on an object (SpringContactModel)
+
+"""
+
+# Preset configurations (ServoConfig.h)
+servo_configurations = [
+    [0, 0, 0, 0, 0],            # Zeros
+    [0, 36, 72, 98, 134],       # Ascending
+    [180, 134, 98, 72, 36],     # Descending
+    [0, 180, 0, 180, 0]         # Alternating
+    ]
+
+# Readings per force block (Defines.h FORCE_BLOCK_SIZE)
+force_block_size = 16
+
+# Servo limits (ServoControl.h)
+# Order is min 0, max 0, min 1, max 1, etc
+default_servo_limits = [0, 180] * servo_count
+
+
+# Force model of fingers closing on a springy object
+# Servos move towards their commanded positions at slew_rate (degrees/s) as real
+# servos do. Once a finger passes contact_position the object pushes back with
+# stiffness force units per degree - the reading is the mean over the fingers
+# plus baseline and noise
+class SpringContactModel:
+    def __init__(self, contact_position=90, stiffness=8.0, baseline=50, servos=(0, 1, 2, 3),
+                 slew_rate=300.0, noise=2.0, seed=None):
+        self.contact_position = contact_position
+        self.stiffness = stiffness
+        self.baseline = baseline
+        self.servos = servos
+        self.slew_rate = slew_rate
+        self.noise = noise
+        self._random = random.Random(seed)
+        self._actual = None
+        self._last_time = None
+
+    # Current (simulated) servo positions
+    @property
+    def actual_positions(self):
+        return list(self._actual) if self._actual is not None else None
+
+    def __call__(self, t, positions):
+        if self._actual is None:
+            self._actual = [float(p) for p in positions]
+        else:
+            step = self.slew_rate * max(t - self._last_time, 0.0)
+            for i, target in enumerate(positions):
+                self._actual[i] += min(max(target - self._actual[i], -step), step)
+        self._last_time = t
+        penetration = sum(max(0.0, self._actual[s] - self.contact_position) for s in self.servos) / len(self.servos)
+        return self.baseline + self.stiffness * penetration + self._random.gauss(0.0, self.noise)
+
+
+# Protocol state machine of the firmware
+# receive() takes bytes sent by the computer and returns the bytes the hand sends back
+# clock_skew_ppm makes millis() run fast (positive) or slow like an inexact crystal, and
+# start_millis starts the counter part way through, e.g. just before it wraps
+class HandFirmware:
+    def __init__(self, debug_only=True, servo_limits=None, force_model=None, clock=time.monotonic,
+                 clock_skew_ppm=0.0, start_millis=0):
+        # Defines.h DEBUG_ONLY - send debug strings when servos are moved
+        self.debug_only = debug_only
+        self.servo_limits = list(servo_limits or default_servo_limits)
+        self.servo_positions = [0] * servo_count
+        # Force reading as a function of (time in seconds, servo positions)
+        # Default is the GENERATE_FALSE_FORCE_DATA sine wave
+        self.force_model = force_model
+        self.force_stream = False
+        self.force_block_stream = False
+        self._clock = clock
+        self._start_time = clock()
+        self._clock_rate = 1.0 + clock_skew_ppm * 1e-6
+        self._start_millis = start_millis
+        # Servo command waiting for its position byte
+        self._pending_servo = None
+        # Readings waiting to be sent as a block - (timestamp, reading)
+        self._block = []
+
+    # Milliseconds since start, wrapping like the Arduino millis() counter
+    def millis(self):
+        return (int((self._clock() - self._start_time) * self._clock_rate * 1000) + self._start_millis) & 0xFFFFFFFF
+
+    # Output of setup()
+    def boot(self):
+        return self._set_all_servo_positions([0] * servo_count)
+
+    # Process received bytes, returns bytes to send
+    def receive(self, data):
+        out = bytearray()
+        for byte in data:
+            out += self._receive_byte(byte)
+        return bytes(out)
+
+    def _receive_byte(self, byte):
+        # Second byte of individual servo command
+        if self._pending_servo is not None:
+            servo = self._pending_servo
+            self._pending_servo = None
+            if servo > servo_count - 1:
+                # Firmware writes outside its arrays here - emulator ignores the command
+                return b''
+            return self._set_servo_position(servo, byte)
+
+        if (byte >> 3) == 0b00000:          # Individual servo control
+            self._pending_servo = byte
+            if byte > servo_count - 1:
+                return encode_string_message(f"Error: invalid servo selected : {byte}")
+            return b''
+        elif byte == QUERY_ALL_POSITIONS:
+            return encode_all_positions_message(self.servo_positions)
+        elif byte == QUERY_ALL_LIMITS:
+            return encode_all_limits_message(self.servo_limits)
+        elif byte == QUERY_FORCE_RAW:
+            return self.force_frame()
+        elif byte == TOGGLE_FORCE_STREAM:
+            self.force_stream = not self.force_stream
+            return b''
+        elif byte == TOGGLE_FORCE_BLOCK_STREAM:
+            self.force_block_stream = not self.force_block_stream
+            if not self.force_block_stream:
+                return self.send_block()
+            return b''
+        elif (byte >> 7) == 1:              # Preset configuration
+            out = b''
+            config = byte - CMD_CONFIG_START
+            if config >= len(servo_configurations):
+                out += encode_string_message(f"Invalid servo configuration: {config} - setting to 0")
+                config = 0
+            return out + self._set_all_servo_positions(servo_configurations[config])
+        else:
+            return encode_string_message(f"Error: invalid command received : {byte:b}")
+
+    # Limit a position to the range allowed for a servo
+    def _limit(self, servo, position):
+        return min(max(position, self.servo_limits[2*servo]), self.servo_limits[2*servo+1])
+
+    def _set_servo_position(self, servo, position):
+        position = self._limit(servo, position)
+        self.servo_positions[servo] = position
+        if self.debug_only:
+            return encode_string_message(f"Servo {servo} set to {position}")
+        return b''
+
+    def _set_all_servo_positions(self, positions):
+        for i in range(servo_count):
+            self.servo_positions[i] = self._limit(i, positions[i])
+        if self.debug_only:
+            values = "".join(f"{p} " for p in self.servo_positions)
+            return encode_string_message("Servo positions set as follows: " + values)
+        return b''
+
+    # Take a force reading, returns (timestamp, reading)
+    def read_force(self):
+        timestamp = self.millis()
+        if self.force_model is None:
+            reading = math.sin(timestamp / 1000.0) * 512 + 512
+        else:
+            reading = self.force_model(timestamp / 1000.0, self.servo_positions)
+        return timestamp, min(max(int(reading), 0), 0xFFFF)
+
+    # Take a force reading and return the timestamped reading message
+    def force_frame(self):
+        return encode_raw_force_message(*self.read_force())
+
+    # Take a force reading and add it to the block (Sensor::addReadingToBlock)
+    # Returns the block message when the block is sent, otherwise no bytes
+    def add_block_reading(self):
+        out = b''
+        timestamp, reading = self.read_force()
+        if self._block and (timestamp - self._block[-1][0]) & 0xFFFFFFFF > 255:
+            out += self.send_block()
+        self._block.append((timestamp, reading))
+        if len(self._block) == force_block_size:
+            out += self.send_block()
+        return out
+
+    # Return the message for any readings waiting in the block
+    def send_block(self):
+        if not self._block:
+            return b''
+        timestamps = [t for t, _ in self._block]
+        deltas = [0] + [(b - a) & 0xFFFFFFFF for a, b in zip(timestamps, timestamps[1:])]
+        message = encode_raw_force_block_message(timestamps[0], deltas, [r for _, r in self._block])
+        self._block = []
+        return message
+
+
+# Runs a HandFirmware in a background thread, mimicking the firmware loop()
+# Output is paced to the baud rate (10 bits per byte) unless baudrate is None
+# stream_interval is the delay between streamed force readings (firmware uses 100 ms)
+# and block_interval the delay between readings in the block stream (firmware uses 10 ms)
+# - set to 0 for max rate mode, where readings are sent as fast as the link allows
+# jitter is the mean of a random (exponential) delay added before each send, as
+# USB polling and OS scheduling add on a real link
+class _EmulatorRunner:
+    def __init__(self, firmware=None, baudrate=9600, stream_interval=0.1, block_interval=0.01, jitter=0.0, seed=None):
+        self.firmware = firmware or HandFirmware()
+        self.baudrate = baudrate
+        self.stream_interval = stream_interval
+        self.block_interval = block_interval
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.bytes_sent = 0
+        self.force_frames_sent = 0
+        self.block_readings_taken = 0
+        self._running = False
+        self._thread = None
+        self._tx_time = 0.0     # Time the last byte sent finishes transmitting
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stop()
+
+    # Link specific - return received bytes, waiting up to timeout seconds
+    def _device_read(self, timeout):
+        raise NotImplementedError
+
+    # Link specific - send bytes to the computer
+    def _device_write(self, data):
+        raise NotImplementedError
+
+    # Send bytes, holding them back until they would have finished transmitting
+    def _send(self, data):
+        if not data:
+            return
+        if self.jitter:
+            time.sleep(self._random.expovariate(1.0 / self.jitter))
+        if self.baudrate:
+            now = time.perf_counter()
+            self._tx_time = max(self._tx_time, now) + len(data) * 10.0 / self.baudrate
+            delay = self._tx_time - now
+            if delay > 0:
+                time.sleep(delay)
+        self._device_write(data)
+        self.bytes_sent += len(data)
+
+    def _run(self):
+        firmware = self.firmware
+        self._send(firmware.boot())
+        next_reading = next_block_reading = time.perf_counter()
+        while self._running:
+            # Wait for commands until the next reading is due
+            timeout = 0.05
+            now = time.perf_counter()
+            if firmware.force_stream:
+                timeout = min(timeout, next_reading - now)
+            if firmware.force_block_stream:
+                timeout = min(timeout, next_block_reading - now)
+            data = self._device_read(max(0.0, timeout))
+            if data:
+                self._send(firmware.receive(data))
+            now = time.perf_counter()
+            if not firmware.force_stream:
+                next_reading = now
+            elif now >= next_reading:
+                self._send(firmware.force_frame())
+                self.force_frames_sent += 1
+                next_reading = max(next_reading + self.stream_interval, now)
+            if not firmware.force_block_stream:
+                next_block_reading = now
+            elif now >= next_block_reading:
+                self._send(firmware.add_block_reading())
+                self.block_readings_taken += 1
+                next_block_reading = max(next_block_reading + self.block_interval, now)
+
+
+# Emulated hand served on a pseudo-terminal pair
+# Open PtyHandEmulator.port with pySerial as if it were the Arduino
+class PtyHandEmulator(_EmulatorRunner):
+    def __init__(self, firmware=None, baudrate=9600, stream_interval=0.1, block_interval=0.01, jitter=0.0, seed=None):
+        super().__init__(firmware, baudrate, stream_interval, block_interval, jitter, seed)
+        import tty
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+
+    def close(self):
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _device_read(self, timeout):
+        readable, _, _ = select.select([self._master], [], [], timeout)
+        if readable:
+            return os.read(self._master, 4096)
+        return b''
+
+    # Waits while the pty buffer is full (computer not reading) until stopped
+    def _device_write(self, data):
+        view = memoryview(data)
+        while view and self._running:
+            _, writable, _ = select.select([], [self._master], [], 0.1)
+            if writable:
+                written = os.write(self._master, view)
+                view = view[written:]
+
+
+# Emulated hand connected to an in-process serial object
+class MemoryHandEmulator(_EmulatorRunner):
+    def __init__(self, firmware=None, baudrate=9600, stream_interval=0.1, block_interval=0.01, jitter=0.0, seed=None):
+        super().__init__(firmware, baudrate, stream_interval, block_interval, jitter, seed)
+        self.serial = EmulatedSerial(self)
+        self._to_device = bytearray()
+        self._lock = Condition()
+
+    # Called by EmulatedSerial.write
+    def _host_write(self, data):
+        with self._lock:
+            self._to_device += data
+            self._lock.notify_all()
+
+    def _device_read(self, timeout):
+        with self._lock:
+            if not self._to_device:
+                self._lock.wait(timeout)
+            data = bytes(self._to_device)
+            self._to_device.clear()
+        return data
+
+    def _device_write(self, data):
+        self.serial._device_write(data)
+
+
+# Host end of a MemoryHandEmulator with the parts of the pySerial interface used by the scripts
+class EmulatedSerial:
+    def __init__(self, emulator):
+        self._emulator = emulator
+        self._from_device = bytearray()
+        self._lock = Condition()
+        self.timeout = 1
+        self.is_open = True
+        self.port = "emulator"
+
+    @property
+    def in_waiting(self):
+        return len(self._from_device)
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        with self._lock:
+            self._lock.notify_all()
+
+    def write(self, data):
+        self._emulator._host_write(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Read up to size bytes, waiting up to timeout for at least one
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._lock:
+            while not self._from_device and self.is_open:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            data = bytes(self._from_device[:size])
+            del self._from_device[:size]
+        return data
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._from_device.clear()
+
+    def _device_write(self, data):
+        with self._lock:
+            self._from_device += data
+            self._lock.notify_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve an emulated hand on a pty")
+    parser.add_argument("--baudrate", type=int, default=9600, help="Baud rate to throttle output to (0 for unthrottled)")
+    parser.add_argument("--max-rate", action="store_true", help="Stream force readings and blocks as fast as the link allows")
+    parser.add_argument("--no-debug", action="store_true", help="Disable DEBUG_ONLY strings")
+    parser.add_argument("--spring-contact", action="store_true", help="Simulate fingers closing on a springy object")
+    parser.add_argument("--clock-skew-ppm", type=float, default=0.0, help="Make millis() run fast (positive) or slow")
+    parser.add_argument("--start-millis", type=int, default=0, help="millis() value at start (4294960000 wraps after ~7 s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Mean random delay before each send (s)")
+    args = parser.parse_args()
+
+    firmware = HandFirmware(debug_only=not args.no_debug,
+                            force_model=SpringContactModel() if args.spring_contact else None,
+                            clock_skew_ppm=args.clock_skew_ppm, start_millis=args.start_millis)
+    emulator = PtyHandEmulator(firmware, baudrate=args.baudrate or None,
+                               stream_interval=0 if args.max_rate else 0.1,
+                               block_interval=0 if args.max_rate else 0.01,
+                               jitter=args.jitter)
+    print(f"Emulated hand on {emulator.port} - Ctrl+C to stop")
+    with emulator:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
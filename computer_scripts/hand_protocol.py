@@ -0,0 +1,409 @@
+# Converting struct data
+import struct
+from collections import namedtuple
+# Threading
+from threading import Lock
+
+"""
+
+Serial protocol used by the hand firmware (see hand_software/SendMessage.h
+and hand_software/hand_software.ino)
+This module has no GUI or serial port dependencies so it can be used by
+scripts and tested against recorded byte streams
+
+Messages sent by the hand:
+    If first bit is 1 then message is string
+        Remaining bits specify string length - 1
+        Next [length] bytes are characters
+    If first 5 bits are 0 then message is for servo position
+        Remaining bits specify which servo
+        Next byte specifies position
+    If message is 0b00001000 then message is for all servo positions
+        Next 5 bytes are position for servos 0 to 4
+    If message is 0b00001001 then message is for all servo limits
+        Next 10 bytes specify limits
+        Order is min 0, max 0, min 1, max 1, etc
+    If message is 0b00001010 then message is raw force reading
+        Next 6 bytes are a little endian unsigned long timestamp
+        followed by an unsigned short reading
+    If message is 0b00001011 then message is a block of raw force readings
+        Next byte is the number of readings N
+        Next 4 bytes are the little endian timestamp of the first reading
+        Next N * 3 bytes are, for each reading, milliseconds since the
+        previous reading (1 byte) followed by an unsigned short reading
+
+"""
+
+servo_count = 5
+
+# Message opcodes sent by the hand
+MSG_CHAR_ARRAY_START = 0b10000000
+MSG_SERVO_POSITION_START = 0b00000000
+MSG_ALL_POSITIONS = 0b00001000
+MSG_ALL_LIMITS = 0b00001001
+MSG_FORCE_RAW = 0b00001010
+MSG_FORCE_RAW_BLOCK = 0b00001011
+
+# Command bytes sent to the hand
+CMD_SERVO_START = 0b00000000
+CMD_CONFIG_START = 0b10000000
+QUERY_ALL_POSITIONS = 0b00001000
+QUERY_ALL_LIMITS = 0b00001001
+QUERY_FORCE_RAW = 0b00001010
+TOGGLE_FORCE_STREAM = 0b00001011
+TOGGLE_FORCE_BLOCK_STREAM = 0b00001100
+
+_raw_force_struct = struct.Struct('<LH')
+_block_header_struct = struct.Struct('<BL')     # Reading count, first timestamp
+
+# Command encoding
+# Individual servo control : 0000 0 [3:servo]  [8:position]
+# Pre-set configuration    : 1 [7:configuration]
+def encode_servo_command(servo, position):
+    if not 0 <= servo < servo_count:
+        raise ValueError(f"Servo must be 0 to {servo_count - 1}, got {servo}")
+    if not 0 <= position <= 255:
+        raise ValueError(f"Servo position must be 0 to 255, got {position}")
+    return bytes([CMD_SERVO_START | servo, position])
+
+def encode_config_command(config):
+    if not 0 <= config <= 127:
+        raise ValueError(f"Configuration must be 0 to 127, got {config}")
+    return bytes([CMD_CONFIG_START | config])
+
+# Length of the command starting with this byte (servo commands are 2 bytes)
+def command_length(first_byte):
+    if first_byte & CMD_CONFIG_START:
+        return 1
+    if first_byte < 8:
+        return 2
+    return 1
+
+# Collects commands so they can be sent in a single write
+# Commands still waiting to be sent are dropped when a later command makes them
+# redundant - a servo command replaces an earlier one for the same servo, and a
+# configuration replaces earlier configurations and all earlier servo commands
+# Queries and other commands are always sent, in order
+class CommandBuffer:
+    def __init__(self):
+        # Key -> command bytes, in send order
+        # Servo commands use the servo number as key so they can be replaced
+        self._pending = {}
+        self._next_key = 0
+        self._lock = Lock()
+        # Statistics
+        self.commands_queued = 0
+        self.commands_sent = 0
+        self.commands_coalesced = 0
+        self.bytes_sent = 0
+        self.bytes_coalesced = 0
+        self.writes = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Queue a command, replacing any waiting command with the same key
+    def _queue(self, key, command):
+        with self._lock:
+            replaced = self._pending.pop(key, None)
+            if replaced is not None:
+                self.commands_coalesced += 1
+                self.bytes_coalesced += len(replaced)
+            self._pending[key] = command
+            self.commands_queued += 1
+
+    # Queue a command that is never replaced
+    def add(self, command):
+        with self._lock:
+            key = ('command', self._next_key)
+            self._next_key += 1
+        self._queue(key, bytes(command))
+
+    def set_servo(self, servo, position):
+        self._queue(('servo', servo), encode_servo_command(servo, position))
+
+    # Queue commands for several servos - None leaves a servo unchanged
+    def set_pose(self, positions):
+        for servo, position in enumerate(positions):
+            if position is not None:
+                self.set_servo(servo, position)
+
+    def set_config(self, config):
+        with self._lock:
+            for key in [key for key in self._pending if key[0] in ('servo', 'config')]:
+                replaced = self._pending.pop(key)
+                self.commands_coalesced += 1
+                self.bytes_coalesced += len(replaced)
+        self._queue(('config',), encode_config_command(config))
+
+    # Remove and return all waiting commands as one bytes object
+    def take(self):
+        with self._lock:
+            commands = list(self._pending.values())
+            self._pending.clear()
+        data = b''.join(commands)
+        self.commands_sent += len(commands)
+        self.bytes_sent += len(data)
+        return data
+
+    # Send all waiting commands with a single call to write (e.g. serial.Serial.write)
+    # Returns the number of bytes written
+    def flush(self, write):
+        data = self.take()
+        if data:
+            write(data)
+            self.writes += 1
+        return len(data)
+
+    def stats(self):
+        return {
+            'commands_queued': self.commands_queued,
+            'commands_sent': self.commands_sent,
+            'commands_coalesced': self.commands_coalesced,
+            'bytes_sent': self.bytes_sent,
+            'bytes_coalesced': self.bytes_coalesced,
+            'writes': self.writes,
+            }
+
+# Message encoding (as sent by the hand)
+# Strings are split into 128-character chunks as in Send::sendString
+def encode_string_message(text):
+    chars = text.encode('ascii', errors='replace')
+    out = bytearray()
+    for i in range(0, len(chars), 128):
+        chunk = chars[i:i+128]
+        out.append(MSG_CHAR_ARRAY_START | (len(chunk) - 1))
+        out += chunk
+    return bytes(out)
+
+def encode_servo_position_message(servo, position):
+    return bytes([MSG_SERVO_POSITION_START + servo, position])
+
+def encode_all_positions_message(positions):
+    return bytes([MSG_ALL_POSITIONS, *positions])
+
+# Limits are flat in order min 0, max 0, min 1, max 1, etc
+def encode_all_limits_message(limits):
+    return bytes([MSG_ALL_LIMITS, *limits])
+
+def encode_raw_force_message(timestamp, raw_force):
+    return bytes([MSG_FORCE_RAW]) + _raw_force_struct.pack(timestamp, raw_force)
+
+# deltas are milliseconds since the previous reading (0 for the first)
+def encode_raw_force_block_message(timestamp, deltas, raw_forces):
+    out = bytearray([MSG_FORCE_RAW_BLOCK])
+    out += _block_header_struct.pack(len(deltas), timestamp)
+    for delta, raw_force in zip(deltas, raw_forces):
+        out += struct.pack('<BH', delta, raw_force)
+    return bytes(out)
+
+# Decoded message types
+StringMessage = namedtuple('StringMessage', ['text'])
+ServoPosition = namedtuple('ServoPosition', ['servo', 'position'])
+AllServoPositions = namedtuple('AllServoPositions', ['positions'])
+AllServoLimits = namedtuple('AllServoLimits', ['limits'])      # Tuple of (min, max) per servo
+RawForce = namedtuple('RawForce', ['timestamp', 'raw_force'])
+RawForceBlock = namedtuple('RawForceBlock', ['timestamps', 'raw_forces'])     # NumPy arrays
+
+# Bytes in the frame a RawForce or RawForceBlock arrived in, e.g. for its transmission time
+def force_frame_size(message):
+    if type(message) is RawForceBlock:
+        return 1 + _block_header_struct.size + 3*len(message.raw_forces)
+    return 1 + _raw_force_struct.size
+
+
+# Frame parsers
+# Each takes the receive buffer and the index of the opcode byte
+def _parse_string(buf, pos):
+    length = (buf[pos] - MSG_CHAR_ARRAY_START) + 1
+    text = bytes(buf[pos+1:pos+1+length]).decode('ascii', errors='backslashreplace')
+    return StringMessage(text)
+
+def _parse_servo_position(buf, pos):
+    return ServoPosition(buf[pos] - MSG_SERVO_POSITION_START, buf[pos+1])
+
+def _parse_all_positions(buf, pos):
+    return AllServoPositions(tuple(buf[pos+1:pos+1+servo_count]))
+
+def _parse_all_limits(buf, pos):
+    values = buf[pos+1:pos+1+2*servo_count]
+    return AllServoLimits(tuple(zip(values[0::2], values[1::2])))
+
+def _parse_raw_force(buf, pos):
+    return RawForce(*_raw_force_struct.unpack_from(buf, pos+1))
+
+# NumPy is only imported once a block is received
+_block_reading_dtype = None
+
+def _parse_raw_force_block(buf, pos):
+    global _block_reading_dtype
+    import numpy as np
+    if _block_reading_dtype is None:
+        _block_reading_dtype = np.dtype([('delta', 'u1'), ('raw_force', '<u2')])
+    count, timestamp = _block_header_struct.unpack_from(buf, pos+1)
+    start = pos + 1 + _block_header_struct.size
+    # Copy out of the receive buffer so it can still be resized
+    readings = np.frombuffer(bytes(buf[start:start + 3*count]), dtype=_block_reading_dtype)
+    timestamps = (timestamp + np.cumsum(readings['delta'], dtype=np.int64)) & 0xFFFFFFFF
+    return RawForceBlock(timestamps, readings['raw_force'].astype(np.int64))
+
+# Size of a block frame, or None if the count byte has not arrived yet
+# The firmware never sends an empty block, so a count of 0 is a framing error
+def _raw_force_block_size(buf, pos, end):
+    if pos + 1 >= end:
+        return None
+    count = buf[pos+1]
+    if count == 0:
+        return 0
+    return 1 + _block_header_struct.size + 3*count
+
+
+# Opcode table - index is the opcode byte, value is (frame size, parser)
+# Frame size includes the opcode byte, None marks an unknown opcode
+# Variable size frames give a function (buffer, opcode index, buffer end) returning
+# the frame size, None if not enough of the frame has arrived to tell, or 0 if
+# the frame is invalid
+def _build_decode_table():
+    table = [None] * 256
+    for servo in range(8):
+        table[MSG_SERVO_POSITION_START | servo] = (2, _parse_servo_position)
+    table[MSG_ALL_POSITIONS] = (1 + servo_count, _parse_all_positions)
+    table[MSG_ALL_LIMITS] = (1 + 2*servo_count, _parse_all_limits)
+    table[MSG_FORCE_RAW] = (1 + _raw_force_struct.size, _parse_raw_force)
+    table[MSG_FORCE_RAW_BLOCK] = (_raw_force_block_size, _parse_raw_force_block)
+    for length in range(1, 129):
+        table[MSG_CHAR_ARRAY_START | (length - 1)] = (1 + length, _parse_string)
+    return table
+
+_decode_table = _build_decode_table()
+
+
+# Extends the hand's 32 bit millis() timestamps (which wrap every ~49.7 days) to
+# a count that keeps increasing
+# A step backwards of more than half the counter range is taken as a device
+# reset - the count carries on from the last timestamp as in force_recorder.elapsed_ms
+class TimestampUnwrapper:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._last_raw = None
+        self._last = 0
+        self.wraps = 0
+        self.resets = 0
+
+    def unwrap(self, timestamp):
+        if self._last_raw is None:
+            self._last_raw = self._last = timestamp
+            return timestamp
+        step = (timestamp - self._last_raw) & 0xFFFFFFFF
+        if step >= 1 << 31:
+            self.resets += 1
+            step = 0
+        elif timestamp < self._last_raw:
+            self.wraps += 1
+        self._last_raw = timestamp
+        self._last += step
+        return self._last
+
+    # Unwrap an array of timestamps in order, returns an int64 array
+    def unwrap_array(self, timestamps):
+        import numpy as np
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not len(timestamps):
+            return timestamps
+        if self._last_raw is None:
+            self._last_raw = self._last = int(timestamps[0])
+        previous = np.concatenate(((self._last_raw,), timestamps[:-1]))
+        steps = (timestamps - previous) & 0xFFFFFFFF
+        backwards = steps >= 1 << 31
+        self.resets += int(np.count_nonzero(backwards))
+        self.wraps += int(np.count_nonzero(~backwards & (timestamps < previous)))
+        steps[backwards] = 0
+        out = self._last + np.cumsum(steps)
+        self._last_raw = int(timestamps[-1])
+        self._last = int(out[-1])
+        return out
+
+
+# Incremental decoder for the byte stream sent by the hand
+# Feed it whatever the serial port returns - partial frames are kept until
+# the rest of their bytes arrive
+# With unwrap_timestamps force reading timestamps are passed through a
+# TimestampUnwrapper, so they keep increasing past the 32 bit millis() wrap
+class MessageDecoder:
+    def __init__(self, unwrap_timestamps=False):
+        self._buffer = bytearray()
+        # Number of bytes discarded because they were not a known opcode
+        self.dropped_bytes = 0
+        self.unwrapper = TimestampUnwrapper() if unwrap_timestamps else None
+
+    # Number of bytes held back waiting for the rest of a frame
+    @property
+    def pending_bytes(self):
+        return len(self._buffer)
+
+    # Discard any partially received frame (and timestamp history, for a new connection)
+    def reset(self):
+        self._buffer.clear()
+        if self.unwrapper is not None:
+            self.unwrapper.reset()
+
+    # Add received bytes and return a list of all completed messages
+    def feed(self, data):
+        return self._decode(data, False)
+
+    # As feed, but returns (message, frame bytes) pairs so frames can be passed on unchanged
+    def feed_frames(self, data):
+        return self._decode(data, True)
+
+    def _decode(self, data, keep_frames):
+        buf = self._buffer
+        buf += data
+        end = len(buf)
+        pos = 0
+        messages = []
+        table = _decode_table
+        while pos < end:
+            entry = table[buf[pos]]
+            if entry is None:
+                # Unknown opcode - skip byte and try to resynchronise on the next one
+                self.dropped_bytes += 1
+                pos += 1
+                continue
+            size, parse = entry
+            if type(size) is not int:
+                size = size(buf, pos, end)
+                if size is None:
+                    break
+                if size == 0:
+                    # Invalid frame - skip the opcode byte as for an unknown opcode
+                    self.dropped_bytes += 1
+                    pos += 1
+                    continue
+            if pos + size > end:
+                # Incomplete frame - wait for more data
+                break
+            if keep_frames:
+                messages.append((parse(buf, pos), bytes(buf[pos:pos+size])))
+            else:
+                messages.append(parse(buf, pos))
+            pos += size
+        del buf[:pos]
+        if self.unwrapper is not None:
+            self._unwrap_timestamps(messages, keep_frames)
+        return messages
+
+    # Replace force reading timestamps with unwrapped ones - frame bytes are left as received
+    def _unwrap_timestamps(self, messages, keep_frames):
+        unwrapper = self.unwrapper
+        for i, item in enumerate(messages):
+            message = item[0] if keep_frames else item
+            message_type = type(message)
+            if message_type is RawForce:
+                message = RawForce(unwrapper.unwrap(message.timestamp), message.raw_force)
+            elif message_type is RawForceBlock:
+                message = RawForceBlock(unwrapper.unwrap_array(message.timestamps), message.raw_forces)
+            else:
+                continue
+            messages[i] = (message, item[1]) if keep_frames else message
@@ -0,0 +1,64 @@
+import time
+
+"""
+
+Batches log messages for display so a high message rate cannot flood the log pane
+
+Messages can be given a key (e.g. "force" for streamed force readings). Each key
+may log up to rate_limit messages per summary_interval - any more are counted
+and replaced by a single summary line at the end of the interval.
+Identical consecutive messages in the same batch are collapsed into one line.
+
+"""
+
+class LogBatcher:
+    def __init__(self, rate_limit=20, summary_interval=1.0, clock=time.monotonic):
+        self.rate_limit = rate_limit
+        self.summary_interval = summary_interval
+        self._clock = clock
+        self._lines = []
+        self._last_text = None
+        self._repeats = 0
+        # key -> [window start time, messages in window, suppressed messages in window]
+        self._windows = {}
+
+    # Add a message to the current batch
+    def add(self, text, key=None):
+        if key is not None:
+            now = self._clock()
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = [now, 0, 0]
+            window[1] += 1
+            if window[1] > self.rate_limit:
+                window[2] += 1
+                return
+        if text == self._last_text:
+            self._repeats += 1
+            return
+        self._end_repeat()
+        self._last_text = text
+        self._lines.append(text)
+
+    def _end_repeat(self):
+        if self._repeats:
+            self._lines[-1] = f"{self._last_text} (repeated {self._repeats} more times)"
+            self._repeats = 0
+
+    # Return the lines to display and start a new batch
+    # Rate summaries are added for keys whose interval has ended
+    def drain(self):
+        self._end_repeat()
+        now = self._clock()
+        for key, window in list(self._windows.items()):
+            start, count, suppressed = window
+            elapsed = now - start
+            if elapsed < self.summary_interval:
+                continue
+            if suppressed:
+                self._lines.append(f"[{suppressed} '{key}' messages hidden - {count / elapsed:.0f} messages/s]")
+            del self._windows[key]
+        lines = self._lines
+        self._lines = []
+        self._last_text = None
+        return lines
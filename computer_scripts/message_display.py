@@ -0,0 +1,107 @@
+# Hand serial protocol
+from hand_protocol import (StringMessage, ServoPosition, AllServoPositions, AllServoLimits,
+    RawForce, RawForceBlock)
+
+"""
+
+Log text and force graph data for decoded hand messages
+
+Shared by the GUI (communication_gui.py) and the capture regression tests
+(replay_regression.py), so the same bytes are logged and graphed the same
+way in both. There is no Tk here - lines go to a log(text, key) function and
+force readings to a graph with append_data(x, y) and extend_data(xs, ys),
+as communication_gui.GraphDisplayFrame.
+
+High rate lines are logged with a key so log_batching.LogBatcher can rate
+limit them: "device" for strings from the hand, "force" for force readings
+and "contact" for contact detector events.
+The graph shows readings after the display filter, in seconds.
+
+"""
+
+# Message types with a display - others are ignored by MessageDisplay.handle
+message_types = (StringMessage, ServoPosition, AllServoPositions, AllServoLimits, RawForce, RawForceBlock)
+
+
+class MessageDisplay:
+    def __init__(self, log, graph):
+        self.log = log
+        self.graph = graph
+        # Log every force reading or block (GUI "Display force readings")
+        self.display_force_readings = False
+        # Streaming filter for displayed force readings and contact detector (None when off)
+        self.force_filter = None
+        self.contact_detector = None
+        self._handlers = {
+            StringMessage: self.show_char_array,
+            ServoPosition: self.show_servo_position,
+            AllServoPositions: self.show_all_servo_positions,
+            AllServoLimits: self.show_all_servo_limits,
+            RawForce: self.show_raw_force,
+            RawForceBlock: self.show_raw_force_block,
+            }
+
+    # Log and graph a decoded message - returns False for a type with no display
+    def handle(self, message):
+        handler = self._handlers.get(type(message))
+        if handler is None:
+            return False
+        handler(message)
+        return True
+
+    # Display a character array
+    def show_char_array(self, message):
+        self.log(f"> \"{message.text}\"", key="device")
+
+    # Display a single servo position
+    def show_servo_position(self, message):
+        self.log(f"> Servo {message.servo} position : {message.position}")
+
+    # Display all servo positions
+    def show_all_servo_positions(self, message):
+        # Positions correspond to servos 0 to 4
+        out = "Servo positions : "
+        for pos in message.positions:
+            out += f"{pos} "
+        self.log(f"> {out}")
+
+    # Display all servo limits
+    def show_all_servo_limits(self, message):
+        # Limits are (min, max) pairs for servos 0 to 4
+        out = "Servo limits : "
+        for l_min, l_max in message.limits:
+            out += f"({l_min},{l_max}) "
+        self.log(f"> {out}")
+
+    # Display a raw force reading - timestamp is in milliseconds
+    def show_raw_force(self, message):
+        timestamp, raw_force = message
+        if self.display_force_readings:
+            self.log(f"> Raw force : {raw_force} at {timestamp}", key="force")
+        if self.force_filter is None and self.contact_detector is None:
+            self.graph.append_data(timestamp/1000.0, raw_force)
+        else:
+            timestamps, values = self.filter_force((timestamp,), (raw_force,))
+            self.graph.extend_data(timestamps/1000.0, values)
+
+    # Display a block of raw force readings - added to the graph in one call
+    def show_raw_force_block(self, message):
+        timestamps, raw_forces = message
+        if self.display_force_readings:
+            self.log(f"> Raw force block : {len(raw_forces)} readings from {timestamps[0]} to {timestamps[-1]}", key="force")
+        filtered_timestamps, values = self.filter_force(timestamps, raw_forces)
+        self.graph.extend_data(filtered_timestamps/1000.0, values)
+
+    # Pass readings through the display filter and contact detector
+    # Returns the filtered (timestamps, values) as arrays
+    def filter_force(self, timestamps, raw_forces):
+        from force_filters import as_arrays
+        timestamps, values = as_arrays(timestamps, raw_forces)
+        force_filter = self.force_filter
+        if force_filter is not None:
+            timestamps, values = force_filter.process(timestamps, values)
+        detector = self.contact_detector
+        if detector is not None:
+            for event in detector.process(timestamps, values):
+                self.log(f"> {event.kind.capitalize()} at {event.timestamp} ms (force {event.value:.0f})", key="contact")
+        return timestamps, values
@@ -0,0 +1,187 @@
+import csv
+import json
+import time
+from threading import Lock
+
+"""
+
+Lightweight metrics for instrumenting hot paths
+
+A MetricsRegistry holds named counters, gauges and histograms. Histograms
+record durations in nanoseconds from time.perf_counter_ns into power of two
+buckets, so recording is a few integer operations and memory use is fixed.
+
+Timing a block of code:
+    start = metrics.start_timer()
+    ...
+    draw_time.observe_since(start)
+
+When the registry is disabled every update returns after a single attribute
+check and start_timer() does not read the clock.
+Updates are not locked - a rare lost update between threads is accepted to
+keep recording cheap.
+
+"""
+
+# Histogram bucket i holds values with bit_length i, i.e. 2**(i-1) <= value < 2**i
+_BUCKETS = 64
+
+
+# Count of events (e.g. bytes received)
+class Counter:
+    def __init__(self, registry, name):
+        self._registry = registry
+        self.name = name
+        self.value = 0
+
+    def inc(self, amount=1):
+        if self._registry.enabled:
+            self.value += amount
+
+    def reset(self):
+        self.value = 0
+
+
+# Latest value of a quantity (e.g. queue depth)
+class Gauge:
+    def __init__(self, registry, name):
+        self._registry = registry
+        self.name = name
+        self.value = 0
+
+    def set(self, value):
+        if self._registry.enabled:
+            self.value = value
+
+    def reset(self):
+        self.value = 0
+
+
+# Distribution of integer values - normally durations in nanoseconds
+class Histogram:
+    def __init__(self, registry, name, unit='ns'):
+        self._registry = registry
+        self.name = name
+        self.unit = unit
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self._buckets = [0] * _BUCKETS
+
+    def observe(self, value):
+        if not self._registry.enabled:
+            return
+        value = int(value)
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self._buckets[min(max(value, 0).bit_length(), _BUCKETS - 1)] += 1
+
+    # Record the time since start (from MetricsRegistry.start_timer)
+    def observe_since(self, start):
+        if self._registry.enabled and start:
+            self.observe(time.perf_counter_ns() - start)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else float('nan')
+
+    # Estimate of the p-th percentile - upper edge of the bucket holding it, limited to the max
+    def percentile(self, p):
+        if not self.count:
+            return float('nan')
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self._buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << index) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min if self.min is not None else float('nan'),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max if self.max is not None else float('nan'),
+            }
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = Lock()
+        self._reset_time = time.monotonic()
+
+    # Get or create metrics by name
+    def counter(self, name):
+        return self._get(self._counters, name, Counter)
+
+    def gauge(self, name):
+        return self._get(self._gauges, name, Gauge)
+
+    def histogram(self, name, unit='ns'):
+        return self._get(self._histograms, name, Histogram, unit)
+
+    def _get(self, metrics, name, metric_class, *args):
+        with self._lock:
+            metric = metrics.get(name)
+            if metric is None:
+                metric = metrics[name] = metric_class(self, name, *args)
+            return metric
+
+    # Start time for Histogram.observe_since - 0 when disabled
+    def start_timer(self):
+        return time.perf_counter_ns() if self.enabled else 0
+
+    # Clear all recorded values
+    def reset(self):
+        with self._lock:
+            for metrics in (self._counters, self._gauges, self._histograms):
+                for metric in metrics.values():
+                    metric.reset()
+            self._reset_time = time.monotonic()
+
+    # Current values of all metrics as a dictionary
+    def snapshot(self):
+        with self._lock:
+            return {
+                'time': time.time(),
+                'elapsed_s': time.monotonic() - self._reset_time,
+                'counters': {name: c.value for name, c in sorted(self._counters.items())},
+                'gauges': {name: g.value for name, g in sorted(self._gauges.items())},
+                'histograms': {name: dict(h.summary(), unit=h.unit) for name, h in sorted(self._histograms.items())},
+                }
+
+    # Write a snapshot as JSON
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    # Write a snapshot as CSV with one row per value (kind, name, field, value)
+    def dump_csv(self, path):
+        snapshot = self.snapshot()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['kind', 'name', 'field', 'value'])
+            writer.writerow(['run', 'run', 'elapsed_s', snapshot['elapsed_s']])
+            for name, value in snapshot['counters'].items():
+                writer.writerow(['counter', name, 'value', value])
+            for name, value in snapshot['gauges'].items():
+                writer.writerow(['gauge', name, 'value', value])
+            for name, summary in snapshot['histograms'].items():
+                unit = summary.pop('unit')
+                for field, value in summary.items():
+                    writer.writerow(['histogram', name, f"{field}_{unit}" if field != 'count' else field, value])
@@ -0,0 +1,149 @@
+import numpy as np
+from ring_buffer import RingBuffer
+
+"""
+
+Multi-resolution min/max history for plotting long time series
+
+Level 0 holds the newest raw samples. Each level above holds one (min, max)
+bucket for every [factor] entries of the level below, so a level covers
+[factor] times more time than the one below with the same number of entries.
+Every level is a fixed-size ring buffer - memory use is set when the
+pyramid is created and old data at each level is overwritten.
+
+Appending costs amortised O(1) per sample: a sample touches level k only
+once per factor**k samples.
+
+query() picks the finest level that can draw the requested range with about
+max_points points, so a plot renders roughly one point per horizontal pixel
+however long the visible time range is.
+
+"""
+
+# Columns stored for each entry
+_X_FIRST, _X_LAST, _Y_MIN, _Y_MAX = range(4)
+
+
+class MinMaxPyramid:
+    def __init__(self, capacity=1 << 14, factor=4, levels=8):
+        if factor < 2:
+            raise ValueError("Pyramid factor must be at least 2")
+        self.factor = factor
+        self._levels = [RingBuffer(capacity, fields=4) for _ in range(levels)]
+        # Entries of each level not yet combined into a bucket of the level above
+        self._carry = [np.empty((4, 0)) for _ in range(levels)]
+
+    def __len__(self):
+        return len(self._levels[0])
+
+    @property
+    def levels(self):
+        return len(self._levels)
+
+    # Memory used by the level buffers
+    @property
+    def memory_bytes(self):
+        return sum(level._data.nbytes for level in self._levels)
+
+    # Number of raw samples covered by one entry of each level
+    def samples_per_entry(self, level):
+        return self.factor ** level
+
+    def clear(self):
+        for level in self._levels:
+            level.clear()
+        self._carry = [np.empty((4, 0)) for _ in self._levels]
+
+    def append(self, x, y):
+        self.extend((x,), (y,))
+
+    # Add samples - x values must not decrease
+    # A step backwards (e.g. the hand restarted and its clock began again) would
+    # break the ordering queries rely on, so the history is cleared and only the
+    # samples from the step on are kept
+    def extend(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if not len(xs):
+            return
+        backwards = np.flatnonzero(xs[1:] < xs[:-1])
+        if len(backwards):
+            xs = xs[backwards[-1] + 1:]
+            ys = ys[backwards[-1] + 1:]
+            self.clear()
+        elif len(self) and xs[0] < self._levels[0].last()[_X_LAST]:
+            self.clear()
+        self._push(0, np.stack((xs, xs, ys, ys)))
+
+    def _push(self, level, entries):
+        self._levels[level].extend(*entries)
+        if level + 1 == len(self._levels):
+            return
+        carry = self._carry[level]
+        if carry.shape[1]:
+            entries = np.concatenate((carry, entries), axis=1)
+        full = entries.shape[1] - entries.shape[1] % self.factor
+        self._carry[level] = entries[:, full:]
+        if full:
+            groups = entries[:, :full].reshape(4, -1, self.factor)
+            self._push(level + 1, np.stack((
+                groups[_X_FIRST, :, 0],
+                groups[_X_LAST, :, -1],
+                groups[_Y_MIN].min(axis=1),
+                groups[_Y_MAX].max(axis=1),
+                )))
+
+    # Range of x values held (oldest, newest)
+    def x_range(self):
+        oldest = None
+        for level in self._levels:
+            if len(level):
+                x_first = level.view()[_X_FIRST][0]
+                oldest = x_first if oldest is None else min(oldest, x_first)
+        if oldest is None:
+            return None
+        return oldest, self._levels[0].last()[_X_LAST]
+
+    # Get points to plot for x0 <= x <= x1 using at most about max_points points
+    # Raw samples are returned as single points and min/max buckets as a
+    # vertical pair of points, so the plotted line shows the full envelope
+    # Returns (x, y) arrays
+    def query(self, x0, x1, max_points):
+        # Finest level that covers x0 within the point budget
+        # A level that has never been full still holds everything it was given
+        chosen = len(self._levels) - 1
+        for index, level in enumerate(self._levels):
+            if not len(level):
+                continue
+            x_first, x_last = level.view()[:2]
+            count = np.searchsorted(x_first, x1, side='right') - np.searchsorted(x_last, x0, side='left')
+            points = count if index == 0 else 2 * count
+            covers = x_first[0] <= x0 or len(level) < level.capacity
+            if covers and points <= max_points:
+                chosen = index
+                break
+
+        # Chosen level lags behind the newest data by its carried entries,
+        # so the tail is filled in from the finer levels below it
+        xs, ys = [], []
+        after = -np.inf
+        for index in range(chosen, -1, -1):
+            level = self._levels[index]
+            if not len(level):
+                continue
+            x_first, x_last, y_min, y_max = level.view()
+            start = max(np.searchsorted(x_last, x0, side='left'), np.searchsorted(x_first, after, side='right'))
+            end = np.searchsorted(x_first, x1, side='right')
+            if start >= end:
+                continue
+            if index == 0:
+                xs.append(x_first[start:end])
+                ys.append(y_min[start:end])
+            else:
+                centre = 0.5 * (x_first[start:end] + x_last[start:end])
+                xs.append(np.repeat(centre, 2))
+                ys.append(np.stack((y_min[start:end], y_max[start:end]), axis=1).ravel())
+            after = x_last[end - 1]
+        if not xs:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(xs), np.concatenate(ys)
@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import time
+from collections import deque
+# Threading (GUI runs the event loop in a background thread)
+from threading import Thread, Lock
+# Hand serial protocol
+from hand_protocol import CommandBuffer, encode_servo_command, encode_config_command
+from hand_client import HandClient
+
+"""
+
+Controls several hands from a single asyncio event loop
+
+Each hand has its own HandClient (serial transport and decoder), but all of
+them are served by one event loop in one thread - reading a port costs a
+callback when it has data rather than a blocked thread per hand.
+
+Broadcast commands are encoded once and written to every hand in the same
+pass through the loop, so hands move together. The time between the first
+and last write of each broadcast is kept in broadcast_skew.
+
+Example:
+    async with MultiHandController(["/dev/ttyACM0", "/dev/ttyACM1"]) as hands:
+        await hands.set_config(1)
+        positions = await hands.query_positions()
+        async for hand, reading in hands.force_stream():
+            print(hand, reading.timestamp, reading.raw_force)
+
+Run this file to open a combined force view for several hands
+(--emulate N serves N emulated hands on ptys)
+
+"""
+
+class MultiHandController:
+    def __init__(self, ports, baudrate=9600, reply_timeout=2.0, force_queue_size=1000):
+        self.clients = [HandClient(port, baudrate, reply_timeout, force_queue_size) for port in ports]
+        self._force_queue_size = force_queue_size
+        # Seconds between the first and last write of recent broadcasts
+        self.broadcast_skew = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self.clients)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Open every port - if any fails the others are closed again
+    async def open(self):
+        results = await asyncio.gather(*(client.open() for client in self.clients), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await self.close()
+            raise errors[0]
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients if client.is_open))
+
+    # Hands to send to - all hands if hands is None, otherwise an iterable of indices
+    def _targets(self, hands):
+        if hands is None:
+            return self.clients
+        return [self.clients[hand] for hand in hands]
+
+    # Write the same bytes to each hand in a single pass
+    def broadcast(self, data, hands=None):
+        start = time.perf_counter()
+        for client in self._targets(hands):
+            client.write(data)
+        self.broadcast_skew.append(time.perf_counter() - start)
+
+    # Set every hand to a preset configuration (0-127)
+    async def set_config(self, config, hands=None):
+        self.broadcast(encode_config_command(config), hands)
+
+    # Move a single servo on every hand
+    async def set_servo(self, servo, position, hands=None):
+        self.broadcast(encode_servo_command(servo, position), hands)
+
+    # Move several servos on every hand - None leaves a servo unchanged
+    async def set_pose(self, positions, hands=None):
+        commands = CommandBuffer()
+        commands.set_pose(positions)
+        self.broadcast(commands.take(), hands)
+
+    # Different pose for each hand, all written in the same pass
+    # poses is a sequence with one positions tuple (or None to skip) per hand
+    async def set_poses(self, poses):
+        start = time.perf_counter()
+        for client, positions in zip(self.clients, poses):
+            if positions is not None:
+                commands = CommandBuffer()
+                commands.set_pose(positions)
+                client.write(commands.take())
+        self.broadcast_skew.append(time.perf_counter() - start)
+
+    # Query all hands at once - returns a list with one result per hand
+    async def query_positions(self):
+        return await asyncio.gather(*(client.query_positions() for client in self.clients))
+
+    async def query_limits(self):
+        return await asyncio.gather(*(client.query_limits() for client in self.clients))
+
+    async def query_force(self):
+        return await asyncio.gather(*(client.query_force() for client in self.clients))
+
+    # Async iterator over (hand index, message) from every hand's force stream
+    # (RawForce, or RawForceBlock if blocks is True)
+    async def force_stream(self, blocks=False):
+        queue = asyncio.Queue(self._force_queue_size)
+        async def forward(index, client):
+            async for message in client.force_stream(blocks):
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait((index, message))
+        tasks = [asyncio.ensure_future(forward(index, client)) for index, client in enumerate(self.clients)]
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Broadcast timing in microseconds
+    def stats(self):
+        skew = sorted(self.broadcast_skew)
+        if not skew:
+            return {'hands': len(self), 'broadcasts': 0}
+        return {
+            'hands': len(self),
+            'broadcasts': len(skew),
+            'broadcast_skew_p50_us': skew[len(skew) // 2] * 1e6,
+            'broadcast_skew_max_us': skew[-1] * 1e6,
+            }
+
+
+# Combined force view for several hands - one line per hand
+# The controller runs in its own event loop thread, readings are passed to
+# the window under a lock and drawn every 100ms
+def run_combined_view(ports, baudrate, window=10.0):
+    import tkinter as tk
+    from tkinter import ttk
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    from matplotlib.figure import Figure
+    from minmax_pyramid import MinMaxPyramid
+
+    controller = MultiHandController(ports, baudrate)
+    loop = asyncio.new_event_loop()
+    histories = [MinMaxPyramid(capacity=1 << 12) for _ in ports]
+    pending = [[] for _ in ports]
+    pending_lock = Lock()
+    stream_task = []
+
+    # Device clocks are not synchronised - each hand's readings are placed
+    # relative to the host time its first reading arrived
+    async def stream_forces():
+        first = {}
+        async for hand, reading in controller.force_stream():
+            if hand not in first:
+                first[hand] = (time.monotonic(), reading.timestamp)
+            host_time, device_time = first[hand]
+            x = host_time + ((reading.timestamp - device_time) & 0xFFFFFFFF) / 1000.0
+            with pending_lock:
+                pending[hand].append((x, reading.raw_force))
+
+    def run_loop():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(controller.open())
+        loop.run_forever()
+
+    def submit(coroutine):
+        asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+    def toggle_stream():
+        def toggle():
+            if stream_task:
+                stream_task.pop().cancel()
+            else:
+                stream_task.append(loop.create_task(stream_forces()))
+        loop.call_soon_threadsafe(toggle)
+
+    root = tk.Tk()
+    root.title(f"Combined Force View - {len(ports)} hands")
+    controls = tk.Frame(root, relief='groove', bd=1)
+    controls.grid(row=0, column=0, sticky='nsew')
+    ttk.Label(controls, text="Configuration (all hands)").grid(row=0, column=0, sticky='nsew')
+    config = ttk.Spinbox(controls, from_=0, to=127, width=5)
+    config.set(0)
+    config.grid(row=0, column=1, sticky='nsew')
+    ttk.Button(controls, text="Set", command=lambda: submit(controller.set_config(int(config.get())))).grid(row=0, column=2, sticky='nsew')
+    ttk.Button(controls, text="Toggle Force Data Stream", command=toggle_stream).grid(row=0, column=3, sticky='nsew')
+
+    fig = Figure(figsize=(8, 4), dpi=100)
+    ax = fig.add_subplot(111)
+    lines = [ax.plot([], [], label=str(port), linewidth=0.8)[0] for port in ports]
+    if len(ports) <= 8:
+        ax.legend(loc='upper left', fontsize='small')
+    canvas = FigureCanvasTkAgg(fig, master=root)
+    canvas.get_tk_widget().grid(row=1, column=0, sticky='nsew')
+
+    # Updates graph on repeat
+    def update_display():
+        with pending_lock:
+            batches = [batch[:] for batch in pending]
+            for batch in pending:
+                batch.clear()
+        if any(batches):
+            newest = time.monotonic()
+            y_low, y_high = float('inf'), float('-inf')
+            for history, batch, line in zip(histories, batches, lines):
+                if batch:
+                    xs, ys = zip(*batch)
+                    history.extend(xs, ys)
+                if len(history):
+                    x, y = history.query(newest - window, newest, 1000)
+                    line.set_data(x, y)
+                    if len(y):
+                        y_low, y_high = min(y_low, y.min()), max(y_high, y.max())
+            ax.set_xlim(newest - window, newest)
+            if y_low <= y_high:
+                margin = max(0.1 * (y_high - y_low), 1.0)
+                ax.set_ylim(y_low - margin, y_high + margin)
+            canvas.draw_idle()
+        root.after(100, update_display)
+
+    def on_close():
+        async def shutdown():
+            for task in stream_task:
+                task.cancel()
+            await controller.close()
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        root.destroy()
+
+    Thread(target=run_loop, daemon=True).start()
+    root.protocol("WM_DELETE_WINDOW", on_close)
+    update_display()
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Combined force view for several hands")
+    parser.add_argument("ports", nargs='*', help="Serial ports of the hands")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--emulate", type=int, default=0, help="Serve this many emulated hands on ptys")
+    args = parser.parse_args()
+
+    emulators = []
+    ports = list(args.ports)
+    if args.emulate:
+        from hand_emulator import HandFirmware, PtyHandEmulator
+        for _ in range(args.emulate):
+            emulator = PtyHandEmulator(HandFirmware(debug_only=False), baudrate=args.baudrate)
+            emulator.start()
+            emulators.append(emulator)
+            ports.append(emulator.port)
+    if not ports:
+        parser.error("Give at least one port or --emulate N")
+    try:
+        run_combined_view(ports, args.baudrate)
+    finally:
+        for emulator in emulators:
+            emulator.close()
@@ -0,0 +1,267 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+# Hand serial protocol
+from hand_protocol import MessageDecoder, RawForce, RawForceBlock
+from log_batching import LogBatcher
+from message_display import MessageDisplay
+from traffic_capture import read_capture, capture_extension, DIRECTION_IN
+
+"""
+
+Regression tests built from captured hand traffic (traffic_capture.py)
+
+Each capture in the corpus directory is fed through the same stages as the
+GUI - decoder, message display (message_display.py), force graph history and
+log batching - with the display refreshed every 100 ms and the log every
+50 ms of capture time, so the result does not depend on the replay speed or
+the machine. The decoded message sequence (hashed), message counts, dropped
+bytes, graph points and log lines are compared with expectations.json, and
+replaying at maximum speed must reach the stored minimum throughput.
+
+Run all captures:
+    python replay_regression.py
+Add or re-baseline captures after a deliberate change:
+    python replay_regression.py --update captures/new_capture.htc
+Replay through the real GUI instead (needs a display):
+    python replay_regression.py --gui
+
+The stored minimum throughput is a quarter of the throughput measured when
+the expectations were written, leaving room for slower machines.
+
+"""
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "captures")
+expectations_name = "expectations.json"
+throughput_margin = 0.25
+graph_interval = 0.1
+log_interval = 0.05
+
+
+# Message as JSON-friendly lists, so NumPy arrays hash the same on every version
+def _canonical(message):
+    return [type(message).__name__] + [value.tolist() if hasattr(value, 'tolist') else value for value in message]
+
+
+# communication_gui.GraphDisplayFrame without the figure - points from the listener
+# thread are added to the history on each display update and the visible window queried
+class ReplayGraph:
+    def __init__(self, window=20.0, max_points=800):
+        from minmax_pyramid import MinMaxPyramid
+        self.history = MinMaxPyramid()
+        self.window = window
+        self.max_points = max_points
+        self._pending_x = []
+        self._pending_y = []
+
+    def append_data(self, x, y):
+        self._pending_x.append(x)
+        self._pending_y.append(y)
+
+    def extend_data(self, xs, ys):
+        if hasattr(xs, 'tolist'):
+            xs = xs.tolist()
+            ys = ys.tolist()
+        self._pending_x.extend(xs)
+        self._pending_y.extend(ys)
+
+    def clear(self):
+        self._pending_x, self._pending_y = [], []
+        self.history.clear()
+
+    def update_display(self):
+        if self._pending_x:
+            self.history.extend(self._pending_x, self._pending_y)
+            self._pending_x, self._pending_y = [], []
+        if len(self.history) >= 2:
+            newest = self.history.x_range()[1]
+            self.history.query(newest - self.window, newest + 0.25*self.window, self.max_points)
+
+
+# The GUI's receive path without Tk - listener thread decoding, message display,
+# graph history and log batching
+# Force readings are logged as with "Display force readings" ticked
+class ReplayPipeline:
+    def __init__(self, hash_messages=True):
+        self.decoder = MessageDecoder(unwrap_timestamps=True)
+        self.graph = ReplayGraph()
+        self._now = 0.0
+        self.log = LogBatcher(clock=lambda: self._now)
+        self.display = MessageDisplay(self.log.add, self.graph)
+        self.display.display_force_readings = True
+        self.counts = {}
+        self.readings = 0
+        self.log_lines = 0
+        self.bytes_in = 0
+        self._hash = hashlib.sha256() if hash_messages else None
+        self._next_graph = graph_interval
+        self._next_log = log_interval
+
+    # Bytes read at elapsed seconds into the capture
+    def feed(self, elapsed, data):
+        # Display loops that would have run before this read
+        while self._next_graph <= elapsed or self._next_log <= elapsed:
+            if self._next_graph <= self._next_log:
+                self._now = self._next_graph
+                self.update_graph()
+                self._next_graph += graph_interval
+            else:
+                self._now = self._next_log
+                self.update_log()
+                self._next_log += log_interval
+        self._now = elapsed
+        self.bytes_in += len(data)
+        for message in self.decoder.feed(data):
+            name = type(message).__name__
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if self._hash is not None:
+                self._hash.update(json.dumps(_canonical(message), separators=(',', ':')).encode())
+            message_type = type(message)
+            if message_type is RawForce:
+                self.readings += 1
+            elif message_type is RawForceBlock:
+                self.readings += len(message.raw_forces)
+            self.display.handle(message)
+
+    def update_graph(self):
+        self.graph.update_display()
+
+    def update_log(self):
+        self.log_lines += len(self.log.drain())
+
+    # Final display updates once the capture has been fed in
+    def finish(self):
+        self.update_graph()
+        self.update_log()
+
+    def results(self):
+        return {
+            'messages': dict(sorted(self.counts.items())),
+            'readings': self.readings,
+            'dropped_bytes': self.decoder.dropped_bytes,
+            'pending_bytes': self.decoder.pending_bytes,
+            'graph_points': len(self.graph.history),
+            'log_lines': self.log_lines,
+            'sequence_sha256': self._hash.hexdigest() if self._hash is not None else None,
+            }
+
+
+# Feed the hand's side of a capture through a pipeline
+# speed is the playback rate (1.0 for real time) or None to go as fast as possible
+def replay(records, pipeline, speed=None):
+    start = time.perf_counter()
+    for elapsed, direction, data in records:
+        if direction != DIRECTION_IN:
+            continue
+        if speed is not None:
+            delay = elapsed / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        pipeline.feed(elapsed, data)
+    pipeline.finish()
+    return pipeline
+
+
+# Bytes per second through the pipeline at maximum speed - best of runs lasting at least min_time in total
+def measure_throughput(records, min_time=0.5):
+    bytes_in = sum(len(data) for _, direction, data in records if direction == DIRECTION_IN)
+    best = None
+    total = 0.0
+    while total < min_time or best is None:
+        start = time.perf_counter()
+        replay(records, ReplayPipeline(hash_messages=False))
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return bytes_in / max(best, 1e-9)
+
+
+# Replay through HandControlApplication with the capture opened as its serial port
+# Returns the message counts from the GUI metrics
+def replay_gui(path, speed):
+    from communication_gui import HandControlApplication
+    app = HandControlApplication()
+    app.echo_log_to_console = False
+    app._replaymaxspeed.set(int(speed is None))
+    app._selected_port.set(path)
+    app.connect()
+    while app.ser.is_open and not app.ser.finished:
+        app.update()
+    # Let the listener thread handle the last read and the display loops catch up
+    end = time.perf_counter() + 0.5
+    while time.perf_counter() < end:
+        app.update()
+    counters = app.metrics.snapshot()['counters']
+    app.on_close()
+    return {name[len('messages_'):]: value for name, value in counters.items()
+            if name.startswith('messages_') and name != 'messages_unhandled' and value}
+
+
+def compare(expected, actual, keys):
+    return [f"{key}: expected {expected.get(key)!r}, got {actual.get(key)!r}"
+            for key in keys if expected.get(key) != actual.get(key)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured hand traffic and check it against expectations")
+    parser.add_argument("captures", nargs='*', help=f"Captures to run (default: all in {corpus_dir})")
+    parser.add_argument("--update", action="store_true", help="Write expectations for the captures instead of checking")
+    parser.add_argument("--speed", type=float, help="Also check a replay at this speed (1 for the original timing)")
+    parser.add_argument("--gui", action="store_true", help="Replay through the GUI (needs a display)")
+    args = parser.parse_args()
+
+    expectations_path = os.path.join(corpus_dir, expectations_name)
+    expectations = {}
+    if os.path.exists(expectations_path):
+        with open(expectations_path) as f:
+            expectations = json.load(f)
+    paths = args.captures or sorted(glob.glob(os.path.join(corpus_dir, "*" + capture_extension)))
+    if not paths:
+        print(f"No captures in {corpus_dir}")
+        sys.exit(1)
+
+    failures = 0
+    for path in paths:
+        name = os.path.basename(path)
+        _, records = read_capture(path)
+        actual = replay(records, ReplayPipeline()).results()
+        throughput = measure_throughput(records)
+        if args.update:
+            actual['min_bytes_per_s'] = round(throughput * throughput_margin)
+            expectations[name] = actual
+            print(f"{name:<32} updated   {sum(actual['messages'].values())} messages, {throughput / 1e6:.2f} MB/s")
+            continue
+        expected = expectations.get(name)
+        if expected is None:
+            print(f"{name:<32} FAIL      no expectations - run with --update to add it")
+            failures += 1
+            continue
+        problems = compare(expected, actual, ('messages', 'readings', 'dropped_bytes', 'pending_bytes',
+                                              'graph_points', 'log_lines', 'sequence_sha256'))
+        if throughput < expected['min_bytes_per_s']:
+            problems.append(f"throughput {throughput:.0f} B/s below minimum {expected['min_bytes_per_s']} B/s")
+        if args.speed is not None:
+            paced = replay(records, ReplayPipeline(), args.speed).results()
+            problems += [f"at speed {args.speed}: {p}" for p in compare(actual, paced, ('sequence_sha256', 'log_lines'))]
+        if args.gui:
+            gui_messages = replay_gui(path, None if args.speed is None else args.speed)
+            if gui_messages != expected['messages']:
+                problems.append(f"GUI messages: expected {expected['messages']}, got {gui_messages}")
+        failures += bool(problems)
+        print(f"{name:<32} {'FAIL' if problems else 'ok':<9} {sum(actual['messages'].values())} messages, "
+              f"{throughput / 1e6:.2f} MB/s (minimum {expected['min_bytes_per_s'] / 1e6:.2f})")
+        for problem in problems:
+            print(f"    {problem}")
+
+    if args.update:
+        with open(expectations_path, 'w') as f:
+            json.dump(expectations, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Wrote {expectations_path}")
+    elif failures:
+        print(f"FAIL - {failures} of {len(paths)} captures")
+        sys.exit(1)
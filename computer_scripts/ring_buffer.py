@@ -0,0 +1,77 @@
+import numpy as np
+
+"""
+
+Fixed-size NumPy ring buffer used to hold streamed data for plotting
+Memory is allocated once when the buffer is created
+
+"""
+
+# Ring buffer holding one or more columns of values (e.g. x and y)
+# Every value is stored twice, at index i and i + capacity, so that the
+# buffer contents can always be returned as a contiguous view without copying
+class RingBuffer:
+    def __init__(self, capacity, fields=2, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be at least 1")
+        self._capacity = capacity
+        self._data = np.zeros((fields, 2*capacity), dtype=dtype)
+        self._end = 0       # Index the next value will be written to
+        self._count = 0     # Number of valid values
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    # Remove all values (storage is kept)
+    def clear(self):
+        self._end = 0
+        self._count = 0
+
+    # Add a single value to each column
+    def append(self, *values):
+        end = self._end
+        self._data[:, end] = values
+        self._data[:, end + self._capacity] = values
+        self._end = (end + 1) % self._capacity
+        if self._count < self._capacity:
+            self._count += 1
+
+    # Add several values to each column at once
+    # All columns must be the same length
+    def extend(self, *columns):
+        cap = self._capacity
+        n = len(columns[0])
+        if n == 0:
+            return
+        # Only the newest [capacity] values can be kept
+        if n > cap:
+            columns = [column[-cap:] for column in columns]
+            n = cap
+        end = self._end
+        first = min(n, cap - end)   # Values that fit before wrapping
+        rest = n - first
+        for row, column in zip(self._data, columns):
+            column = np.asarray(column)
+            row[end:end+first] = column[:first]
+            row[end+cap:end+cap+first] = column[:first]
+            if rest:
+                row[:rest] = column[first:]
+                row[cap:cap+rest] = column[first:]
+        self._end = (end + n) % cap
+        self._count = min(self._count + n, cap)
+
+    # Get the buffer contents, oldest first, as one array per column
+    # Arrays are views into the buffer so will change as new data is added
+    def view(self):
+        start = (self._end - self._count) % self._capacity
+        return tuple(self._data[:, start:start+self._count])
+
+    # Get the newest value in each column
+    def last(self):
+        if self._count == 0:
+            raise IndexError("Ring buffer is empty")
+        return tuple(self._data[:, self._end - 1 + self._capacity])
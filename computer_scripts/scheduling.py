@@ -0,0 +1,116 @@
+import math
+import time
+from collections import deque
+# Threading
+from threading import Thread, Event, Lock
+
+"""
+
+Fixed-rate scheduler for control and playback threads
+
+Ticks are scheduled against absolute deadlines (start + n * period) so timing
+errors do not accumulate. A tick that starts after the following deadline has
+already passed counts as a missed deadline, and the skipped ticks are dropped
+rather than run in a burst.
+
+"""
+
+# Runs callback(tick, scheduled_time) at a fixed rate in a dedicated thread
+# The callback returns False to stop the scheduler
+# spin is the time (s) before each deadline spent busy-waiting instead of sleeping,
+# which trades CPU time for lower jitter
+class FixedRateScheduler:
+    def __init__(self, rate, callback, spin=0.0005, history=10000, name=None):
+        if rate <= 0:
+            raise ValueError("Scheduler rate must be positive")
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.spin = spin
+        self._callback = callback
+        self._stop = Event()
+        self._thread = None
+        self._name = name
+        # Statistics
+        self.ticks = 0
+        self.missed_deadlines = 0
+        self.overruns = 0           # Callbacks that took longer than one period
+        self._jitter = deque(maxlen=history)        # Start time - deadline (s)
+        self._durations = deque(maxlen=history)     # Callback run time (s)
+        # Held while the histories change, so stats() can copy them while running
+        self._stats_lock = Lock()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    # Stop and wait for the thread to finish
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        period = self.period
+        start = time.perf_counter()
+        tick = 0
+        while not self._stop.is_set():
+            deadline = start + tick * period
+            # Sleep until just before the deadline then spin
+            remaining = deadline - time.perf_counter() - self.spin
+            if remaining > 0 and self._stop.wait(remaining):
+                break
+            now = time.perf_counter()
+            while now < deadline:
+                now = time.perf_counter()
+            with self._stats_lock:
+                self._jitter.append(now - deadline)
+            self.ticks += 1
+            keep_running = self._callback(tick, deadline)
+            finished = time.perf_counter()
+            with self._stats_lock:
+                self._durations.append(finished - now)
+            if finished - now > period:
+                self.overruns += 1
+            if keep_running is False:
+                break
+            # Move to the next deadline that has not passed yet
+            next_tick = tick + 1
+            late_tick = int((finished - start) / period)
+            if late_tick >= next_tick:
+                self.missed_deadlines += late_tick - next_tick + 1
+                next_tick = late_tick + 1
+            tick = next_tick
+
+    # Timing statistics in microseconds - may be called while running
+    def stats(self):
+        with self._stats_lock:
+            jitter = list(self._jitter)
+            durations = list(self._durations)
+        jitter.sort()
+        durations.sort()
+        def percentile(values, p):
+            if not values:
+                return float('nan')
+            return values[min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)] * 1e6
+        mean = sum(jitter) / len(jitter) if jitter else float('nan')
+        variance = sum((j - mean) ** 2 for j in jitter) / len(jitter) if jitter else float('nan')
+        return {
+            'rate_hz': self.rate,
+            'ticks': self.ticks,
+            'missed_deadlines': self.missed_deadlines,
+            'overruns': self.overruns,
+            'jitter_mean_us': mean * 1e6,
+            'jitter_std_us': math.sqrt(variance) * 1e6,
+            'jitter_p50_us': percentile(jitter, 50),
+            'jitter_p99_us': percentile(jitter, 99),
+            'jitter_max_us': jitter[-1] * 1e6 if jitter else float('nan'),
+            'callback_p99_us': percentile(durations, 99),
+            }
@@ -0,0 +1,251 @@
+import argparse
+import struct
+import time
+from multiprocessing import shared_memory
+# Threading
+from threading import Lock
+import numpy as np
+# Record layout shared with force recordings
+from force_recorder import record_dtype
+
+"""
+
+Shared memory ring buffer for publishing force readings to other processes
+
+One writer (the process reading the hand) adds (timestamp, raw_force)
+records, any number of readers in other processes map the same memory and
+read new records as NumPy views without copying and without locks.
+
+Memory layout:
+    64 byte header - magic, version, record size, capacity, max batch,
+        then at byte 16 the uint64 write sequence (total records written)
+    2 * capacity records (record_dtype) - every record is stored twice, at
+        index i and i + capacity, so any run of records is contiguous
+
+The writer stores records before publishing the new write sequence, and
+writes at most max_batch records per publish. Each reader keeps its own
+read cursor (sequence number). A reader that falls more than
+capacity - max_batch records behind has been overrun - the lost records are
+counted in reader.lost and the cursor jumps forward to the oldest safe record.
+
+Views returned by read() stay valid until the writer laps them - call
+still_valid() after using a view to check it was not overwritten meanwhile.
+The sequence is a single aligned 8 byte store, which is atomic on the
+platforms the scripts run on (x86-64, ARM64).
+
+Example reader:
+    with SharedForceReader("hand_force") as reader:
+        while True:
+            records = reader.read()
+            process(records['timestamp'], records['raw_force'])
+            time.sleep(0.05)
+
+"""
+
+default_name = "hand_force"
+ring_magic = b'HFSR'
+ring_version = 1
+_header_struct = struct.Struct('<4sHHLL')
+header_size = 64
+_seq_offset = 16
+
+# Rings created by this process - still tracked so they are removed if the writer is not closed
+_created = set()
+
+
+# Open existing shared memory without the resource tracker removing it when this process exits
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the memory with the tracker
+        shm = shared_memory.SharedMemory(name)
+        if shm.name in _created:
+            return shm
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except (ImportError, AttributeError):
+            pass
+        return shm
+
+
+# Views of the header sequence and records in a shared memory block
+def _map(shm, capacity):
+    seq = np.ndarray((1,), dtype='<u8', buffer=shm.buf, offset=_seq_offset)
+    records = np.ndarray((2 * capacity,), dtype=record_dtype, buffer=shm.buf, offset=header_size)
+    return seq, records
+
+
+# Creates the shared memory and writes records into it
+# Records added after closing are ignored, so a listener thread can keep
+# calling append while another thread closes the writer
+class SharedForceWriter:
+    def __init__(self, name=default_name, capacity=1 << 16, max_batch=None):
+        if capacity < 2:
+            raise ValueError("Shared ring capacity must be at least 2")
+        self.capacity = capacity
+        self.max_batch = max_batch or max(1, capacity // 8)
+        if self.max_batch >= capacity:
+            raise ValueError("Shared ring max_batch must be less than the capacity")
+        size = header_size + 2 * capacity * record_dtype.itemsize
+        self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = self._shm.name
+        _created.add(self.name)
+        _header_struct.pack_into(self._shm.buf, 0, ring_magic, ring_version, record_dtype.itemsize,
+                                 capacity, self.max_batch)
+        self._seq, self._records = _map(self._shm, capacity)
+        self._seq[0] = 0
+        self._next = 0
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def records_written(self):
+        return self._next
+
+    # Add a single record
+    def append(self, timestamp, raw_force):
+        with self._lock:
+            if self._shm is None:
+                return
+            index = self._next % self.capacity
+            record = (timestamp & 0xFFFFFFFF, raw_force)
+            self._records[index] = record
+            self._records[index + self.capacity] = record
+            self._next += 1
+            self._seq[0] = self._next
+
+    # Add several records - published in batches of at most max_batch
+    def extend(self, timestamps, raw_forces):
+        timestamps = np.asarray(timestamps) & 0xFFFFFFFF
+        raw_forces = np.asarray(raw_forces)
+        cap = self.capacity
+        # Only the newest records that a reader could still read are kept
+        skip = max(0, len(timestamps) - (cap - self.max_batch))
+        with self._lock:
+            if self._shm is None:
+                return
+            # Skipped records still count as written, so readers count them as lost
+            self._next += skip
+            for start in range(skip, len(timestamps), self.max_batch):
+                n = min(self.max_batch, len(timestamps) - start)
+                index = self._next % cap
+                first = min(n, cap - index)     # Records that fit before wrapping
+                for offset, count, src in ((index, first, start), (0, n - first, start + first)):
+                    if not count:
+                        continue
+                    for copy in (offset, offset + cap):
+                        self._records['timestamp'][copy:copy + count] = timestamps[src:src + count]
+                        self._records['raw_force'][copy:copy + count] = raw_forces[src:src + count]
+                self._next += n
+                self._seq[0] = self._next
+
+    # Close and remove the shared memory - readers keep their mapping until they close
+    def close(self):
+        with self._lock:
+            if self._shm is None:
+                return
+            del self._seq, self._records
+            self._shm.close()
+            self._shm.unlink()
+            _created.discard(self.name)
+            self._shm = None
+
+
+# Maps a SharedForceWriter's memory and reads records with its own cursor
+# from_start reads all records still held, otherwise only records written after opening
+class SharedForceReader:
+    def __init__(self, name=default_name, from_start=False):
+        self._shm = _attach(name)
+        magic, version, record_size, capacity, max_batch = _header_struct.unpack_from(self._shm.buf, 0)
+        if magic != ring_magic or version != ring_version or record_size != record_dtype.itemsize:
+            self._shm.close()
+            raise ValueError(f"Shared memory '{name}' is not a force ring")
+        self.name = name
+        self.capacity = capacity
+        self.max_batch = max_batch
+        self._seq, self._records = _map(self._shm, capacity)
+        written = int(self._seq[0])
+        self.cursor = max(0, written - self.safe_capacity) if from_start else written
+        self._last_start = self.cursor
+        self.lost = 0       # Records overwritten before they were read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Records a reader can fall behind by without being overrun
+    @property
+    def safe_capacity(self):
+        return self.capacity - self.max_batch
+
+    # Total records written by the writer
+    @property
+    def write_seq(self):
+        return int(self._seq[0])
+
+    # Number of records waiting to be read
+    @property
+    def available(self):
+        return min(self.write_seq - self.cursor, self.safe_capacity)
+
+    # Return new records (up to max_records) as a view into shared memory and advance the cursor
+    def read(self, max_records=None):
+        written = int(self._seq[0])
+        behind = written - self.cursor
+        if behind > self.safe_capacity:
+            self.lost += behind - self.safe_capacity
+            self.cursor = written - self.safe_capacity
+            behind = self.safe_capacity
+        if max_records is not None:
+            behind = min(behind, max_records)
+        start = self.cursor % self.capacity
+        self._last_start = self.cursor
+        self.cursor += behind
+        return self._records[start:start + behind]
+
+    # True if the records from the last read have not been overwritten yet
+    def still_valid(self):
+        return int(self._seq[0]) - self._last_start <= self.safe_capacity
+
+    # Views from read() must not be used after closing
+    def close(self):
+        if self._shm is None:
+            return
+        del self._seq, self._records
+        try:
+            self._shm.close()
+        except BufferError:
+            # Caller still holds views - the mapping is released when they are freed
+            pass
+        self._shm = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print statistics for a shared force ring")
+    parser.add_argument("name", nargs='?', default=default_name, help="Shared memory name")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between printouts")
+    args = parser.parse_args()
+
+    with SharedForceReader(args.name) as reader:
+        print(f"Reading '{args.name}' (capacity {reader.capacity} records) - Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(args.interval)
+                records = reader.read()
+                if len(records):
+                    forces = records['raw_force']
+                    print(f"{len(records)/args.interval:8.1f} records/s   last timestamp {records['timestamp'][-1]:>10}   "
+                          f"force min {forces.min()} mean {forces.mean():.1f} max {forces.max()}   lost {reader.lost}")
+                else:
+                    print(f"{0.0:8.1f} records/s   lost {reader.lost}")
+        except KeyboardInterrupt:
+            pass
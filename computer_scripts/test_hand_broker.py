@@ -0,0 +1,265 @@
+import asyncio
+import contextlib
+import socket
+import time
+import pytest
+from hand_protocol import (MessageDecoder, StringMessage, AllServoPositions, RawForce,
+    QUERY_FORCE_RAW, TOGGLE_FORCE_STREAM, command_length,
+    encode_servo_command, encode_string_message, encode_raw_force_message)
+from hand_emulator import HandFirmware, PtyHandEmulator
+from hand_broker import (HandBroker, BrokerClient, FrameReader, encode_frame, FRAME_DEVICE, FRAME_DROPPED,
+    FRAME_SUBSCRIBE, SUBSCRIBE_ALL, SUBSCRIBE_STRINGS, SUBSCRIBE_POSITIONS, drop_policies)
+
+"""
+
+Tests for hand_broker.HandBroker on localhost, with an emulated hand on a pty
+
+Run from this directory with
+    python -m pytest test_hand_broker.py
+
+"""
+
+# Firmware that keeps every byte it receives, so tests can see what the broker sent to the hand
+class RecordingFirmware(HandFirmware):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = bytearray()
+
+    def receive(self, data):
+        self.received += data
+        return super().receive(data)
+
+    # Commands received so far, split as the firmware reads them
+    def commands(self):
+        data = bytes(self.received)
+        commands = []
+        pos = 0
+        while pos < len(data):
+            length = command_length(data[pos])
+            commands.append(data[pos:pos + length])
+            pos += length
+        return commands
+
+
+# Broker on an emulated hand, serving framed and raw subscribers on localhost TCP
+# Yields (broker, firmware, framed address, raw port)
+@contextlib.asynccontextmanager
+async def running_broker(baudrate=115200, **kwargs):
+    firmware = RecordingFirmware(debug_only=False)
+    emulator = PtyHandEmulator(firmware, baudrate=baudrate, stream_interval=0.02)
+    emulator.start()
+    broker = HandBroker(emulator.port, baudrate, **kwargs)
+    try:
+        await broker.open()
+        framed = await broker.serve_tcp()
+        raw = await broker.serve_tcp(raw=True)
+        yield (broker, firmware, f"127.0.0.1:{framed.sockets[0].getsockname()[1]}",
+               raw.sockets[0].getsockname()[1])
+    finally:
+        await broker.close()
+        emulator.close()
+
+
+async def wait_until(condition, timeout=5.0):
+    end = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < end, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def connect_client(address, subscribe=SUBSCRIBE_ALL):
+    client = BrokerClient(address, subscribe)
+    await client.open()
+    return client
+
+
+# Collects the messages a BrokerClient receives
+def record_messages(client):
+    messages = []
+    client.add_message_handler(messages.append)
+    return messages
+
+
+# Every message from the hand goes to every subscriber that asked for its group
+def test_fan_out():
+    async def run():
+        async with running_broker() as (broker, firmware, address, raw_port):
+            first = await connect_client(address)
+            second = await connect_client(address)
+            strings_only = await connect_client(address, SUBSCRIBE_STRINGS)
+            reader, writer = await asyncio.open_connection('127.0.0.1', raw_port)
+            received = [record_messages(c) for c in (first, second, strings_only)]
+            await wait_until(lambda: broker.stats()['subscribers'] == 4)
+
+            # Reply to one subscriber's query reaches the others too
+            positions = await first.query_positions()
+            broker.data_received(encode_string_message("Hello"))
+            await wait_until(lambda: all(any(type(m) is StringMessage for m in r) for r in received))
+            for messages in received[:2]:
+                assert [type(m) for m in messages] == [AllServoPositions, StringMessage]
+                assert messages[0].positions == positions
+            assert received[2] == [StringMessage("Hello")]
+
+            decoder = MessageDecoder()
+            raw_messages = []
+            while len(raw_messages) < 2:
+                raw_messages += decoder.feed(await asyncio.wait_for(reader.read(4096), 5.0))
+            assert raw_messages == [AllServoPositions(positions), StringMessage("Hello")]
+            writer.close()
+            for client in (first, second, strings_only):
+                await client.close()
+    asyncio.run(run())
+
+
+# Commands from several subscribers are interleaved, so one busy subscriber cannot hold up another
+def test_fair_queuing():
+    async def run():
+        # 9600 baud paces the broker to 2 servo commands per write
+        async with running_broker(baudrate=9600) as (broker, firmware, address, raw_port):
+            _, busy = await asyncio.open_connection('127.0.0.1', raw_port)
+            _, other = await asyncio.open_connection('127.0.0.1', raw_port)
+            await wait_until(lambda: broker.stats()['subscribers'] == 2)
+            busy.write(b''.join(encode_servo_command(0, 10 + i % 100) for i in range(100)))
+            await busy.drain()
+            other.write(b''.join(encode_servo_command(1, 10 + i) for i in range(20)))
+            await other.drain()
+            await wait_until(lambda: len(firmware.commands()) == 120)
+            servos = [command[0] for command in firmware.commands()]
+            # All of the other subscriber's commands are sent alongside the first of the busy subscriber's
+            last_other = len(servos) - 1 - servos[::-1].index(1)
+            assert servos[:last_other].count(0) < 40
+            assert broker.stats()['commands_sent'] == 120
+            busy.close()
+            other.close()
+    asyncio.run(run())
+
+
+# Connects a framed subscriber that is not reading, with small socket buffers
+# so the broker starts holding back messages after a few kB
+async def connect_stalled_subscriber(broker, address):
+    host, _, port = address.rpartition(':')
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect((host, int(port)))
+    sock.setblocking(False)
+    reader, writer = await asyncio.open_connection(sock=sock)
+    count = broker.stats()['subscribers']
+    writer.write(encode_frame(FRAME_SUBSCRIBE, bytes([SUBSCRIBE_ALL])))
+    await wait_until(lambda: broker.stats()['subscribers'] == count + 1)
+    subscriber = broker._subscribers[-1]
+    subscriber.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    return subscriber, reader, writer
+
+
+# Reads frames until count readings and the dropped count have arrived
+async def read_readings(reader, count, dropped):
+    frames = FrameReader()
+    decoder = MessageDecoder()
+    readings = []
+    strings = []
+    reported = 0
+    while len(readings) < count or reported < dropped:
+        data = await asyncio.wait_for(reader.read(4096), 5.0)
+        assert data, "broker closed the connection"
+        for kind, payload in frames.feed(data):
+            if kind == FRAME_DROPPED:
+                reported += int.from_bytes(payload, 'little')
+            elif kind == FRAME_DEVICE:
+                for message in decoder.feed(payload):
+                    if type(message) is RawForce:
+                        readings.append(message.raw_force)
+                    else:
+                        strings.append(message)
+    assert reported == dropped
+    return readings, strings
+
+
+reading_count = 5000
+queue_limit = 10
+
+
+@pytest.mark.parametrize('policy', drop_policies)
+def test_drop_policies(policy):
+    async def run():
+        async with running_broker(queue_limit=queue_limit, drop_policy=policy,
+                                  write_buffer_limit=256) as (broker, firmware, address, _):
+            subscriber, reader, writer = await connect_stalled_subscriber(broker, address)
+            # Force readings from the hand arrive faster than the subscriber reads them
+            # The string after them is never dropped
+            broker.data_received(b''.join(encode_raw_force_message(i, i) for i in range(reading_count))
+                                 + encode_string_message("Done"))
+
+            if policy == 'disconnect':
+                await wait_until(lambda: broker.stats()['subscribers'] == 0)
+                writer.close()
+                return
+
+            dropped = subscriber.dropped_total
+            assert dropped > 0
+            assert broker.stats()['messages_dropped'] == dropped
+            readings, strings = await read_readings(reader, reading_count - dropped, dropped)
+            assert strings == [StringMessage("Done")]
+            sent_directly = reading_count - dropped - queue_limit
+            if policy == 'newest':
+                # Held back readings are the ones that followed those sent, later ones were dropped
+                assert readings == list(range(reading_count - dropped))
+            else:
+                # Held back readings are the latest
+                assert readings == list(range(sent_directly)) + list(range(reading_count - queue_limit, reading_count))
+            writer.close()
+    asyncio.run(run())
+
+
+# The hand's force stream is toggled only by the first subscriber to enable it
+# and the last to disable it or disconnect
+def test_stream_reference_counting():
+    async def run():
+        async with running_broker() as (broker, firmware, address, _):
+            first = await connect_client(address)
+            second = await connect_client(address)
+            toggles = lambda: firmware.received.count(TOGGLE_FORCE_STREAM)
+
+            await first.set_force_stream(True)
+            await wait_until(lambda: firmware.force_stream)
+            await second.set_force_stream(True)
+            # Once the query is answered the hand has received any earlier command from the same client
+            await second.query_positions()
+            assert toggles() == 1
+
+            await first.set_force_stream(False)
+            await first.query_positions()
+            assert toggles() == 1
+            assert firmware.force_stream
+
+            # Last user disconnects without turning its stream off
+            await second.close()
+            await wait_until(lambda: not firmware.force_stream)
+            assert toggles() == 2
+            await first.close()
+    asyncio.run(run())
+
+
+# A force query while another subscriber's stream is running is answered from the stream
+# and not sent to the hand, so no subscriber sees a reply mixed into the stream
+def test_force_query_during_shared_stream():
+    async def run():
+        async with running_broker() as (broker, firmware, address, _):
+            streaming = await connect_client(address)
+            everything = await connect_client(address)
+            no_force = await connect_client(address, SUBSCRIBE_STRINGS | SUBSCRIBE_POSITIONS)
+            await streaming.set_force_stream(True)
+            await wait_until(lambda: firmware.force_stream)
+
+            for client in (everything, no_force):
+                reading = await client.query_force()
+                assert type(reading) is RawForce
+            assert QUERY_FORCE_RAW not in firmware.received
+
+            # With the stream off queries go to the hand again
+            await streaming.set_force_stream(False)
+            await streaming.query_positions()
+            assert type(await no_force.query_force()) is RawForce
+            assert firmware.received.count(QUERY_FORCE_RAW) == 1
+            for client in (streaming, everything, no_force):
+                await client.close()
+    asyncio.run(run())
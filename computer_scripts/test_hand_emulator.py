@@ -0,0 +1,78 @@
+import time
+from hand_protocol import MessageDecoder, RawForceBlock, TOGGLE_FORCE_BLOCK_STREAM
+from hand_emulator import HandFirmware, MemoryHandEmulator, force_block_size
+
+"""
+
+Tests of the force block stream against the in-memory hand emulator
+
+Run from this directory with
+    python -m pytest test_hand_emulator.py
+
+"""
+
+# millis() value at the first reading - the stream wraps within the first few blocks
+start_millis = 0xFFFFFF00
+# Emulated clock advances 1/128 s per reading, so deltas are 7 or 8 ms
+clock_step = 1 / 128
+
+
+# Firmware whose clock moves on one step after every reading
+# Each reading is the low 16 bits of its own timestamp, so readings can be matched to timestamps
+def stepped_firmware():
+    ticks = [0]
+    def clock():
+        return ticks[0] * clock_step
+    def force_model(t, positions):
+        ticks[0] += 1
+        return round(t * 1000) & 0xFFFF
+    return HandFirmware(clock=clock, force_model=force_model, start_millis=start_millis)
+
+
+def expected_timestamp(index):
+    return (start_millis + index * 1000 // 128) & 0xFFFFFFFF
+
+
+# Read from the emulated port until check(blocks) is true, returns the decoded blocks
+def read_blocks(ser, decoder, blocks, check, timeout=5.0):
+    end = time.perf_counter() + timeout
+    while not check(blocks):
+        assert time.perf_counter() < end, "timed out waiting for force blocks"
+        for message in decoder.feed(ser.read(ser.in_waiting or 1)):
+            if type(message) is RawForceBlock:
+                blocks.append(message)
+    return blocks
+
+
+def test_block_stream_decodes_and_flushes_partial_block():
+    emulator = MemoryHandEmulator(stepped_firmware(), baudrate=115200, block_interval=0.02)
+    ser = emulator.serial
+    ser.timeout = 0.05
+    decoder = MessageDecoder()
+    blocks = []
+    with emulator:
+        ser.write(bytes([TOGGLE_FORCE_BLOCK_STREAM]))
+        read_blocks(ser, decoder, blocks, lambda blocks: len(blocks) >= 2)
+        # Stop part way through a block - readings are 20 ms apart, so the toggle
+        # is handled before the next one is taken
+        end = time.perf_counter() + 5.0
+        while emulator.block_readings_taken % force_block_size != force_block_size // 2:
+            assert time.perf_counter() < end, "emulator stopped taking readings"
+            time.sleep(0.001)
+        ser.write(bytes([TOGGLE_FORCE_BLOCK_STREAM]))
+        taken = emulator.block_readings_taken
+        read_blocks(ser, decoder, blocks, lambda blocks: sum(len(b.raw_forces) for b in blocks) >= taken)
+        assert not emulator.firmware.force_block_stream
+    assert decoder.dropped_bytes == 0
+
+    # Every block but the last is full, and the last holds the readings taken since the previous one
+    counts = [len(block.raw_forces) for block in blocks]
+    assert counts[:-1] == [force_block_size] * (len(blocks) - 1)
+    assert counts[-1] == taken % force_block_size
+    assert sum(counts) == taken
+
+    # Base timestamps and deltas give each reading's timestamp, across the 32 bit wrap
+    timestamps = [t for block in blocks for t in block.timestamps.tolist()]
+    assert timestamps == [expected_timestamp(i) for i in range(taken)]
+    assert timestamps[-1] < timestamps[0]
+    assert [r for block in blocks for r in block.raw_forces.tolist()] == [t & 0xFFFF for t in timestamps]
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+from hand_protocol import (MessageDecoder, StringMessage, ServoPosition, AllServoPositions,
+    AllServoLimits, RawForce, RawForceBlock, MSG_FORCE_RAW_BLOCK,
+    encode_string_message, encode_servo_position_message, encode_all_positions_message,
+    encode_all_limits_message, encode_raw_force_message, encode_raw_force_block_message)
+from traffic_capture import read_capture, DIRECTION_IN
+
+"""
+
+Tests for hand_protocol.MessageDecoder
+
+Run from this directory with
+    python -m pytest test_hand_protocol.py
+
+"""
+
+# One frame of every message type, as the hand sends them
+frames = [
+    encode_string_message("Hand ready"),
+    encode_servo_position_message(3, 120),
+    encode_all_positions_message((10, 20, 30, 40, 50)),
+    encode_all_limits_message((0, 180, 5, 175, 10, 170, 15, 165, 20, 160)),
+    encode_raw_force_message(123456, 512),
+    encode_raw_force_block_message(1000, (0, 2, 3), (100, 200, 300)),
+    encode_raw_force_message(0xFFFFFFFF, 65535),
+    ]
+expected = [
+    StringMessage("Hand ready"),
+    ServoPosition(3, 120),
+    AllServoPositions((10, 20, 30, 40, 50)),
+    AllServoLimits(((0, 180), (5, 175), (10, 170), (15, 165), (20, 160))),
+    RawForce(123456, 512),
+    RawForceBlock(np.array([1000, 1002, 1005]), np.array([100, 200, 300])),
+    RawForce(0xFFFFFFFF, 65535),
+    ]
+stream = b''.join(frames)
+
+captures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "captures")
+
+
+# Messages with arrays as lists, so they can be compared with ==
+def plain(messages):
+    return [tuple(value.tolist() if hasattr(value, 'tolist') else value for value in message) for message in messages]
+
+
+def test_whole_stream():
+    decoder = MessageDecoder()
+    assert plain(decoder.feed(stream)) == plain(expected)
+    assert decoder.dropped_bytes == 0
+    assert decoder.pending_bytes == 0
+
+
+# The stream split in two at every byte boundary decodes the same
+def test_split_at_every_byte():
+    for split in range(len(stream) + 1):
+        decoder = MessageDecoder()
+        messages = decoder.feed(stream[:split]) + decoder.feed(stream[split:])
+        assert plain(messages) == plain(expected), f"split at {split}"
+        assert decoder.pending_bytes == 0
+
+
+def test_one_byte_at_a_time():
+    decoder = MessageDecoder()
+    messages = []
+    for i in range(len(stream)):
+        messages += decoder.feed(stream[i:i + 1])
+    assert plain(messages) == plain(expected)
+
+
+def test_frames_are_returned_unchanged():
+    decoder = MessageDecoder()
+    assert [frame for _, frame in decoder.feed_frames(stream)] == frames
+
+
+# Unknown opcodes are dropped one byte at a time and decoding picks up at the next frame
+def test_unknown_opcodes_are_dropped():
+    decoder = MessageDecoder()
+    garbage = bytes([0x0C, 0x7F, 0x0D])
+    data = frames[0] + garbage + frames[1] + bytes([0x0E]) + frames[4]
+    assert plain(decoder.feed(data)) == plain([expected[0], expected[1], expected[4]])
+    assert decoder.dropped_bytes == 4
+
+
+# A trailing partial frame is held until the rest arrives
+def test_truncated_trailing_frame():
+    for frame, message in zip(frames, expected):
+        for cut in range(1, len(frame)):
+            decoder = MessageDecoder()
+            assert plain(decoder.feed(frames[1] + frame[:cut])) == plain([expected[1]])
+            assert decoder.pending_bytes == cut
+            assert plain(decoder.feed(frame[cut:])) == plain([message])
+            assert decoder.pending_bytes == 0
+
+
+def test_reset_discards_partial_frame():
+    decoder = MessageDecoder()
+    decoder.feed(frames[4][:3])
+    decoder.reset()
+    assert decoder.pending_bytes == 0
+    assert plain(decoder.feed(frames[1])) == plain([expected[1]])
+
+
+# The firmware never sends a block with no readings - a count of 0 is a framing error
+def test_empty_force_block_is_a_framing_error():
+    decoder = MessageDecoder()
+    messages = decoder.feed(bytes([MSG_FORCE_RAW_BLOCK, 0]))
+    assert not any(type(message) is RawForceBlock for message in messages)
+    assert decoder.dropped_bytes == 1
+
+
+def test_unwrapped_timestamps_keep_increasing():
+    decoder = MessageDecoder(unwrap_timestamps=True)
+    messages = decoder.feed(encode_raw_force_message(0xFFFFFFF0, 1)
+                            + encode_raw_force_block_message(0xFFFFFFFE, (0, 1, 2), (2, 3, 4)))
+    assert messages[0].timestamp == 0xFFFFFFF0
+    assert messages[1].timestamps.tolist() == [0xFFFFFFFE, 0xFFFFFFFF, 0x100000001]
+    assert decoder.unwrapper.wraps == 1
+
+
+# Captured hand traffic decodes the same with its original read boundaries as in one piece
+def test_recorded_stream_read_boundaries():
+    _, records = read_capture(os.path.join(captures_dir, "blocks_115200.htc"))
+    reads = [data for _, direction, data in records if direction == DIRECTION_IN]
+    decoder = MessageDecoder()
+    messages = []
+    for data in reads:
+        messages += decoder.feed(data)
+    whole = MessageDecoder().feed(b''.join(reads))
+    assert plain(messages) == plain(whole)
+    assert any(type(message) is RawForceBlock for message in messages)
@@ -0,0 +1,283 @@
+import argparse
+import os
+import struct
+import time
+# Threading
+from threading import Thread, Lock, Event, Condition
+
+"""
+
+Capture of the raw byte streams between the computer and the hand
+
+Everything read from and written to the serial port is recorded with the
+time it was read or written, so a session can be replayed exactly - bytes
+split across reads as they were, garbage included - without the hand.
+Replay a capture through the GUI by typing its path in as the port, or
+through the decoder pipeline with replay_regression.py.
+
+File layout:
+    32 byte header - magic, format version, baud rate, capture start time (unix seconds)
+    Records - little endian float64 seconds since the start, uint8 direction,
+        uint16 length, then [length] bytes
+        Direction is DIRECTION_IN (hand to computer) or DIRECTION_OUT
+
+Record a session from the command line:
+    python traffic_capture.py record /dev/ttyACM0 session.htc --send 11 --duration 10
+    python traffic_capture.py info session.htc
+
+"""
+
+file_magic = b'HTCP'
+file_version = 1
+capture_extension = '.htc'
+_header_struct = struct.Struct('<4sHxxLd')
+header_size = 32
+_record_struct = struct.Struct('<dBH')
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+# Longest chunk in one record - longer reads are split
+_max_chunk = 0xFFFF
+
+
+# Appends captured bytes to a capture file
+# Writes are collected in memory and flushed to disk by a background thread
+# so the listener thread never waits on the disk (as force_recorder.ForceRecorder)
+class TrafficCapture:
+    def __init__(self, path, baudrate=0, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.bytes_captured = [0, 0]    # In, out
+        self._start = time.perf_counter()
+        self._file = open(path, 'wb')
+        header = _header_struct.pack(file_magic, file_version, baudrate or 0, time.time())
+        self._file.write(header.ljust(header_size, b'\0'))
+        self._pending = bytearray()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Add bytes read or written at timestamp (time.perf_counter(), now if None)
+    def record(self, direction, data, timestamp=None):
+        if not data:
+            return
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        elapsed = timestamp - self._start
+        with self._lock:
+            for i in range(0, len(data), _max_chunk):
+                chunk = data[i:i + _max_chunk]
+                self._pending += _record_struct.pack(elapsed, direction, len(chunk))
+                self._pending += chunk
+            self.bytes_captured[direction] += len(data)
+
+    def record_in(self, data, timestamp=None):
+        self.record(DIRECTION_IN, data, timestamp)
+
+    def record_out(self, data, timestamp=None):
+        self.record(DIRECTION_OUT, data, timestamp)
+
+    # Write out pending records and stop the writer thread
+    def close(self):
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._flush()
+        self._file.close()
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            data = self._pending
+            self._pending = bytearray()
+        if data:
+            self._file.write(data)
+            self._file.flush()
+
+
+# Read a capture, returns (header dict, list of (seconds, direction, bytes))
+# A partially written final record (e.g. after a crash) is ignored
+def read_capture(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < header_size:
+        raise ValueError(f"{path} is too short to be a traffic capture")
+    magic, version, baudrate, start_time = _header_struct.unpack_from(data)
+    if magic != file_magic:
+        raise ValueError(f"{path} is not a traffic capture")
+    if version != file_version:
+        raise ValueError(f"{path} has unsupported format version {version}")
+    records = []
+    pos = header_size
+    while pos + _record_struct.size <= len(data):
+        elapsed, direction, length = _record_struct.unpack_from(data, pos)
+        pos += _record_struct.size
+        if pos + length > len(data):
+            break
+        records.append((elapsed, direction, data[pos:pos + length]))
+        pos += length
+    return {'version': version, 'baudrate': baudrate, 'start_time': start_time}, records
+
+
+# Serial port stand-in that plays back the hand's side of a capture
+# Has the pySerial methods used by the GUI - captured reads become available at
+# their original times divided by speed, or if speed is None one at a time as
+# soon as the previous one has been read, keeping the original read boundaries
+# Bytes written are kept in .written (not checked against the capture)
+class CaptureReplaySerial:
+    def __init__(self, path, speed=1.0, timeout=1):
+        header, records = read_capture(path)
+        self.port = path
+        self.baudrate = header['baudrate'] or 9600
+        self.timeout = timeout
+        self.speed = speed
+        self._chunks = [(elapsed, data) for elapsed, direction, data in records if direction == DIRECTION_IN]
+        self._next = 0
+        self._buffer = bytearray()
+        self._lock = Condition()
+        self._start = None
+        self.written = bytearray()
+        self.is_open = False
+
+    # True once every captured read has been returned
+    @property
+    def finished(self):
+        return self._next >= len(self._chunks) and not self._buffer
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._release_due()
+            return len(self._buffer)
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def open(self):
+        self.is_open = True
+        self._start = time.perf_counter()
+
+    def close(self):
+        with self._lock:
+            self.is_open = False
+            self._lock.notify_all()
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Read up to size bytes, waiting up to timeout for at least one
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        with self._lock:
+            while self.is_open:
+                wait = self._release_due()
+                if self._buffer:
+                    break
+                now = time.perf_counter()
+                if deadline is not None:
+                    if now >= deadline:
+                        break
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._lock.wait(wait)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    # Move captured reads that are due into the buffer
+    # Returns seconds until the next one is due, or None if there are no more
+    def _release_due(self):
+        if self._start is None:
+            return None
+        if self.speed is None:
+            if not self._buffer and self._next < len(self._chunks):
+                self._buffer += self._chunks[self._next][1]
+                self._next += 1
+            return None
+        now = time.perf_counter() - self._start
+        while self._next < len(self._chunks):
+            elapsed, data = self._chunks[self._next]
+            if elapsed / self.speed > now:
+                return elapsed / self.speed - now
+            self._buffer += data
+            self._next += 1
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or inspect serial traffic captures")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help="Record traffic from a serial port")
+    record_parser.add_argument("port", help="Serial port or pySerial url, or 'emulator' for the hand emulator")
+    record_parser.add_argument("path", help="Capture file to write")
+    record_parser.add_argument("--baudrate", type=int, default=9600)
+    record_parser.add_argument("--duration", type=float, default=5.0, help="Seconds to record")
+    record_parser.add_argument("--start-millis", type=int, default=0, help="Emulator millis() value at start")
+    record_parser.add_argument("--max-rate", action="store_true", help="Emulator streams as fast as the link allows")
+    record_parser.add_argument("--send", type=lambda s: int(s, 0), nargs='*', default=[],
+                               help="Command bytes to send after opening (e.g. 11 to toggle the force stream)")
+    record_parser.add_argument("--send-after", type=lambda s: int(s, 0), nargs='*', default=[],
+                               help="Command bytes to send before closing (e.g. 11 to stop the force stream)")
+    info_parser = commands.add_parser('info', help="Summarise a capture")
+    info_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        import serial
+        emulator = None
+        if args.port == 'emulator':
+            from hand_emulator import HandFirmware, MemoryHandEmulator
+            emulator = MemoryHandEmulator(HandFirmware(start_millis=args.start_millis), baudrate=args.baudrate,
+                                          stream_interval=0 if args.max_rate else 0.1,
+                                          block_interval=0 if args.max_rate else 0.01)
+            emulator.start()
+            ser = emulator.serial
+        else:
+            ser = serial.serial_for_url(args.port, baudrate=args.baudrate, timeout=0.1)
+        ser.timeout = 0.1
+        with TrafficCapture(args.path, args.baudrate) as capture:
+            def send(values):
+                if values:
+                    data = bytes(values)
+                    ser.write(data)
+                    capture.record_out(data)
+            send(args.send)
+            end = time.perf_counter() + args.duration
+            while time.perf_counter() < end:
+                data = ser.read(ser.in_waiting or 1)
+                capture.record_in(data)
+            send(args.send_after)
+            # Collect the replies to the final commands
+            time.sleep(0.2)
+            capture.record_in(ser.read(ser.in_waiting))
+        ser.close()
+        if emulator is not None:
+            emulator.close()
+        print(f"Captured {capture.bytes_captured[DIRECTION_IN]} bytes in and "
+              f"{capture.bytes_captured[DIRECTION_OUT]} bytes out to {args.path}")
+    else:
+        header, records = read_capture(args.path)
+        duration = records[-1][0] if records else 0.0
+        for direction, name in ((DIRECTION_IN, "in"), (DIRECTION_OUT, "out")):
+            chunks = [data for _, d, data in records if d == direction]
+            total = sum(len(c) for c in chunks)
+            print(f"{name:<4}{len(chunks):>8} reads/writes {total:>10} bytes {total / max(duration, 1e-9):>10.0f} B/s")
+        print(f"Baud rate {header['baudrate']}, {duration:.2f} s, "
+              f"recorded {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['start_time']))}, "
+              f"{os.path.getsize(args.path)} bytes on disk")
@@ -0,0 +1,259 @@
+import argparse
+import json
+import time
+import warnings
+import numpy as np
+# Hand serial protocol
+from hand_protocol import CommandBuffer, MessageDecoder, AllServoLimits, QUERY_ALL_LIMITS, servo_count
+from scheduling import FixedRateScheduler
+
+"""
+
+Trajectory playback - smooth servo motions from keyframes
+
+Keyframes are given per servo as (time in seconds, position) pairs:
+    keyframes = {
+        0: [(0.0, 0), (1.0, 180), (2.0, 90)],   # Finger 0
+        4: [(0.0, 0), (2.0, 120)],              # Thumb
+        }
+The whole trajectory is interpolated up front at the playback rate and
+clamped to the servo limits, then streamed by a TrajectoryPlayer thread.
+Only setpoints that change from one tick to the next are sent.
+play_trajectory() queries the limits from the hand, clamps and plays.
+
+Play keyframes from a JSON file ({"servo": [[time, position], ...]}), or a
+demo grasp, on the hand emulator or a real hand:
+    python trajectory.py --keyframes grasp.json --method min_jerk
+    python trajectory.py --port /dev/ttyACM0
+
+"""
+
+interpolation_methods = ('linear', 'cubic', 'min_jerk')
+
+
+# Raised (as a warning) when a trajectory needs more bytes per second than the link can carry
+class LinkBudgetWarning(UserWarning):
+    pass
+
+
+# Maximum updates per second when each update changes [servos] servos
+# Each servo command is 2 bytes and each byte is 10 bits on the wire
+def max_update_rate(baudrate, servos=servo_count):
+    return baudrate / 10.0 / (2 * servos)
+
+
+# Interpolate keyframe positions at sample_times
+# Times must be increasing - samples outside the keyframes hold the end positions
+def interpolate(times, positions, sample_times, method='linear'):
+    times = np.asarray(times, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    if method not in interpolation_methods:
+        raise ValueError(f"Unknown interpolation method '{method}' - use one of {interpolation_methods}")
+    if len(times) == 1 or method == 'linear':
+        return np.interp(sample_times, times, positions)
+    if np.any(np.diff(times) <= 0):
+        raise ValueError("Keyframe times must be increasing")
+
+    # Segment containing each sample and position within it (0 to 1)
+    t = np.clip(sample_times, times[0], times[-1])
+    segment = np.clip(np.searchsorted(times, t, side='right') - 1, 0, len(times) - 2)
+    t0 = times[segment]
+    dt = times[segment + 1] - t0
+    s = (t - t0) / dt
+    p0 = positions[segment]
+    p1 = positions[segment + 1]
+
+    if method == 'min_jerk':
+        # Rest to rest minimum jerk profile between each pair of keyframes
+        return p0 + (p1 - p0) * (s**3 * (10.0 - 15.0*s + 6.0*s**2))
+
+    # Cubic Hermite spline with Catmull-Rom tangents, at rest at the first and last keyframe
+    tangents = np.zeros_like(positions)
+    tangents[1:-1] = (positions[2:] - positions[:-2]) / (times[2:] - times[:-2])
+    m0 = tangents[segment] * dt
+    m1 = tangents[segment + 1] * dt
+    s2 = s * s
+    s3 = s2 * s
+    return ((2*s3 - 3*s2 + 1) * p0 + (s3 - 2*s2 + s) * m0
+            + (-2*s3 + 3*s2) * p1 + (s3 - s2) * m1)
+
+
+# Servo setpoints sampled at a fixed rate
+class Trajectory:
+    def __init__(self, keyframes, rate, method='linear'):
+        if not keyframes:
+            raise ValueError("Trajectory needs keyframes for at least one servo")
+        self.rate = rate
+        self.method = method
+        end_time = max(frame[0] for frames in keyframes.values() for frame in frames)
+        self.times = np.arange(int(round(end_time * rate)) + 1) / rate
+        # One column per servo - servos without keyframes are -1 and never sent
+        self.setpoints = np.full((len(self.times), servo_count), -1, dtype=np.int16)
+        for servo, frames in keyframes.items():
+            if not 0 <= servo < servo_count:
+                raise ValueError(f"Servo must be 0 to {servo_count - 1}, got {servo}")
+            frames = sorted(frames)
+            values = interpolate([f[0] for f in frames], [f[1] for f in frames], self.times, method)
+            self.setpoints[:, servo] = np.clip(np.rint(values), 0, 255)
+
+    @property
+    def duration(self):
+        return self.times[-1]
+
+    # Limit every setpoint to the servo limits
+    # limits is the (min, max) per servo tuple returned by a limits query
+    def clamp(self, limits):
+        for servo, (l_min, l_max) in enumerate(limits):
+            column = self.setpoints[:, servo]
+            used = column >= 0
+            column[used] = np.clip(column[used], l_min, l_max)
+        return self
+
+    # Bytes sent on each tick, only counting servos that change
+    def bytes_per_tick(self):
+        changed = np.ones_like(self.setpoints, dtype=bool)
+        changed[1:] = self.setpoints[1:] != self.setpoints[:-1]
+        changed &= self.setpoints >= 0
+        return 2 * changed.sum(axis=1)
+
+    # Check the trajectory fits the link at the given baud rate
+    # Returns a list of problems (empty if it fits) and raises a LinkBudgetWarning for each
+    def check_link_budget(self, baudrate):
+        problems = []
+        bytes_per_second = baudrate / 10.0
+        per_tick = self.bytes_per_tick()
+        average = per_tick.mean() * self.rate
+        if average > bytes_per_second:
+            problems.append(f"Trajectory needs {average:.0f} bytes/s on average but {baudrate} baud carries {bytes_per_second:.0f} bytes/s")
+        worst = per_tick.max()
+        if worst * self.rate > bytes_per_second:
+            servos = worst // 2
+            problems.append(f"Updates changing {servos} servos at {self.rate} Hz exceed the link - "
+                            f"maximum rate is {max_update_rate(baudrate, servos):.1f} Hz")
+        for problem in problems:
+            warnings.warn(problem, LinkBudgetWarning, stacklevel=2)
+        return problems
+
+
+# Streams a trajectory from a fixed-rate scheduler thread
+# write is called with the command bytes for each tick (e.g. serial.Serial.write)
+class TrajectoryPlayer:
+    def __init__(self, trajectory, write, baudrate=9600):
+        self.trajectory = trajectory
+        self._write = write
+        self._commands = CommandBuffer()
+        self._last_sent = np.full(servo_count, -1, dtype=np.int16)
+        self._scheduler = FixedRateScheduler(trajectory.rate, self._tick, name="Trajectory player")
+        trajectory.check_link_budget(baudrate)
+
+    def start(self):
+        self._last_sent[:] = -1
+        self._scheduler.start()
+
+    def stop(self):
+        self._scheduler.stop()
+
+    # Wait for playback to finish
+    def join(self, timeout=None):
+        self._scheduler.join(timeout)
+
+    @property
+    def is_playing(self):
+        return self._scheduler.is_running
+
+    def _tick(self, tick, scheduled_time):
+        setpoints = self.trajectory.setpoints
+        if not len(setpoints):
+            return False
+        # Missed deadlines can skip past the end - the final setpoints are still sent
+        tick = min(tick, len(setpoints) - 1)
+        row = setpoints[tick]
+        for servo in np.flatnonzero((row != self._last_sent) & (row >= 0)):
+            self._commands.set_servo(int(servo), int(row[servo]))
+        self._commands.flush(self._write)
+        self._last_sent[:] = row
+        return tick < len(setpoints) - 1
+
+    # Scheduler timing and command statistics
+    def stats(self):
+        stats = self._scheduler.stats()
+        stats['ticks_total'] = len(self.trajectory.setpoints)
+        stats.update(self._commands.stats())
+        return stats
+
+
+# Ask the hand on a serial port for its servo limits, returns the (min, max) per servo tuple
+# Other messages arriving meanwhile are discarded - raises TimeoutError if there is no reply
+def query_servo_limits(ser, timeout=1.0):
+    decoder = MessageDecoder()
+    ser.write(bytes([QUERY_ALL_LIMITS]))
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        for message in decoder.feed(ser.read(ser.in_waiting or 1)):
+            if type(message) is AllServoLimits:
+                return message.limits
+    raise TimeoutError("No reply to the servo limits query")
+
+
+# Clamp a trajectory to the limits queried from the hand and play it on a serial port
+# Waits for playback to finish and returns the player for its statistics
+def play_trajectory(ser, trajectory, baudrate=9600, reply_timeout=1.0):
+    trajectory.clamp(query_servo_limits(ser, reply_timeout))
+    player = TrajectoryPlayer(trajectory, ser.write, baudrate)
+    player.start()
+    player.join()
+    return player
+
+
+# Close the fingers and thumb past the default limits, hold, then open
+demo_keyframes = {
+    0: [(0.0, 0), (1.5, 200), (2.5, 200), (3.5, 0)],
+    1: [(0.0, 0), (1.5, 200), (2.5, 200), (3.5, 0)],
+    2: [(0.0, 0), (1.5, 200), (2.5, 200), (3.5, 0)],
+    3: [(0.0, 0), (1.5, 200), (2.5, 200), (3.5, 0)],
+    4: [(0.0, 0), (0.5, 0), (1.5, 120), (3.0, 120), (3.5, 0)],
+    }
+
+
+if __name__ == "__main__":
+    import serial
+    from hand_emulator import HandFirmware, PtyHandEmulator
+
+    parser = argparse.ArgumentParser(description="Play a servo trajectory on the hand, clamped to its servo limits")
+    parser.add_argument("--keyframes", help="JSON file of keyframes per servo (default: a demo grasp)")
+    parser.add_argument("--method", choices=interpolation_methods, default='min_jerk')
+    parser.add_argument("--rate", type=float, default=50, help="Setpoint rate (Hz)")
+    parser.add_argument("--port", help="Use a real hand on this port instead of the emulator")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    args = parser.parse_args()
+
+    keyframes = demo_keyframes
+    if args.keyframes:
+        with open(args.keyframes) as f:
+            keyframes = {int(servo): [tuple(frame) for frame in frames] for servo, frames in json.load(f).items()}
+    trajectory = Trajectory(keyframes, args.rate, args.method)
+
+    emulator = None
+    port = args.port
+    if port is None:
+        emulator = PtyHandEmulator(HandFirmware(debug_only=False), baudrate=args.baudrate)
+        emulator.start()
+        port = emulator.port
+
+    ser = serial.Serial(port, args.baudrate, timeout=0.1)
+    requested = trajectory.setpoints.copy()
+    try:
+        player = play_trajectory(ser, trajectory, args.baudrate)
+    finally:
+        ser.close()
+        if emulator is not None:
+            emulator.close()
+
+    clamped = int(np.count_nonzero(requested != trajectory.setpoints))
+    print(f"Played {trajectory.duration:.2f} s at {args.rate:.0f} Hz ({args.method}), "
+          f"{clamped} setpoints clamped to the servo limits")
+    if emulator is not None:
+        print(f"Emulated servo positions at the end : {emulator.firmware.servo_positions}")
+    for name, value in player.stats().items():
+        print(f"{name:<24}{value:>12.1f}" if isinstance(value, float) else f"{name:<24}{value:>12}")
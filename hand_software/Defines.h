@@ -18,4 +18,10 @@
 // If defined false force readings will be generated - used to test data graphing
 #define GENERATE_FALSE_FORCE_DATA
 
+// Force block stream settings
+// Readings are sent in blocks of up to FORCE_BLOCK_SIZE readings
+// One reading is taken every FORCE_BLOCK_SAMPLE_INTERVAL milliseconds
+#define FORCE_BLOCK_SIZE 16
+#define FORCE_BLOCK_SAMPLE_INTERVAL 10
+
 #endif
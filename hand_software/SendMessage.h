@@ -8,6 +8,7 @@
 #define MSG_ALL_POSITIONS 0b00001000
 #define MSG_ALL_LIMITS 0b00001001
 #define MSG_FORCE_RAW 0b00001010
+#define MSG_FORCE_RAW_BLOCK 0b00001011
 
 #define MAX_SINGLE_MESSAGE_LENGTH 128
 
@@ -88,6 +89,26 @@ namespace Send {
     }
   }
 
+  // Send a block of raw force readings
+  // Format (little endian):
+  //    1 byte  - number of readings
+  //    4 bytes - unsigned long timestamp of first reading
+  //    Then for each reading:
+  //    1 byte  - milliseconds since previous reading (0 for first reading)
+  //    2 bytes - unsigned short reading
+  void sendRawForceBlock(uint32_t timestamp, uint8_t* deltas, uint16_t* readings, uint8_t count) {
+    sendMessageByte(MSG_FORCE_RAW_BLOCK);
+    sendMessageByte(count);
+    for (int i = 0; i < 4; i++) {
+      sendMessageByte((timestamp >> (8 * i)) & 0xFF);
+    }
+    for (int i = 0; i < count; i++) {
+      sendMessageByte(deltas[i]);
+      sendMessageByte(readings[i] & 0xFF);
+      sendMessageByte(readings[i] >> 8);
+    }
+  }
+
 }
 
 #endif
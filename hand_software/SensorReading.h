@@ -31,6 +31,38 @@ namespace Sensor {
   void sendReadingDetails() {
     Send::sendRawForce(rawForceTimestamp, rawForceReading);
   }
+
+  // Readings waiting to be sent as a block
+  uint32_t blockTimestamp = 0;      // Timestamp of first reading in block
+  uint32_t blockLastTimestamp = 0;  // Timestamp of last reading in block
+  uint8_t blockDeltas[FORCE_BLOCK_SIZE];
+  uint16_t blockReadings[FORCE_BLOCK_SIZE];
+  uint8_t blockCount = 0;
+
+  /* Send any readings waiting in the block */
+  void sendReadingBlock() {
+    if (blockCount == 0)
+      return;
+    Send::sendRawForceBlock(blockTimestamp, blockDeltas, blockReadings, blockCount);
+    blockCount = 0;
+  }
+
+  /* Add the current reading to the block, sending the block when it is full */
+  void addReadingToBlock() {
+    // Time since last reading must fit in one byte - send block early if not
+    if (blockCount > 0 && rawForceTimestamp - blockLastTimestamp > 255)
+      sendReadingBlock();
+    if (blockCount == 0) {
+      blockTimestamp = rawForceTimestamp;
+      blockLastTimestamp = rawForceTimestamp;
+    }
+    blockDeltas[blockCount] = rawForceTimestamp - blockLastTimestamp;
+    blockReadings[blockCount] = rawForceReading;
+    blockLastTimestamp = rawForceTimestamp;
+    blockCount++;
+    if (blockCount == FORCE_BLOCK_SIZE)
+      sendReadingBlock();
+  }
   
 }
 
@@ -7,6 +7,7 @@
 #define QUERY_ALL_LIMITS 0b00001001
 #define QUERY_FORCE_RAW 0b00001010
 #define TOGGLE_FORCE_STREAM 0b00001011
+#define TOGGLE_FORCE_BLOCK_STREAM 0b00001100
 
 void setup() {
   Serial.begin(9600);
@@ -14,6 +15,7 @@ void setup() {
 }
 
 bool sendForceStream = false;
+bool sendForceBlockStream = false;
 
 void loop() {
   // Check for messages
@@ -55,6 +57,10 @@ void loop() {
       Sensor::sendReadingDetails(); // Send reading
     } else if (in == TOGGLE_FORCE_STREAM) {   // Toggle force reading data stream
       sendForceStream = !sendForceStream;
+    } else if (in == TOGGLE_FORCE_BLOCK_STREAM) {   // Toggle block force reading data stream
+      sendForceBlockStream = !sendForceBlockStream;
+      if (!sendForceBlockStream)
+        Sensor::sendReadingBlock();   // Send readings left in partial block
     } else if ((in >> 7) == 1) {              // Set servos to preset position
       // Retrieve configuration and set servos to it
       uint8_t *positions = ServoConfigurations::GetConfiguration(in - 0b10000000);
@@ -69,4 +75,9 @@ void loop() {
     Sensor::sendReadingDetails();
     delay(100);
   }
+  if (sendForceBlockStream) {
+    Sensor::updateReading();
+    Sensor::addReadingToBlock();
+    delay(FORCE_BLOCK_SAMPLE_INTERVAL);
+  }
 }